@@ -0,0 +1,68 @@
+""" Measures the upload throughput of SSH.copy_file against a local paramiko sftp server.
+
+The fake host is reached through a tcp proxy that delays traffic by `--rtt` milliseconds to emulate a remote link.
+The `per call session` row reproduces the old behaviour (a new sftp session and a plain `put` for every file).
+
+usage: python benchmarks/bench_copy_file.py [--size MB] [--rtt MS ...] [--compress]
+"""
+import argparse
+import os
+import tempfile
+
+import common
+import sshd
+from hephaestus.ssh import SSH
+
+def per_call_session(ssh_client, src, dest):
+  ftp_client = ssh_client.ssh_client.open_sftp()
+  ftp_client.put(src, dest)
+  ftp_client.close()
+
+def upload(address, src, dest, copy, compress = False, **settings):
+  """ Uploads src 3 times over a single connection and returns the throughput in MB/s. """
+  ssh_client = SSH(address)
+  ssh_client.compress = compress
+  for name, value in settings.items():
+    setattr(ssh_client, name, value)
+  ssh_client.connect()
+  try:
+    copy(ssh_client, src, dest)  # warm up (sftp session, tcp window)
+    elapsed, value = common.timed(lambda: [copy(ssh_client, src, dest) for i in range(3)])
+  finally:
+    ssh_client.close()
+  return 3 * os.path.getsize(src) / 1024.0 / 1024.0 / elapsed
+
+def main():
+  parser = argparse.ArgumentParser(description = 'SSH.copy_file throughput')
+  parser.add_argument('--size', type = int, default = 8, help = 'size of the uploaded file in MB')
+  parser.add_argument('--rtt', type = int, nargs = '+', default = [0, 20, 50], help = 'round trip times in ms')
+  parser.add_argument('--compress', action = 'store_true', help = 'compress the ssh traffic')
+  args = parser.parse_args()
+
+  host = sshd.FakeSSHServer()
+  workdir = tempfile.mkdtemp(prefix = 'hep-bench-')
+  src = os.path.join(workdir, 'src')
+  dest = os.path.join(workdir, 'dest')
+  with open(src, 'wb') as f:
+    f.write(os.urandom(args.size * 1024 * 1024))
+
+  cases = [
+    ('per call session', per_call_session, {}),
+    ('copy_file, 1 pending write', SSH.copy_file, {'max_pending_writes': 1}),
+    ('copy_file, 16 pending writes', SSH.copy_file, {'max_pending_writes': 16}),
+    ('copy_file, 64 pending writes', SSH.copy_file, {'max_pending_writes': 64}),
+  ]
+
+  rows = []
+  for rtt in args.rtt:
+    link = sshd.DelayedLink(host.address, rtt / 1000.0)
+    for name, copy, settings in cases:
+      rows.append([rtt, name, '%.1f' % (upload(link.address, src, dest, copy, args.compress, **settings))])
+    link.stop()
+
+  print('%d MB file, compression %s' % (args.size, 'on' if args.compress else 'off'))
+  common.table(['rtt (ms)', 'upload', 'MB/s'], rows)
+  host.stop()
+
+if __name__ == '__main__':
+  main()
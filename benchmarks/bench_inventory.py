@@ -0,0 +1,90 @@
+""" Measures the time and memory it takes to read a synthetic hosts file of `--hosts` hosts.
+
+The hosts file has `--groups` groups, each one listing half of its hosts one per line and the other half as a
+single range. The `readlines` row reproduces the old behaviour (the whole file read into a list of lines), the
+other rows go through hephaestus/inventory.py with various `--limit` patterns. Each row is measured in a forked
+process, memory is the growth of its peak resident set size (linux only).
+
+usage: python benchmarks/bench_inventory.py [--hosts N] [--groups N]
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+
+import common
+from hephaestus.inventory import Inventory
+
+def generate(path, hosts, groups):
+  """ Writes a hosts file of `hosts` hosts split into `groups` groups. """
+  per_group = hosts // groups
+  with open(path, 'w') as f:
+    for group in range(groups):
+      f.write('\n# group %d\n[g%03d]\n' % (group, group))
+      for i in range(per_group // 2):
+        f.write('host-%03d-%06d.example.com\n' % (group, i))
+      f.write('range-%03d-[%06d:%06d].example.com\n' % (group, 0, per_group - per_group // 2 - 1))
+
+def readlines(path):
+  with open(os.path.realpath(path)) as f:
+    return [x.strip() for x in f.readlines()]
+
+def rss(field):
+  """ Returns a memory field of /proc/self/status (i.e. `VmHWM`, the peak resident set size) in MB. """
+  with open('/proc/self/status') as f:
+    for line in f:
+      if (line.startswith(field + ':')):
+        return int(line.split()[1]) / 1024.0
+
+def measure(function):
+  """ Returns (seconds, peak memory growth in MB or None, number of hosts) of a call made in a forked process. """
+  read, write = os.pipe()
+  pid = os.fork()
+  if (pid == 0):
+    os.close(read)
+    try:
+      # reset the peak resident set size to the current one
+      with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+      before = rss('VmRSS')
+    except (IOError, OSError):
+      before = None
+    elapsed, hosts = common.timed(function)
+    growth = rss('VmHWM') - before if before != None else None
+    os.write(write, json.dumps([elapsed, growth, len(hosts)]).encode('ascii'))
+    os._exit(0)
+
+  os.close(write)
+  result = os.read(read, 4096)
+  os.close(read)
+  os.waitpid(pid, 0)
+  return json.loads(result.decode('ascii'))
+
+def main():
+  parser = argparse.ArgumentParser(description = 'hosts file parsing time and memory')
+  parser.add_argument('--hosts', type = int, default = 100000, help = 'number of hosts of the hosts file')
+  parser.add_argument('--groups', type = int, default = 100, help = 'number of groups of the hosts file')
+  args = parser.parse_args()
+
+  tmp = tempfile.mkdtemp()
+  try:
+    path = os.path.join(tmp, 'hosts')
+    generate(path, args.hosts, args.groups)
+    print('%d hosts in %d groups, %.1f MB hosts file' % (args.hosts, args.groups, os.path.getsize(path) / 1024.0 / 1024.0))
+
+    rows = []
+    for name, function in [
+        ('readlines (old)', lambda: readlines(path)),
+        ('inventory, every host', lambda: list(Inventory(path).hosts())),
+        ('inventory, --limit g042', lambda: list(Inventory(path).hosts('g042'))),
+        ('inventory, --limit g042,!range*', lambda: list(Inventory(path).hosts('g042,!range*'))),
+        ('inventory, --limit host-042-00001*', lambda: list(Inventory(path).hosts('host-042-00001*')))]:
+      elapsed, peak, hosts = measure(function)
+      rows.append([name, hosts, '%.0f' % (elapsed * 1000), '%.1f' % (peak) if peak != None else 'n/a'])
+    common.table(['hosts file', 'hosts', 'time (ms)', 'memory (MB)'], rows)
+  finally:
+    shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,102 @@
+""" Runs examples/manifests/manifest.yml against simulated hosts and reports how long a run takes.
+
+Each simulated host is a local fake ssh server (see tests/sshd.py) reached through a tcp proxy that delays traffic
+by `--rtt` milliseconds and optionally limits it to `--bandwidth` Mbit/s. The dest files of the manifest are moved
+into each host's own directory and owned by the current user, everything else (apt packages, services) is handled
+by the fakebin stubs. The manifest is run twice: the first run converges fresh hosts, the second one finds nothing
+to change. Round trips and bytes are counted by the `SSH` class (see hephaestus/stats.py), so they don't include
+the ssh handshake nor the ssh framing.
+
+usage: python benchmarks/bench_manifest.py [--hosts N] [--forks N] [--task-concurrency N] [--rtt MS ...] [--bandwidth MBIT] [--manifest PATH]
+"""
+import argparse
+import copy
+import grp
+import os
+import pwd
+
+import common
+import sshd
+from hephaestus.config import config
+from hephaestus.events import EventStream
+from hephaestus.plan import Plan
+from hephaestus.stats import Stats
+from hephaestus.task_runner import TaskRunner
+
+OWNER = pwd.getpwuid(os.getuid()).pw_name
+GROUP = grp.getgrgid(os.getgid()).gr_name
+
+def localize(tasks, root):
+  """ Returns a copy of the tasks with the dest files moved into root and src files relative to the repo root. """
+  tasks = copy.deepcopy(tasks)
+  for task in tasks:
+    if ('file' in task):
+      options = task['file']
+      options['src'] = os.path.join(common.ROOT, options['src'])
+      options['dest'] = os.path.join(root, options['dest'].lstrip('/'))
+      options['owner'] = OWNER
+      options['group'] = GROUP
+      if (not os.path.isdir(os.path.dirname(options['dest']))):
+        os.makedirs(os.path.dirname(options['dest']))
+  return tasks
+
+class BenchRunner(TaskRunner):
+  """ A TaskRunner that runs a plan of the manifest localized to each fake host (see `localize`). """
+
+  def __init__(self, manifest, hosts, roots):
+    TaskRunner.__init__(self, manifest, hosts)
+    self.plans = dict((host, Plan(localize(self.plan.tasks, roots[host]))) for host in hosts)
+    self.stats = Stats()
+    # the events are not displayed
+    self.events = EventStream([])
+
+def run(manifest, links, roots):
+  """ Runs the manifest on every host, returns (elapsed seconds, results, stats report). """
+  runner = BenchRunner(manifest, [link.address for link in links], roots)
+  elapsed, results = common.timed(runner.run)
+  return elapsed, results, runner.stats.report()
+
+def main():
+  parser = argparse.ArgumentParser(description = 'manifest run time against simulated hosts')
+  parser.add_argument('--hosts', type = int, default = 10, help = 'number of simulated hosts')
+  parser.add_argument('--forks', type = int, default = 5, help = 'number of hosts converged in parallel')
+  parser.add_argument('--task-concurrency', type = int, default = 1, help = 'number of independent tasks run at the same time on each host')
+  parser.add_argument('--rtt', type = int, nargs = '+', default = [0, 50], help = 'round trip times in ms')
+  parser.add_argument('--bandwidth', type = float, help = 'bandwidth of each link in Mbit/s (unlimited by default)')
+  parser.add_argument('--manifest', default = os.path.join(common.ROOT, 'examples/manifests/manifest.yml'),
+                      help = 'manifest to run')
+  args = parser.parse_args()
+
+  config['forks'] = args.forks
+  config['task_concurrency'] = args.task_concurrency
+  bandwidth = args.bandwidth * 1000 * 1000 / 8 if args.bandwidth else None
+
+  rows = []
+  for rtt in args.rtt:
+    hosts = [sshd.FakeSSHServer() for i in range(args.hosts)]
+    links = [sshd.DelayedLink(host.address, rtt / 1000.0, bandwidth) for host in hosts]
+    roots = dict((link.address, host.root) for link, host in zip(links, hosts))
+
+    for name in ['converge', 'no change']:
+      elapsed, results, report = run(args.manifest, links, roots)
+      failed = [host for host, result in results.items() if result['failed']]
+      if (failed):
+        raise SystemExit('the manifest failed on %s' % (', '.join(failed)))
+
+      stats = report['hosts'].values()
+      tasks = sum(len(host['tasks']) for host in stats)
+      round_trips = sum(host['execute_calls'] + host['agent_calls'] + host['copy_file_calls'] for host in stats)
+      moved = sum(host['bytes_sent'] + host['bytes_received'] for host in stats)
+      rows.append([rtt, name, '%.2f' % (elapsed), '%.0f' % (args.hosts * 60 / elapsed),
+                   '%.2f' % (float(round_trips) / tasks), '%.1f' % (moved / 1024.0 / args.hosts)])
+
+    for link, host in zip(links, hosts):
+      link.stop()
+      host.stop()
+
+  print('%d hosts, %d forks, %d concurrent tasks per host, bandwidth %s' % (args.hosts, args.forks, args.task_concurrency,
+        '%g Mbit/s' % (args.bandwidth) if args.bandwidth else 'unlimited'))
+  common.table(['rtt (ms)', 'run', 'wall (s)', 'hosts/minute', 'round trips/task', 'KB/host'], rows)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,73 @@
+""" Measures the time it takes to render a templated manifest for `--hosts` hosts sharing `--sets` sets of variables.
+
+The manifest deploys a templated file (`--size` KB) to every host. The `render every host` row renders and hashes
+the template once per host, as a naive templating stage would. The `TaskRunner` row goes through
+hephaestus/template.py, which renders and hashes once per distinct set of the variables the template uses (every
+host also has a `host_id` variable the template does not use). Nothing is run on the hosts.
+
+usage: python benchmarks/bench_render.py [--hosts N] [--sets N] [--size KB]
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import string
+import tempfile
+
+import common
+from hephaestus import template
+from hephaestus.task_runner import TaskRunner
+
+MANIFEST = """
+- name: "Deploy the config"
+  file:
+    src: "%(src)s"
+    dest: "/etc/app/app.conf"
+    owner: "root"
+    group: "root"
+    mod: 644
+    action: "present"
+    template: true
+"""
+
+def naive(path, hosts, variables):
+  """ Renders and hashes the template for every host. """
+  with open(path) as f:
+    text = f.read()
+  for host in hosts:
+    hashlib.sha256(string.Template(text).substitute(variables[host]).encode('utf-8')).hexdigest()
+  return hosts
+
+def main():
+  parser = argparse.ArgumentParser(description = 'templated manifest rendering time')
+  parser.add_argument('--hosts', type = int, default = 1000, help = 'number of hosts')
+  parser.add_argument('--sets', type = int, default = 4, help = 'number of distinct sets of variables')
+  parser.add_argument('--size', type = int, default = 64, help = 'size of the template in KB')
+  args = parser.parse_args()
+
+  tmp = tempfile.mkdtemp()
+  try:
+    src = os.path.join(tmp, 'app.conf')
+    with open(src, 'w') as f:
+      line = 'listen $listen; workers $workers; # %s\n' % ('x' * 64)
+      f.write(line * (args.size * 1024 // len(line)))
+    with open(os.path.join(tmp, 'manifest.yaml'), 'w') as f:
+      f.write(MANIFEST % {'src': src})
+
+    hosts = ['10.0.%d.%d' % (i // 256, i % 256) for i in range(args.hosts)]
+    variables = dict((host, {'listen': '10.1.0.%d' % (i % args.sets), 'workers': '4', 'host_id': str(i)})
+                     for i, host in enumerate(hosts))
+
+    rows = []
+    elapsed, value = common.timed(naive, src, hosts, variables)
+    rows.append(['render every host', args.hosts, '%.0f' % (elapsed * 1000)])
+    renders = len(template.rendered)
+    elapsed, runner = common.timed(TaskRunner, os.path.join(tmp, 'manifest.yaml'), hosts, variables)
+    rows.append(['TaskRunner (render cache)', len(template.rendered) - renders, '%.0f' % (elapsed * 1000)])
+    print('%d hosts, %d sets of variables, %d KB template' % (args.hosts, args.sets, args.size))
+    common.table(['rendering', 'renders', 'time (ms)'], rows)
+  finally:
+    shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+  main()
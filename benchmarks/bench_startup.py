@@ -0,0 +1,75 @@
+""" Measures the cold start of `hep --check-manifest` and `hep -h` and fails if it is over budget.
+
+Each command is run `--runs` times in a new python process, with the plan cache disabled so that the manifest is
+parsed and validated every time. The median wall time is compared with `--budget` milliseconds (the time
+python itself takes to start is reported as a baseline). The modules imported by `--check-manifest` are checked
+too: paramiko must not be one of them.
+
+usage: python benchmarks/bench_startup.py [--runs N] [--budget MS] [--manifest PATH]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+import common
+
+def median(values):
+  values = sorted(values)
+  return values[len(values) // 2]
+
+def run(argv, runs):
+  """ Runs a command `runs` times and returns the median wall time in milliseconds. """
+  env = dict(os.environ, PYTHONPATH=common.ROOT)
+  with open(os.devnull, 'w') as devnull:
+    timings = []
+    for i in range(runs):
+      elapsed, status = common.timed(subprocess.call, argv, stdout=devnull, stderr=devnull, env=env)
+      if (status != 0):
+        raise SystemExit('`%s` exited with status %d' % (' '.join(argv), status))
+      timings.append(elapsed * 1000)
+  return median(timings)
+
+def imported(hep_args):
+  """ Returns the names of the modules imported by a hep command. """
+  probe = ("import runpy, sys\n"
+           "sys.argv = %r\n"
+           "try:\n"
+           "  runpy.run_path(%r, run_name='__main__')\n"
+           "except SystemExit:\n"
+           "  pass\n"
+           "sys.stdout.write('\\nimported: ' + ' '.join(sorted(sys.modules)))\n") % (['hep'] + hep_args, os.path.join(common.ROOT, 'bin/hep'))
+  process = subprocess.Popen([sys.executable, '-c', probe], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             env=dict(os.environ, PYTHONPATH=common.ROOT))
+  stdout, stderr = process.communicate()
+  return stdout.decode('utf-8', 'replace').split('\nimported: ')[-1].split()
+
+def main():
+  parser = argparse.ArgumentParser(description = 'cold start time of hep')
+  parser.add_argument('--runs', type = int, default = 15, help = 'number of runs of each command')
+  parser.add_argument('--budget', type = float, default = 300, help = 'maximum median time of `hep --check-manifest` in ms')
+  parser.add_argument('--manifest', default = os.path.join(common.ROOT, 'examples/manifests/manifest.yml'),
+                      help = 'manifest to check')
+  args = parser.parse_args()
+
+  # a config without plan cache, so that every run compiles the manifest
+  config = os.path.join(common.ROOT, 'tests/config.yml')
+  hep = [sys.executable, os.path.join(common.ROOT, 'bin/hep')]
+  check = ['--check-manifest', '--config', config, args.manifest]
+
+  rows = [
+    ['python -c pass', '%.0f' % (run([sys.executable, '-c', 'pass'], args.runs))],
+    ['hep -h', '%.0f' % (run(hep + ['-h'], args.runs))],
+    ['hep --check-manifest', '%.0f' % (run(hep + check, args.runs))],
+  ]
+  common.table(['command', 'median (ms)'], rows)
+
+  modules = imported(check)
+  if ('paramiko' in modules):
+    raise SystemExit('`hep --check-manifest` imported paramiko')
+  if (float(rows[2][1]) > args.budget):
+    raise SystemExit('`hep --check-manifest` took %s ms, over the budget of %g ms' % (rows[2][1], args.budget))
+  print('within the budget of %g ms, %d modules imported, paramiko not imported' % (args.budget, len(modules)))
+
+if __name__ == '__main__':
+  main()
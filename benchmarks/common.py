@@ -0,0 +1,31 @@
+""" Helpers shared by the benchmarks.
+
+Importing this module makes `hephaestus` and the fake ssh server from `tests/sshd.py` importable and loads the
+test configuration (tests/config.yml), the same way `tests/conftest.py` does for the tests.
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+TESTS = os.path.join(ROOT, 'tests')
+
+sys.path.insert(0, TESTS)
+sys.path.insert(0, ROOT)
+
+# load the test config (tests/config.yml) rather than parsing the benchmark's cli args
+from hephaestus.config import config
+config.load(['--config', os.path.join(TESTS, 'config.yml')])
+
+def timed(function, *args, **kwargs):
+  """ Calls function and returns (elapsed seconds, return value). """
+  start = time.time()
+  value = function(*args, **kwargs)
+  return time.time() - start, value
+
+def table(header, rows):
+  """ Prints rows as a left aligned table. """
+  rows = [header] + [[str(column) for column in row] for row in rows]
+  widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+  for row in rows:
+    print('  '.join(column.ljust(width) for column, width in zip(row, widths)))
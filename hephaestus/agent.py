@@ -0,0 +1,212 @@
+""" Helper agent executed on the remote hosts.
+
+The SSH class starts this script once per connection (see `SSH.agent`) and keeps it running until the connection
+is closed. It reads one json request per line on stdin, i.e. `{"op": "stat", "args": {"paths": ["/etc/hosts"]}}`,
+and answers each one with one json line on stdout: `{"ok": true, "result": ...}` or `{"ok": false, "error": "..."}`.
+
+The script must only depend on the python standard library and run on both python 2 and python 3, since it is
+executed by whatever `python` the remote host has.
+"""
+import grp
+import hashlib
+import json
+import os
+import pwd
+import stat as stat_module
+import struct
+import subprocess
+import sys
+import zlib
+
+def sha256(path):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+def stat(paths, checksum = True):
+  """ Describes files: existence, mode (octal string), owner, group, size and sha256 of the content. """
+  stats = {}
+  for path in paths:
+    if not os.path.isfile(path):
+      stats[path] = {'exists': False}
+      continue
+
+    st = os.stat(path)
+    try:
+      owner = pwd.getpwuid(st.st_uid).pw_name
+    except KeyError:
+      owner = str(st.st_uid)
+    try:
+      group = grp.getgrgid(st.st_gid).gr_name
+    except KeyError:
+      group = str(st.st_gid)
+
+    stats[path] = {'exists': True, 'mode': '%o' % (st.st_mode & 0o7777), 'owner': owner, 'group': group,
+                   'size': st.st_size}
+    if checksum:
+      stats[path]['sha256'] = sha256(path)
+  return stats
+
+def tree(root):
+  """ Describes the files (mode, owner, group, size and sha256) and directories (mode, owner, group) under root,
+  keyed by path relative to root. Anything but regular files and directories is left out. """
+  files, dirs = {}, {}
+  if not os.path.isdir(root):
+    return {'files': files, 'dirs': dirs}
+
+  for path, dirnames, filenames in os.walk(root):
+    for name in dirnames + filenames:
+      full = os.path.join(path, name)
+      st = os.lstat(full)
+      if stat_module.S_ISDIR(st.st_mode):
+        entries = dirs
+      elif stat_module.S_ISREG(st.st_mode):
+        entries = files
+      else:
+        continue
+      entry = {'mode': '%o' % (st.st_mode & 0o7777), 'owner': name_of(pwd.getpwuid, st.st_uid),
+               'group': name_of(grp.getgrgid, st.st_gid)}
+      if entries is files:
+        entry['size'] = st.st_size
+        entry['sha256'] = sha256(full)
+      entries[os.path.relpath(full, root)] = entry
+  return {'files': files, 'dirs': dirs}
+
+def name_of(lookup, id):
+  try:
+    return lookup(id)[0]
+  except KeyError:
+    return str(id)
+
+def set_attrs(root, paths, owner = None, group = None):
+  """ Sets the mode (octal string, None to leave it alone), owner and group of many paths relative to root. """
+  for path, mode in paths.items():
+    if mode is not None:
+      chmod(os.path.join(root, path), mode)
+    chown(os.path.join(root, path), owner, group)
+
+def prune(root, files, dirs):
+  """ Removes files and then the directories (deepest first, only if they are empty) relative to root. """
+  for path in files:
+    remove(os.path.join(root, path))
+  for path in sorted(dirs, key=lambda path: path.count(os.sep), reverse=True):
+    try:
+      os.rmdir(os.path.join(root, path))
+    except OSError:
+      pass
+
+def signature(path, block_size):
+  """ Returns the size of a file and the adler32 and md5 of each of its full blocks (see hephaestus/delta.py). """
+  blocks = []
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(block_size), b''):
+      if len(block) == block_size:
+        blocks.append([zlib.adler32(block) & 0xffffffff, hashlib.md5(block).hexdigest()])
+  return {'size': os.path.getsize(path), 'blocks': blocks}
+
+def patch(base, delta, dest, block_size):
+  """ Writes dest from the blocks of base and the instructions of delta (see hephaestus/delta.py), removes delta
+  and returns the sha256 of dest. """
+  digest = hashlib.sha256()
+  with open(base, 'rb') as source:
+    with open(delta, 'rb') as instructions:
+      with open(dest, 'wb') as out:
+        while True:
+          kind = instructions.read(1)
+          if not kind:
+            break
+          if kind == b'C':
+            first, count = struct.unpack('>QQ', instructions.read(16))
+            source.seek(first * block_size)
+            for i in range(count):
+              data = source.read(block_size)
+              out.write(data)
+              digest.update(data)
+          elif kind == b'L':
+            size = struct.unpack('>I', instructions.read(4))[0]
+            data = instructions.read(size)
+            if len(data) != size:
+              raise ValueError('truncated delta')
+            out.write(data)
+            digest.update(data)
+          else:
+            raise ValueError('invalid delta record %r' % (kind))
+        out.flush()
+        os.fsync(out.fileno())
+  os.remove(delta)
+  return digest.hexdigest()
+
+def hash_files(paths):
+  """ Returns the sha256 of the content of files (None for missing files). """
+  return dict((path, sha256(path) if os.path.isfile(path) else None) for path in paths)
+
+def chmod(path, mode):
+  os.chmod(path, int(str(mode), 8))
+
+def chown(path, owner = None, group = None):
+  uid = pwd.getpwnam(owner).pw_uid if owner else -1
+  gid = grp.getgrnam(group).gr_gid if group else -1
+  os.chown(path, uid, gid)
+
+def remove(path):
+  """ Removes a file, returns False if it did not exist. """
+  if not os.path.lexists(path):
+    return False
+  os.remove(path)
+  return True
+
+def rename(src, dest):
+  os.rename(src, dest)
+
+def run(command):
+  process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+  output = process.communicate()[0]
+  return process.returncode, output.decode('utf-8', 'replace')
+
+def dpkg_status(packages):
+  """ Returns the dpkg status of packages (i.e. `install ok installed`), unknown packages are left out. """
+  status, output = run(['dpkg-query', '-W', '-f=${Package} ${Status}\n'] + list(packages))
+  statuses = {}
+  for line in output.splitlines():
+    if line.startswith('dpkg-query:'):
+      continue
+    fields = line.split(' ', 1)
+    if len(fields) == 2:
+      statuses[fields[0]] = fields[1]
+  return statuses
+
+def service_status(name):
+  """ Runs `service <name> status` and returns its exit status and output. """
+  status, output = run(['service', name, 'status'])
+  return {'status': status, 'output': output}
+
+OPS = {
+  'stat': stat,
+  'hash': hash_files,
+  'tree': tree,
+  'signature': signature,
+  'patch': patch,
+  'set_attrs': set_attrs,
+  'prune': prune,
+  'chmod': chmod,
+  'chown': chown,
+  'remove': remove,
+  'rename': rename,
+  'dpkg_status': dpkg_status,
+  'service_status': service_status,
+}
+
+def serve(requests, responses):
+  for line in iter(requests.readline, ''):
+    try:
+      request = json.loads(line)
+      response = {'ok': True, 'result': OPS[request['op']](**request.get('args', {}))}
+    except Exception as e:
+      response = {'ok': False, 'error': '%s: %s' % (e.__class__.__name__, e)}
+    responses.write(json.dumps(response) + '\n')
+    responses.flush()
+
+if __name__ == '__main__':
+  serve(sys.stdin, sys.stdout)
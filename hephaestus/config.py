@@ -3,31 +3,69 @@ import os
 import yaml
 import argparse
 import logging
+import threading
+
+try:
+  from collections.abc import MutableMapping
+except ImportError: # python 2
+  from collections import MutableMapping
 
 class Config:
-  """ A class used to manage configuration for the hephaestus configuration management tool. """
+  """ A class used to manage configuration for the hephaestus configuration management tool.
+
+  The cli arguments override the options of the config file (or of the `cfg` dict when the config is built from
+  code), then the defaults are applied and the options are validated.
+  """
+
+  def __init__(self, default_config_file = "config.yml", argv = None, cfg = None):
+    """
+    Parameters
+    ----------
+    default_config_file : str
+        config file loaded from the working dir unless `--config` is passed
+    argv : list
+        cli arguments (`sys.argv[1:]` by default)
+    cfg : dict
+        options to use instead of loading a config file
+    """
 
-  def __init__(self, default_config_file = "config.yml"):
     # parse cli arguments
     self.default_config_file = default_config_file
     self.parser = argparse.ArgumentParser(description = 'Execute hep manifests against remote hosts')
     self.parser.add_argument('manifest', nargs='*',  help = 'Manifest file to run')
     self.parser.add_argument('--hosts', '-i', help = 'Hosts file to use')
     self.parser.add_argument('--config', '-c', help = 'Config file to use')
-    self.args = self.parser.parse_args()
-
-    # override config file path if passed through clid
-    if (self.args.config == None):
-      # by default hep will look in the current working dir for a config.yml file
-      #dir = os.path.dirname(os.path.realpath(sys.argv[0]))
-      dir = os.getcwd()
-      config_file_path = os.path.join(dir, self.default_config_file)
+    self.parser.add_argument('--transport', help = 'How to reach the hosts whose transport is not set in the hosts file: ssh (default) or local')
+    self.parser.add_argument('--limit', '-l', help = 'Only run the manifest on the hosts matching this pattern (i.e. `web,!web001`)')
+    self.parser.add_argument('--forks', '-f', type = int, help = 'Number of hosts to run the manifest on in parallel')
+    self.parser.add_argument('--task-concurrency', '-t', type = int, help = 'Number of independent tasks to run at the same time on each host')
+    self.parser.add_argument('--serial', help = 'Number (or percentage, i.e. 25%%) of hosts per rolling batch')
+    self.parser.add_argument('--max-fail-percentage', type = float, help = 'Abort the remaining batches if more than this percentage of the hosts of a batch failed')
+    self.parser.add_argument('--force', action = 'store_true', help = 'Run the manifest on every host, even the ones that did not change since their last successful run')
+    self.parser.add_argument('--prestage', action = 'store_true', help = 'Download the apt packages of the manifest on each host before running its tasks')
+    self.parser.add_argument('--resume', action = 'store_true', help = 'Skip the hosts and tasks that succeeded in the interrupted run of the same manifest')
+    self.parser.add_argument('--daemon', '-d', action = 'store_true', help = 'Run the manifest through the hep daemon (hepd)')
+    self.parser.add_argument('--socket', '-s', help = 'Unix socket of the hep daemon (hepd)')
+    self.parser.add_argument('--stats', help = 'Write the timings and counters of the run to this json file')
+    self.parser.add_argument('--output', '-o', choices = ['human', 'json'], help = 'Display the progress of the run for humans (default) or as json lines')
+    self.parser.add_argument('--check-manifest', action = 'store_true', help = 'Validate the manifest and exit without connecting to any host')
+    self.args = self.parser.parse_args(argv)
+
+    if (cfg != None):
+      self.cfg = dict(cfg)
     else:
-      config_file_path = os.path.realpath(self.args.config)
+      # override config file path if passed through clid
+      if (self.args.config == None):
+        # by default hep will look in the current working dir for a config.yml file
+        #dir = os.path.dirname(os.path.realpath(sys.argv[0]))
+        dir = os.getcwd()
+        config_file_path = os.path.join(dir, self.default_config_file)
+      else:
+        config_file_path = os.path.realpath(self.args.config)
 
-    # load config from yml file
-    with open(config_file_path, 'r') as yml_file:
-      self.cfg = yaml.load(yml_file)
+      # load config from yml file
+      with open(config_file_path, 'r') as yml_file:
+        self.cfg = yaml.safe_load(yml_file)
 
     # override manifest file path if passed through cli
     if (self.args.manifest != []):
@@ -39,15 +77,115 @@ class Config:
       # by default hep will look for the hosts file path in config file
       self.cfg['hosts'] = self.args.hosts
 
-    # make sure ssh credentials, manifest file, hosts file and loglevel are set, otherwise exit
-    has_ssh = 'ssh' in self.cfg
+    # override the host selection if passed through cli (see hephaestus/inventory.py)
+    if (self.args.limit != None):
+      self.cfg['limit'] = self.args.limit
+    self.cfg.setdefault('limit', None)
+
+    # override number of parallel workers if passed through cli
+    if (self.args.forks != None):
+      # by default hep will look for the number of parallel workers in config file
+      self.cfg['forks'] = self.args.forks
+
+    # override the default transport if passed through cli
+    if (self.args.transport != None):
+      self.cfg['transport'] = self.args.transport
+
+    # hosts are reached over ssh unless told otherwise (see hephaestus/transport.py)
+    self.cfg.setdefault('transport', 'ssh')
+
+    # make sure ssh credentials (unless every host is local), manifest file, hosts file and loglevel are set,
+    # otherwise exit
+    has_ssh = 'ssh' in self.cfg or self.cfg['transport'] == 'local'
     has_manifest = 'manifest' in self.cfg
     has_hosts = 'hosts' in self.cfg
     has_log_level = 'log_level' in self.cfg
 
     if (not (has_ssh and has_manifest and has_hosts and has_log_level)):
       raise Exception('hep is misconfigured, check the config file')
-      
+
+    # forks is optional, run the manifest on 5 hosts at a time unless told otherwise
+    self.cfg.setdefault('forks', 5)
+
+    if (self.cfg['forks'] < 1):
+      raise Exception('hep is misconfigured, forks must be at least 1')
+
+    # override number of concurrent tasks per host if passed through cli
+    if (self.args.task_concurrency != None):
+      self.cfg['task_concurrency'] = self.args.task_concurrency
+
+    # tasks run one after the other on each host unless told otherwise
+    self.cfg.setdefault('task_concurrency', 1)
+
+    if (self.cfg['task_concurrency'] < 1):
+      raise Exception('hep is misconfigured, task_concurrency must be at least 1')
+
+    # the hep daemon listens on ~/.hepd.sock unless told otherwise
+    self.cfg['daemon'] = self.cfg.get('daemon') or {}
+    self.cfg['daemon'].setdefault('socket', os.path.expanduser('~/.hepd.sock'))
+    self.cfg['daemon']['enabled'] = self.args.daemon or self.cfg['daemon'].get('enabled', False)
+
+    # override daemon socket path if passed through cli
+    if (self.args.socket != None):
+      self.cfg['daemon']['socket'] = self.args.socket
+
+    # compiled manifests are cached in ~/.cache/hep/plans unless told otherwise (empty to disable the cache)
+    self.cfg.setdefault('plan_cache', os.path.expanduser('~/.cache/hep/plans'))
+
+    # override rolling batches settings if passed through cli
+    if (self.args.serial != None):
+      self.cfg['serial'] = self.args.serial
+    if (self.args.max_fail_percentage != None):
+      self.cfg['max_fail_percentage'] = self.args.max_fail_percentage
+
+    # every host is in a single batch and failures never abort the run unless told otherwise
+    self.cfg.setdefault('serial', None)
+    self.cfg.setdefault('max_fail_percentage', 100)
+
+    serial = str(self.cfg['serial'])
+    if (self.cfg['serial'] != None and not (serial.isdigit() or (serial.endswith('%') and serial[:-1].replace('.', '', 1).isdigit()))):
+      raise Exception('hep is misconfigured, serial must be a number of hosts or a percentage (i.e. 25%)')
+
+    # hosts are skipped if they did not change since their last successful run, unless forced (see converge_cache)
+    self.cfg['force'] = self.args.force or self.cfg.get('force', False)
+
+    # hosts are not prestaged unless told otherwise, at most forks hosts are prestaged at the same time
+    self.cfg['prestage'] = self.args.prestage or self.cfg.get('prestage', False)
+    self.cfg.setdefault('prestage_concurrency', None)
+
+    if (self.cfg['prestage_concurrency'] != None and self.cfg['prestage_concurrency'] < 1):
+      raise Exception('hep is misconfigured, prestage_concurrency must be at least 1')
+
+    # the work done by a run is journaled under ~/.cache/hep/journal, one file per plan, unless told otherwise
+    # (empty to disable it)
+    self.cfg.setdefault('journal', os.path.expanduser('~/.cache/hep/journal'))
+    self.cfg['resume'] = self.args.resume or self.cfg.get('resume', False)
+
+    if (self.cfg['resume'] and not self.cfg['journal']):
+      raise Exception('hep is misconfigured, --resume needs a journal')
+
+    # instrumentation is disabled unless a report file is set
+    self.cfg['stats'] = self.cfg.get('stats') or {}
+
+    # override json report path if passed through cli
+    if (self.args.stats != None):
+      self.cfg['stats']['json'] = self.args.stats
+
+    # the progress of a run is rendered for humans on stdout unless told otherwise, and can also be appended to a
+    # json lines file (see hephaestus/events.py)
+    self.cfg['events'] = self.cfg.get('events') or {}
+    if (self.args.output != None):
+      self.cfg['events']['format'] = self.args.output
+    self.cfg['events'].setdefault('format', 'human')
+    self.cfg['events'].setdefault('file', None)
+    self.cfg['events'].setdefault('queue_size', 10000)
+
+    if (self.cfg['events']['format'] not in ['human', 'json']):
+      raise Exception('hep is misconfigured, events format must be `human` or `json`')
+
+    # only validate the manifest (see `hep --check-manifest`)
+    self.cfg['check_manifest'] = self.args.check_manifest
+
   def get_config(self):
     """ Returns hepahestus configuration.
 
@@ -58,4 +196,86 @@ class Config:
     """
     return self.cfg
 
-config = Config().get_config()
+class LazyConfig(MutableMapping):
+  """
+  The configuration of hep, loaded the first time it is needed.
+
+  Importing hephaestus.config does not parse the cli nor read the config file anymore: the config is loaded by an
+  explicit call to `load` (i.e. by bin/hep, before anything else so that `hep -h` returns right away) or, failing
+  that, from `sys.argv` and the config file of the working dir the first time an option is read. It can also be
+  built from code with `use`. Once loaded it behaves like the dict returned by `Config.get_config`.
+
+  Methods
+  -------
+  load(argv, default_config_file)
+      parses the cli arguments and loads the config file (once)
+  use(cfg, argv)
+      builds the config from a dict instead of a config file
+  loaded()
+      checks weather the config was loaded
+  """
+
+  def __init__(self):
+    self.cfg = None
+    self.lock = threading.Lock()
+
+  def load(self, argv = None, default_config_file = "config.yml"):
+    """ Parses the cli arguments and loads the config file, unless the config was already loaded.
+
+    Parameters
+    ----------
+    argv : list
+        cli arguments (`sys.argv[1:]` by default)
+    default_config_file : str
+        config file loaded from the working dir unless `--config` is passed
+
+    Returns
+    ------
+    dict:
+        configuration parameters and its values
+    """
+
+    with self.lock:
+      if (self.cfg == None):
+        self.cfg = Config(default_config_file, argv).get_config()
+      return self.cfg
+
+  def use(self, cfg, argv = None):
+    """ Builds the config from a dict (defaults are applied and the options are validated, see `Config`).
+
+    Parameters
+    ----------
+    cfg : dict
+        configuration parameters and their values (`ssh`, `manifest`, `hosts` and `log_level` are required)
+    argv : list
+        cli arguments overriding the options (none by default)
+
+    Returns
+    ------
+    dict:
+        configuration parameters and its values
+    """
+
+    with self.lock:
+      self.cfg = Config(argv=argv if argv != None else [], cfg=cfg).get_config()
+      return self.cfg
+
+  def loaded(self):
+    return self.cfg != None
+
+  def __getitem__(self, key):
+    return (self.cfg if self.cfg != None else self.load())[key]
+
+  def __setitem__(self, key, value):
+    (self.cfg if self.cfg != None else self.load())[key] = value
+
+  def __delitem__(self, key):
+    del (self.cfg if self.cfg != None else self.load())[key]
+
+  def __iter__(self):
+    return iter(self.cfg if self.cfg != None else self.load())
+
+  def __len__(self):
+    return len(self.cfg if self.cfg != None else self.load())
+
+config = LazyConfig()
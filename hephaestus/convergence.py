@@ -0,0 +1,189 @@
+from hephaestus.plan import module_name, resolve
+import hashlib
+import json
+import logging
+import os
+import threading
+
+try:
+  from shlex import quote
+except ImportError: # python 2
+  from pipes import quote
+
+class ConvergenceCache:
+  """
+  Remembers the state of the hosts after their last successful run, so that hosts nothing changed on are skipped.
+
+  The state of a host is summed up by a fingerprint: the hash of the plan, of the local inputs of the tasks (i.e.
+  the content of the src files) and of the mtime, size, mode, owner, group and inode of the remote files the tasks
+  manage (i.e. the dest files, the dpkg status file), as listed by the `fingerprint` static method of each module.
+  Probing the remote files takes a single command. If the fingerprint of a host matches the one saved after its
+  last successful run the host is skipped.
+
+  Only what the modules list is covered, changes that leave those files alone (i.e. a service stopped by hand)
+  are not noticed, so the cache is disabled unless `converge_cache` is set in the config file.
+
+  Attributes
+  ----------
+  path : str
+      path of the json file the fingerprints are saved in (`converge_cache` in the config file)
+  hosts : dict
+      fingerprint of each host after its last successful run
+
+  Methods
+  -------
+  local_fingerprint(plan)
+      returns the paths of the remote files to probe and the hash of the plan and its local inputs
+  probe(plan, ssh_client)
+      queues the probe of the remote host
+  fingerprint(plan, ssh_client, probe)
+      returns the fingerprint of the remote host from its probe
+  unchanged(host, fingerprint)
+      checks weather a host is in the same state as after its last successful run
+  converged(host, fingerprint)
+      remembers the state of a host after a successful run
+  forget(host)
+      forgets the state of a host
+  save()
+      writes the fingerprints to `path`
+  """
+
+  def __init__(self, path):
+    self.log = logging.getLogger(__name__)
+    self.path = os.path.expanduser(path)
+    self.lock = threading.Lock()
+    self.hosts = {}
+    self.local = {}
+
+    if (os.path.exists(self.path)):
+      try:
+        with open(self.path) as f:
+          self.hosts = json.load(f)
+      except ValueError as e:
+        self.log.warning('Ignoring the convergence cache `%s`: %s' % (self.path, e))
+
+  def local_fingerprint(self, plan):
+    """ Returns the paths of the remote files to probe and the hash of the plan and its local inputs.
+
+    The result is computed once per plan and run.
+
+    Parameters
+    ----------
+    plan : obj
+        Plan of the manifest
+
+    Returns
+    ------
+    tuple:
+        list of remote paths and a hex digest, or None if a module can't fingerprint its tasks
+    """
+
+    with self.lock:
+      if (plan.hash in self.local):
+        return self.local[plan.hash]
+
+    paths = set()
+    digest = hashlib.sha256(plan.hash.encode('ascii'))
+    try:
+      for task in plan.tasks:
+        cls = resolve(module_name(task))
+        if (not hasattr(cls, 'fingerprint')):
+          raise Exception('the `%s` module does not support fingerprints' % (module_name(task)))
+        remote_paths, local = cls.fingerprint(task)
+        paths.update(remote_paths)
+        digest.update(('\0%s' % (local)).encode('utf-8'))
+      result = (sorted(paths), digest.hexdigest())
+    except Exception as e:
+      self.log.info('Hosts will not be skipped: %s' % (e))
+      result = None
+
+    with self.lock:
+      self.local[plan.hash] = result
+    return result
+
+  def probe(self, plan, ssh_client):
+    """ Queues the single command probing the state of the host (see `Transport.queue`), so that it is sent with
+    the other probes queued on the connection.
+
+    Parameters
+    ----------
+    plan : obj
+        Plan of the manifest
+    ssh_client : obj
+        SSH object connected to the host
+
+    Returns
+    ------
+    obj:
+        PendingCommand of the probe, or None if the plan can't be fingerprinted or has no remote path
+    """
+
+    local = self.local_fingerprint(plan)
+    if (local == None or not local[0]):
+      return None
+
+    # missing files are left out of the output, so a file that appears or disappears changes the fingerprint
+    return ssh_client.queue("stat -L -c '%%n %%Y %%s %%a %%U %%G %%i' -- %s" % (' '.join(quote(path) for path in local[0])))
+
+  def fingerprint(self, plan, ssh_client, probe = None):
+    """ Returns the fingerprint of the host from the output of its probe.
+
+    Parameters
+    ----------
+    plan : obj
+        Plan of the manifest
+    ssh_client : obj
+        SSH object connected to the host
+    probe : obj
+        PendingCommand returned by `probe` (the host is probed now by default)
+
+    Returns
+    ------
+    str:
+        hex digest of the state of the host, or None if the plan can't be fingerprinted
+    """
+
+    local = self.local_fingerprint(plan)
+    if (local == None):
+      return None
+    paths, digest = local
+
+    if (probe == None):
+      probe = self.probe(plan, ssh_client)
+    stdout = probe.result[0] if probe != None else []
+    return hashlib.sha256(('%s\n%s' % (digest, ''.join(stdout))).encode('utf-8')).hexdigest()
+
+  def unchanged(self, host, fingerprint):
+    """ Returns True if the host is in the same state as after its last successful run. """
+
+    with self.lock:
+      return (fingerprint != None and self.hosts.get(host) == fingerprint)
+
+  def converged(self, host, fingerprint):
+    """ Remembers the state of a host after a successful run. """
+
+    with self.lock:
+      if (fingerprint != None):
+        self.hosts[host] = fingerprint
+      else:
+        self.hosts.pop(host, None)
+
+  def forget(self, host):
+    """ Forgets the state of a host (i.e. after a failed run). """
+
+    with self.lock:
+      self.hosts.pop(host, None)
+
+  def save(self):
+    """ Writes the fingerprints to `path` (through a temporary file renamed over it). """
+
+    try:
+      if (not os.path.isdir(os.path.dirname(self.path))):
+        os.makedirs(os.path.dirname(self.path))
+      tmp = '%s.%d.tmp' % (self.path, os.getpid())
+      with self.lock:
+        with open(tmp, 'w') as f:
+          json.dump(self.hosts, f, indent=2, sort_keys=True)
+      os.rename(tmp, self.path)
+    except (IOError, OSError) as e:
+      self.log.error('Failed to save the convergence cache `%s`: %s' % (self.path, e))
@@ -0,0 +1,320 @@
+from hephaestus import inventory
+from hephaestus.config import config
+from hephaestus.events import EventStream, JsonLines
+from hephaestus.plan import module_name, resolve
+from hephaestus.transport import TransportError, for_host
+from hephaestus.stats import NullStats, Stats
+from hephaestus.task_runner import TaskRunner
+
+import json
+import logging
+import os
+import socket
+import threading
+
+try:
+  import socketserver
+except ImportError: # python 2
+  import SocketServer as socketserver
+
+# run options of the client (see hephaestus/config.py) applied to the runs of the daemon
+OPTIONS = ['forks', 'task_concurrency', 'serial', 'max_fail_percentage', 'force', 'prestage', 'prestage_concurrency']
+
+# options of the client the daemon rejects (runs are not journaled) unless they match its own (the connections
+# are opened by the daemon)
+CHECKED = ['resume', 'transport']
+
+class DaemonRunner(TaskRunner):
+  """
+  A TaskRunner used by the hep daemon.
+
+  It borrows the daemon's warm ssh connections instead of opening new ones and streams the events of the run
+  (see hephaestus/events.py) to the client as json lines instead of displaying them. The run options (`OPTIONS`)
+  and the variables of the hosts are the client's, so a run gives the same results with or without the daemon.
+  Runs are not journaled, concurrent requests would share the journal file, so `--resume` is rejected, and so is
+  a transport other than the one of the daemon's connections.
+
+  Attributes
+  ----------
+  daemon : obj
+      the Daemon holding the ssh connections
+  stream : file
+      where the json events are written to (the client's socket)
+  """
+
+  def __init__(self, daemon, stream, manifest, hosts = None, options = None, variables = None):
+    """
+    Parameters
+    ----------
+    daemon : obj
+        the Daemon holding the ssh connections
+    stream : file
+        where the json events are written to
+    manifest : str
+        absolute path to the manifest file
+    hosts : list
+        hostnames the manifest will be applied on (every host of the daemon by default)
+    options : dict
+        run options of the client (see `OPTIONS`), overriding the ones of the daemon
+    variables : dict
+        variables of the hosts keyed by hostname (the ones of the daemon's hosts file by default)
+    """
+
+    options = options or {}
+    if (options.get('resume')):
+      raise Exception('runs through the hep daemon are not journaled, it can not honour --resume')
+    if (options.get('transport', config['transport']) != config['transport']):
+      raise Exception('the hep daemon reaches the hosts through `%s`, it can not honour --transport %s' % (config['transport'], options['transport']))
+
+    TaskRunner.__init__(self, manifest, hosts, daemon.variables if variables == None else variables)
+    self.journal = None
+    self.daemon = daemon
+    self.stream = stream
+    self.events = EventStream([JsonLines(stream, encode=True)], config['events']['queue_size'])
+
+    for option in OPTIONS:
+      if (option in options):
+        setattr(self, option, options[option])
+    if ('forks' in options or 'prestage_concurrency' in options):
+      self.prestage_concurrency = options.get('prestage_concurrency') or self.forks
+    self.check_local_files()
+
+  def check_local_files(self):
+    """ Raises an exception if a task reads a local file through a relative path, which the daemon would resolve
+    against its own working directory rather than the client's. """
+
+    for plan in (set(self.plans.values()) or [self.plan]):
+      for task in plan.tasks:
+        cls = resolve(module_name(task))
+        for path in (cls.local_files(task) if hasattr(cls, 'local_files') else []):
+          if (not os.path.isabs(path)):
+            raise Exception('task `%s` uses the relative path `%s`, the hep daemon requires absolute paths' % (task['name'], path))
+
+  def send(self, event):
+    """ Writes an event (dict) to the client as a json line, once the events of the run were written. """
+    self.stream.write((json.dumps(event) + '\n').encode('utf-8'))
+    self.stream.flush()
+
+  def connect(self, host):
+    ssh_client = self.daemon.acquire(host)
+    ssh_client.stats = self.stats.host(host)
+    return ssh_client
+
+  def disconnect(self, host, ssh_client, failed):
+    ssh_client.stats = NullStats().host(host)
+    self.daemon.release(host, ssh_client, failed)
+
+class RequestHandler(socketserver.StreamRequestHandler):
+  """ Handles one run request: a json line with the `manifest` path, an optional list of `hosts` and their
+  `variables`, whether the client wants the timings and counters of the run (`stats`) and the run `options` of
+  the client. """
+
+  def handle(self):
+    daemon = self.server.hepd
+    try:
+      request = json.loads(self.rfile.readline().decode('utf-8'))
+      runner = DaemonRunner(daemon, self.wfile, request['manifest'], request.get('hosts'), request.get('options'),
+                            request.get('variables'))
+      if (request.get('stats') and not runner.stats.enabled):
+        runner.stats = Stats()
+      results = runner.run()
+      runner.send({'event': 'done', 'results': results, 'stats': runner.stats.report()})
+    except Exception as e:
+      daemon.log.error('Failed to run request: %s' % (e))
+      self.wfile.write((json.dumps({'event': 'error', 'error': str(e)}) + '\n').encode('utf-8'))
+
+class Daemon:
+  """
+  A long running process that keeps authenticated ssh connections to the hosts and runs manifests on request.
+
+  Clients (`hep --daemon`) connect to a unix domain socket, send a run request (manifest path and hosts) and read
+  the results as they are streamed back (see `submit`). The ssh connections are opened when the daemon starts,
+  kept alive with keepalive packets, reused by every run and reopened if they dropped. A host is used by one
+  run at a time.
+
+  Attributes
+  ----------
+  socket_path : str
+      path of the unix domain socket the daemon listens on
+  hosts : list
+      hosts the daemon connects to when it starts (the hosts file from the config)
+  variables : dict
+      variables of the hosts of the hosts file keyed by hostname (see hephaestus/inventory.py)
+  connections : dict
+      SSH objects keyed by hostname
+
+  Methods
+  -------
+  warm_up()
+      connects to every host of the hosts file
+  acquire(host)
+      returns a connected SSH object for the host, reconnecting if needed
+  release(host, ssh_client, failed)
+      returns a SSH object to the daemon once a run is done with it
+  serve_forever()
+      accepts run requests until `shutdown` is called
+  shutdown()
+      stops accepting requests and closes every ssh connection
+  """
+
+  def __init__(self, socket_path, hosts = None):
+    self.log = logging.getLogger(__name__)
+    self.socket_path = socket_path
+    self.keepalive = config.get('daemon', {}).get('keepalive', 30)
+    self.connections = {}
+    self.locks = {}
+    self.lock = threading.Lock()
+
+    variables = {}
+    if (hosts == None):
+      hosts, variables = inventory.select(config['hosts'], '')
+    self.hosts = hosts
+    self.variables = variables
+
+    # remove the socket left behind by a previous daemon
+    if (os.path.exists(socket_path)):
+      os.remove(socket_path)
+    # only the user running the daemon can connect to it, the socket runs manifests with its ssh credentials
+    umask = os.umask(0o177)
+    try:
+      self.server = socketserver.ThreadingUnixStreamServer(socket_path, RequestHandler)
+    finally:
+      os.umask(umask)
+    self.server.daemon_threads = True
+    self.server.hepd = self
+
+  def warm_up(self):
+    """ Connects to every host of the hosts file, `forks` hosts at a time. """
+
+    hosts = list(self.hosts)
+
+    def worker():
+      while True:
+        with self.lock:
+          if (not hosts):
+            return
+          host = hosts.pop()
+        try:
+          self.release(host, self.acquire(host), False)
+        except TransportError:
+          self.log.error('Failed to connect to `%s`, will retry on the next run' % (host))
+
+    workers = [threading.Thread(target=worker) for i in range(min(config['forks'], len(hosts)))]
+    for thread in workers:
+      thread.start()
+    for thread in workers:
+      thread.join()
+
+  def acquire(self, host):
+    """ Returns a connected SSH object for the host, reconnecting if the connection dropped.
+
+    The host is locked until the SSH object is released so that concurrent runs don't share a connection.
+
+    Parameters
+    ----------
+    host : str
+        hostname to connect to
+
+    Returns
+    ------
+    obj:
+        connected SSH object
+    """
+
+    with self.lock:
+      lock = self.locks.setdefault(host, threading.Lock())
+    lock.acquire()
+
+    try:
+      ssh_client = self.connections.get(host)
+      if (ssh_client == None or not ssh_client.is_active()):
+        if (ssh_client != None):
+          self.log.info('Connection to `%s` dropped, reconnecting' % (host))
+          ssh_client.close()
+        ssh_client = for_host(host)
+        ssh_client.keepalive = self.keepalive
+        ssh_client.connect()
+        self.connections[host] = ssh_client
+    except BaseException:
+      lock.release()
+      raise
+
+    # state shared by the tasks of a run (i.e. apt lists were updated, probes that were not read) must not leak
+    # into the next run
+    ssh_client.cache = {}
+    ssh_client.queued = []
+    return ssh_client
+
+  def release(self, host, ssh_client, failed):
+    """ Returns a SSH object to the daemon once a run is done with it.
+
+    The connection of a host the manifest failed on is closed, it will be reopened by the next run.
+
+    Parameters
+    ----------
+    host : str
+        hostname of the connection
+    ssh_client : obj
+        SSH object returned by `acquire`
+    failed : bool
+        True if the manifest failed on the host
+    """
+
+    if (failed):
+      ssh_client.close()
+      del self.connections[host]
+    self.locks[host].release()
+
+  def serve_forever(self):
+    """ Accepts run requests until `shutdown` is called. """
+    self.server.serve_forever()
+
+  def shutdown(self):
+    """ Stops accepting requests and closes every ssh connection. """
+
+    self.server.shutdown()
+    self.server.server_close()
+    if (os.path.exists(self.socket_path)):
+      os.remove(self.socket_path)
+    for ssh_client in self.connections.values():
+      ssh_client.close()
+
+def submit(socket_path, manifest, hosts = None, stats = False, options = None, variables = None):
+  """ Sends a run request to the hep daemon and yields the events it streams back.
+
+  Parameters
+  ----------
+  socket_path : str
+      path of the unix domain socket the daemon listens on
+  manifest : str
+      path to the manifest file
+  hosts : list
+      hostnames the manifest will be applied on (every host of the daemon by default)
+  stats : bool
+      True to get the timings and counters of the run (see hephaestus/stats.py) with the `done` event
+  options : dict
+      run options (see `OPTIONS`, the ones of the daemon by default)
+  variables : dict
+      variables of the hosts keyed by hostname (the ones of the daemon's hosts file by default)
+
+  Returns
+  ------
+  generator:
+      events (dict): the events of the run (see hephaestus/events.py), then `done` with the results of every
+      host (and the stats) at the end of the run (or `error` if the request failed)
+  """
+
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  client.connect(socket_path)
+  try:
+    request = {'manifest': os.path.realpath(manifest), 'stats': stats, 'options': options or {}}
+    if (hosts != None):
+      request['hosts'] = hosts
+    if (variables != None):
+      request['variables'] = variables
+    client.sendall((json.dumps(request) + '\n').encode('utf-8'))
+
+    for line in client.makefile('rb'):
+      yield json.loads(line.decode('utf-8'))
+  finally:
+    client.close()
@@ -0,0 +1,143 @@
+""" rsync-style delta encoding of a local file against the blocks of a remote file.
+
+The remote host describes its copy of the file as a list of blocks (see `signature` in hephaestus/agent.py): the
+adler32 (weak checksum) and md5 (strong checksum) of each `block_size` bytes. The local file is scanned with a
+rolling adler32 so that the blocks are found at any offset, not only at multiples of `block_size`, and `delta`
+writes the instructions to rebuild the local file from the remote one: blocks to copy from the remote file and
+literal data for everything else. The remote host applies them with `patch` (see hephaestus/agent.py).
+
+Format of the delta: a sequence of records, `C` followed by the index of the first block and the number of
+consecutive blocks to copy (two big endian unsigned 64 bit integers), or `L` followed by the size of the literal
+data (a big endian unsigned 32 bit integer) and the literal data.
+"""
+import hashlib
+import math
+import mmap
+import os
+import struct
+import zlib
+
+# modulus of adler32
+MOD_ADLER = 65521
+
+# literal data is written in records of at most this many bytes
+MAX_LITERAL = 1024 * 1024
+
+def block_size(size):
+  """ Returns the block size used for a file of `size` bytes: about the square root of the size (like rsync),
+  between 2KB and 128KB, so that the signature stays small and a change costs a few blocks at most.
+
+  Parameters
+  ----------
+  size : int
+      size of the remote file
+
+  Returns
+  ------
+  int:
+      size of the blocks in bytes
+  """
+
+  return int(min(128 * 1024, max(2048, math.sqrt(size) // 1024 * 1024)))
+
+def roll(checksum, out, into, size):
+  """ Slides the adler32 of a window of `size` bytes by one byte: `out` leaves the window and `into` enters it. """
+
+  a = checksum & 0xffff
+  b = (checksum >> 16) & 0xffff
+  a = (a - out + into) % MOD_ADLER
+  b = (b - size * out + a - 1) % MOD_ADLER
+  return (b << 16) | a
+
+def delta(path, signature, size, out):
+  """ Writes the instructions to rebuild a local file from the blocks of a remote file.
+
+  The local file is memory mapped and scanned with a rolling adler32. When the weak checksum of the window
+  matches a block of the remote file (and so does its md5) a copy instruction is emitted and the window jumps by
+  a block, otherwise the window slides by a byte and the byte becomes literal data. Consecutive blocks are
+  copied with a single instruction. Unchanged regions that are aligned with the blocks (i.e. data appended to
+  the file) are matched at C speed, only the changed regions are scanned byte by byte.
+
+  Parameters
+  ----------
+  path : str
+      path to the local file
+  signature : list
+      [adler32, md5] of each block of the remote file (see `signature` in hephaestus/agent.py)
+  size : int
+      size of the blocks in bytes
+  out : file
+      binary file the delta is written to
+
+  Returns
+  ------
+  int:
+      number of literal bytes written
+  """
+
+  blocks = {}
+  for index, (weak, strong) in enumerate(signature):
+    blocks.setdefault(weak, {}).setdefault(strong, index)
+
+  state = {'literal': 0, 'copy': None}
+
+  def copy(index):
+    if (state['copy'] != None and state['copy'][0] + state['copy'][1] == index):
+      state['copy'][1] += 1
+      return
+    flush_copy()
+    state['copy'] = [index, 1]
+
+  def flush_copy():
+    if (state['copy'] != None):
+      out.write(b'C' + struct.pack('>QQ', state['copy'][0], state['copy'][1]))
+      state['copy'] = None
+
+  def literal(data):
+    if (not data):
+      return
+    flush_copy()
+    for offset in range(0, len(data), MAX_LITERAL):
+      chunk = data[offset:offset + MAX_LITERAL]
+      out.write(b'L' + struct.pack('>I', len(chunk)))
+      out.write(chunk)
+    state['literal'] += len(data)
+
+  with open(path, 'rb') as f:
+    length = os.fstat(f.fileno()).st_size
+    if (length == 0):
+      return 0
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      pos = 0
+      start = 0 # first byte that is neither copied nor written as literal data yet
+      weak = None
+      while (pos + size <= length):
+        if (weak == None):
+          weak = zlib.adler32(data[pos:pos + size]) & 0xffffffff
+
+        candidates = blocks.get(weak)
+        if (candidates):
+          index = candidates.get(hashlib.md5(data[pos:pos + size]).hexdigest())
+          if (index != None):
+            literal(data[start:pos])
+            copy(index)
+            pos += size
+            start = pos
+            weak = None
+            continue
+
+        if (pos + size < length):
+          weak = roll(weak, ord(data[pos:pos + 1]), ord(data[pos + size:pos + size + 1]), size)
+        pos += 1
+        # keep the pending literal data bounded
+        if (pos - start >= MAX_LITERAL):
+          literal(data[start:pos])
+          start = pos
+
+      literal(data[start:length])
+      flush_copy()
+    finally:
+      data.close()
+
+  return state['literal']
@@ -0,0 +1,226 @@
+""" The progress of a run as a stream of typed events, written by a background thread.
+
+Events are dicts with an `event` type and the `time` they happened at:
+
+- `run_start`: `manifest`, `hosts` (number of hosts), `plan` (hash of the plan) and `forks`
+- `host_connect`: `host` and `seconds` it took to connect
+- `host_skip`: `host` and `reason` (`unchanged` since its last successful run or `resumed`, done in the
+  interrupted run)
+- `task_start`: `host`, `module` and `task` (name of the task)
+- `task_result`: `host`, `module`, `task`, `status` (`changed`, `ok` or `failed`), `seconds` and `error` (failed
+  tasks only)
+- `host_done`: `host`, `ok`, `changed`, `failed`, `error` and `seconds`
+- `run_summary`: `results` (`host`, `ok`, `changed`, `failed` and `error` of each host in the order of the hosts
+  file), `seconds` and `dropped` (number of events that were dropped because the queue was full)
+
+The workers running the hosts only put events on a bounded queue, without ever waiting: a background thread
+drains it to the sinks (the terminal, a json lines file, the client of the hep daemon), so a slow terminal never
+stalls a host. If the queue is full, the event is dropped and counted in the `run_summary` event.
+"""
+from hephaestus.config import config
+import json
+import logging
+import sys
+import threading
+import time
+
+try:
+  import queue
+except ImportError: # python 2
+  import Queue as queue
+
+log = logging.getLogger(__name__)
+
+def event(type, **fields):
+  """ Returns an event of a type (i.e. `task_result`) with its fields, timestamped. """
+
+  return dict(fields, event=type, time=round(time.time(), 3))
+
+class JsonLines:
+  """ A sink writing each event as a json line to a stream (i.e. a file or the socket of a hep daemon client). """
+
+  def __init__(self, stream, encode = False, owned = False):
+    """
+    Parameters
+    ----------
+    stream : file
+        where the events are written to
+    encode : bool
+        True if the stream expects bytes rather than text (i.e. a socket)
+    owned : bool
+        True to close the stream with the sink (i.e. a file opened for the sink)
+    """
+
+    self.stream = stream
+    self.encode = encode
+    self.owned = owned
+
+  def write(self, event):
+    line = json.dumps(event) + '\n'
+    self.stream.write(line.encode('utf-8') if self.encode else line)
+
+  def flush(self):
+    self.stream.flush()
+
+  def close(self):
+    if (self.owned):
+      self.stream.close()
+    else:
+      self.flush()
+
+class Human:
+  """ A sink rendering the events for humans: one line per task result and skipped or failed host, and the result
+  of every host at the end of the run. """
+
+  def __init__(self, stream):
+    self.stream = stream
+
+  def write(self, event):
+    line = self.render(event)
+    if (line != None):
+      self.stream.write(line + '\n')
+
+  def render(self, event):
+    """ Returns the lines of an event (None for the events that are not displayed). """
+
+    if (event['event'] == 'run_start'):
+      return "RUN %s on %d hosts" % (event['manifest'], event['hosts'])
+    if (event['event'] == 'host_skip'):
+      reason = {'unchanged': 'UNCHANGED since the last successful run', 'resumed': 'DONE in the interrupted run'}
+      return "HOST [ %s ]: %s, skipping" % (event['host'], reason.get(event['reason'], event['reason']))
+    if (event['event'] == 'task_result'):
+      status = {'changed': 'SUCCESS', 'ok': 'NO CHANGE', 'failed': 'FAILED'}[event['status']]
+      line = "TASK(%s module - [ %s ]): %s: %s" % (event['module'], event['host'], event['task'], status)
+      return line + (" (%s)" % (event['error']) if event.get('error') else '')
+    if (event['event'] == 'host_done' and event['failed']):
+      return "HOST [ %s ]: FAILED (%s)" % (event['host'], event['error'])
+    if (event['event'] == 'run_summary'):
+      lines = ["HOSTS:"]
+      for result in event['results']:
+        line = "%s : ok=%d changed=%d failed=%s" % (result['host'], result['ok'], result['changed'], result['failed'])
+        if (result['failed']):
+          line += " (%s)" % (result['error'])
+        lines.append(line)
+      if (event.get('dropped')):
+        lines.append("(%d events were dropped, the output could not keep up)" % (event['dropped']))
+      return '\n'.join(lines)
+    return None
+
+  def flush(self):
+    self.stream.flush()
+
+  def close(self):
+    self.flush()
+
+def sinks():
+  """ Returns the sinks configured in the `events` section of the config file: the terminal (`format`, `human` or
+  `json`, `--output` cli argument) and a json lines file (`file`, if set).
+
+  Returns
+  ------
+  list:
+      sink objects
+  """
+
+  found = [Human(sys.stdout) if config['events']['format'] == 'human' else JsonLines(sys.stdout)]
+  if (config['events'].get('file')):
+    found.append(JsonLines(open(config['events']['file'], 'a'), owned=True))
+  return found
+
+class EventStream:
+  """
+  Events put on a bounded queue by any thread and written to the sinks by a background writer thread.
+
+  Attributes
+  ----------
+  sinks : list
+      objects the events are written to (`write(event)`, `flush()` and `close()`)
+  queue : obj
+      the bounded queue of the events waiting to be written (`events.queue_size` in the config file)
+  dropped : int
+      number of events dropped because the queue was full
+
+  Methods
+  -------
+  start()
+      starts the writer thread
+  emit(type, **fields)
+      queues an event without waiting
+  send(type, **fields)
+      queues an event, waiting for room in the queue
+  close()
+      writes the queued events, stops the writer thread and closes the sinks
+  """
+
+  def __init__(self, sinks, queue_size = 10000):
+    """
+    Parameters
+    ----------
+    sinks : list
+        objects the events are written to
+    queue_size : int
+        maximum number of events waiting to be written
+    """
+
+    self.sinks = sinks
+    self.queue = queue.Queue(queue_size)
+    self.dropped = 0
+    self.lock = threading.Lock()
+    self.thread = None
+
+  def start(self):
+    """ Starts the writer thread (once). """
+
+    if (self.thread == None):
+      self.thread = threading.Thread(target=self.drain)
+      self.thread.daemon = True
+      self.thread.start()
+
+  def emit(self, type, **fields):
+    """ Queues an event (see `event`), dropping it rather than waiting if the queue is full. """
+
+    try:
+      self.queue.put_nowait(event(type, **fields))
+    except queue.Full:
+      with self.lock:
+        self.dropped += 1
+
+  def send(self, type, **fields):
+    """ Queues an event (see `event`), waiting for room in the queue, so that it is never dropped (i.e. the
+    `run_summary` event, once the workers are done). """
+
+    self.queue.put(event(type, **fields))
+
+  def drain(self):
+    """ Writes the queued events to the sinks until `close` queues None, flushing them whenever the queue is empty. """
+
+    while True:
+      item = self.queue.get()
+      if (item == None):
+        return
+      for sink in self.sinks:
+        try:
+          sink.write(item)
+          if (self.queue.empty()):
+            sink.flush()
+        except Exception as e:
+          log.error('Failed to write the `%s` event: %s' % (item['event'], e))
+
+  def close(self):
+    """ Writes the events queued so far, stops the writer thread and closes the sinks. """
+
+    if (self.thread != None):
+      self.queue.put(None)
+      self.thread.join()
+      self.thread = None
+    else:
+      # never started, write the queued events from the calling thread
+      self.queue.put(None)
+      self.drain()
+    for sink in self.sinks:
+      try:
+        sink.close()
+      except Exception as e:
+        log.error('Failed to close the events sink: %s' % (e))
+    if (self.dropped):
+      log.warning('%d events were dropped, the events sinks could not keep up' % (self.dropped))
@@ -0,0 +1,360 @@
+""" The hosts file: hosts, groups of hosts, host ranges and their variables, read as a stream.
+
+```
+# hosts before the first group are only in the `all` group
+10.0.0.1
+local://build
+
+[web]
+web[001:200].example.com   # 200 hosts, web001.example.com to web200.example.com
+web-canary.example.com:2222 workers=2
+
+[web:vars]                 # variables of the hosts of a group
+listen = 0.0.0.0
+workers = 8
+
+[db]
+db[a:c].example.com
+
+[prod:children]            # groups of groups
+web
+db
+```
+
+Blank lines and comments are skipped. A range (`[start:end]`, numbers or single letters) expands to every value
+between start and end, numbers keeping the width of start when it is zero padded, and a host can have several
+ranges. Ranges are only expanded when the hosts are read, one host at a time.
+
+Variables (rendered into the tasks, see hephaestus/template.py) are strings set in `[group:vars]` sections or as
+`name=value` words after a host. The variables of a host are those of `all`, then of the groups its group is a
+child of (the closest groups last), then of its group and finally its own, each one overriding the ones before.
+"""
+from hephaestus.config import config
+import fnmatch
+import logging
+import os
+import re
+import shlex
+
+# `[start:end]` in a host pattern
+RANGE = re.compile(r'\[([0-9]+|[a-zA-Z]):([0-9]+|[a-zA-Z])\]')
+
+log = logging.getLogger(__name__)
+
+def expand(pattern):
+  """ Yields the hosts of a host pattern, expanding its ranges (i.e. `web[01:03]` yields `web01`, `web02` and
+  `web03`).
+
+  Parameters
+  ----------
+  pattern : str
+      host, possibly with ranges
+
+  Returns
+  ------
+  generator:
+      hostnames
+  """
+
+  match = RANGE.search(pattern)
+  if (match == None):
+    yield pattern
+    return
+
+  start, end = match.group(1), match.group(2)
+  if (start.isdigit() != end.isdigit()):
+    raise Exception('invalid range `%s` in host `%s`' % (match.group(0), pattern))
+  if (start.isdigit()):
+    width = len(start) if start.startswith('0') else 0
+    values = ('%0*d' % (width, value) for value in range(int(start), int(end) + 1))
+  else:
+    values = (chr(value) for value in range(ord(start), ord(end) + 1))
+
+  prefix, suffix = pattern[:match.start()], pattern[match.end():]
+  for value in values:
+    for host in expand(suffix):
+      yield prefix + value + host
+
+def entries(path):
+  """ Yields the (section, value) of each meaningful line of a hosts file, without reading the whole file.
+
+  Sections are `[group]`, `[group:children]` or `[group:vars]` headers (None before the first one), values are
+  the lines without their comment, comments and blank lines are skipped.
+  """
+
+  section = None
+  with open(path) as f:
+    for line in f:
+      line = line.split('#', 1)[0].strip()
+      if (not line):
+        continue
+      if (line.startswith('[') and line.endswith(']') and RANGE.match(line) == None):
+        section = line[1:-1].strip()
+        continue
+      yield section, line
+
+def assignment(text, path):
+  """ Returns the name and the value of a `name=value` variable (quotes around the value are removed). """
+
+  name, equal, value = text.partition('=')
+  if (not equal or not name.strip()):
+    raise Exception('invalid variable `%s` in `%s`, variables are set as `name=value`' % (text, path))
+  value = value.strip()
+  if (len(value) > 1 and value[0] == value[-1] and value[0] in '"\''):
+    value = value[1:-1]
+  return name.strip(), value
+
+class Inventory:
+  """
+  The hosts of a hosts file and their groups.
+
+  The file is read twice, line by line, and never held in memory: once when the Inventory is created to learn the
+  names of the groups, the groups of groups (`[group:children]` sections) and the variables of the groups
+  (`[group:vars]` sections), and once by `select` which yields the selected hosts one at a time, expanding the
+  ranges as it goes. Memory only grows with the number of groups and of selected hosts, not with the size of the
+  file: the hosts of a group without variables of their own share the variables of the group.
+
+  Attributes
+  ----------
+  path : str
+      path of the hosts file
+  groups : set
+      names of the groups (`all` included)
+  parents : dict
+      names of the groups each group is a child of
+  group_vars : dict
+      variables set in the `[group:vars]` section of each group
+
+  Methods
+  -------
+  hosts(limit)
+      yields the hosts matching a limit pattern, in the order of the hosts file
+  select(limit)
+      yields the hosts matching a limit pattern and their variables
+  ancestors(group)
+      returns a group and the groups it belongs to, directly or not
+  variables(group)
+      returns the variables of the hosts of a group
+  """
+
+  def __init__(self, path):
+    """
+    Parameters
+    ----------
+    path : str
+        path of the hosts file
+    """
+
+    self.path = os.path.realpath(path)
+    self.groups = set(['all'])
+    self.parents = {}
+    self.group_vars = {}
+
+    for section, line in entries(self.path):
+      group, kind = self.section(section)
+      if (group != None):
+        self.groups.add(group)
+      if (kind == 'children'):
+        self.groups.add(line.split()[0])
+        self.parents.setdefault(line.split()[0], set()).add(group)
+      elif (kind == 'vars'):
+        name, value = assignment(line, self.path)
+        self.group_vars.setdefault(group, {})[name] = value
+
+  def section(self, section):
+    """ Returns the group of a section header and what it lists: `hosts`, `children` (groups) or `vars`. """
+
+    if (section == None):
+      return None, 'hosts'
+    for kind in ['children', 'vars']:
+      if (section.endswith(':' + kind)):
+        return section[:-len(kind) - 1], kind
+    return section, 'hosts'
+
+  def ancestors(self, group):
+    """ Returns the names of a group, of the groups it is a child of, of their parents and so on (and `all`).
+
+    Parameters
+    ----------
+    group : str
+        name of the group (None for the hosts before the first group)
+
+    Returns
+    ------
+    frozenset:
+        names of the groups
+    """
+
+    found = set(['all'])
+    pending = [group] if group != None else []
+    while (pending):
+      name = pending.pop()
+      if (name not in found):
+        found.add(name)
+        pending.extend(self.parents.get(name, []))
+    return frozenset(found)
+
+  def variables(self, group):
+    """ Returns the variables of the hosts of a group: those of `all`, of the groups it is a child of (the closer
+    the group, the later it overrides the others) and of the group itself.
+
+    Parameters
+    ----------
+    group : str
+        name of the group (None for the hosts before the first group)
+
+    Returns
+    ------
+    dict:
+        values of the variables keyed by name
+    """
+
+    # distance of each ancestor to the group
+    depth = {}
+    pending = [(group, 0)] if group != None else []
+    while (pending):
+      name, distance = pending.pop(0)
+      if (name not in depth):
+        depth[name] = distance
+        pending.extend((parent, distance + 1) for parent in self.parents.get(name, []))
+
+    variables = dict(self.group_vars.get('all', {}))
+    for name in sorted(depth, key=lambda name: (-depth[name], name)):
+      variables.update(self.group_vars.get(name, {}))
+    return variables
+
+  def hosts(self, limit = None):
+    """ Yields the hosts matching a limit pattern, in the order of the hosts file.
+
+    A limit is a comma separated list of patterns: a group name, a host (`web001.example.com`), a shell style
+    wildcard (`web0*`) or a regular expression prefixed by `~` (`~web0[0-4][0-9]`). Patterns prefixed by `!`
+    exclude the hosts they match. A host is selected if it matches one of the other patterns (or there is none)
+    and none of the excluded ones. Sections whose groups can't match are skipped without expanding their ranges.
+    Each host is yielded once, even if it is listed in several groups. Group patterns match the groups of the
+    section a host is listed in (and their parents), so a host listed in two groups is excluded by `!group` only
+    where it is listed under that group.
+
+    Parameters
+    ----------
+    limit : str
+        limit pattern (every host by default)
+
+    Returns
+    ------
+    generator:
+        hostnames
+    """
+
+    for host, variables in self.select(limit):
+      yield host
+
+  def select(self, limit = None):
+    """ Yields the hosts matching a limit pattern (see `hosts`) and their variables (see `variables`, followed by
+    the `name=value` words after the host). A host listed several times gets the variables of its first listing.
+
+    Parameters
+    ----------
+    limit : str
+        limit pattern (every host by default)
+
+    Returns
+    ------
+    generator:
+        (hostname, dict of variables) tuples
+    """
+
+    patterns = [pattern.strip() for pattern in (limit or '').split(',') if pattern.strip()]
+    include = [Pattern(pattern, self.groups) for pattern in patterns if not pattern.startswith('!')]
+    exclude = [Pattern(pattern[1:], self.groups) for pattern in patterns if pattern.startswith('!')]
+    # a section is skipped when only groups are included and none of them is one of its groups
+    groups_only = bool(include) and all(pattern.group != None for pattern in include)
+
+    seen = set()
+    ancestors = {}
+    group_variables = {}
+    for section, line in entries(self.path):
+      group, kind = self.section(section)
+      if (kind != 'hosts'):
+        continue
+      if (group not in ancestors):
+        ancestors[group] = self.ancestors(group)
+        group_variables[group] = self.variables(group)
+      groups = ancestors[group]
+      if (groups_only and not any(pattern.group in groups for pattern in include)):
+        continue
+
+      words = line.split(None, 1)
+      variables = group_variables[group]
+      if (len(words) > 1):
+        variables = dict(variables)
+        variables.update(assignment(word, self.path) for word in shlex.split(words[1]))
+
+      for host in expand(words[0]):
+        if (host in seen):
+          continue
+        if (include and not any(pattern.matches(host, groups) for pattern in include)):
+          continue
+        if (any(pattern.matches(host, groups) for pattern in exclude)):
+          continue
+        seen.add(host)
+        yield host, variables
+
+class Pattern:
+  """ A pattern of a limit: a group name, a host, a shell style wildcard or a `~` regular expression. """
+
+  def __init__(self, pattern, groups):
+    self.group = pattern if pattern in groups else None
+    if (pattern.startswith('~')):
+      # regular expressions match anywhere in the hostname, wildcards the whole hostname
+      self.search = re.compile(pattern[1:]).search
+    else:
+      self.search = re.compile(fnmatch.translate(pattern)).match
+
+  def matches(self, host, groups):
+    if (self.group != None):
+      return self.group in groups
+    return self.search(host) != None
+
+def select(path = None, limit = None):
+  """ Returns the hosts of the hosts file selected by the limit pattern and their variables (see
+  `Inventory.select`).
+
+  Parameters
+  ----------
+  path : str
+      path of the hosts file (`hosts` from the config by default)
+  limit : str
+      limit pattern (`limit` from the config, `--limit` cli argument, by default)
+
+  Returns
+  ------
+  tuple:
+      list of the hostnames in the order of the hosts file and dict of their variables keyed by hostname
+  """
+
+  limit = limit if limit != None else config.get('limit')
+  hosts, variables = [], {}
+  for host, host_variables in Inventory(path or config['hosts']).select(limit):
+    hosts.append(host)
+    variables[host] = host_variables
+  if (not hosts):
+    log.warning('No host of `%s` matches the limit `%s`' % (path or config['hosts'], limit or ''))
+  return hosts, variables
+
+def load(path = None, limit = None):
+  """ Returns the hosts of the hosts file selected by the limit pattern (see `Inventory.hosts`).
+
+  Parameters
+  ----------
+  path : str
+      path of the hosts file (`hosts` from the config by default)
+  limit : str
+      limit pattern (`limit` from the config, `--limit` cli argument, by default)
+
+  Returns
+  ------
+  list:
+      hostnames in the order of the hosts file
+  """
+
+  return select(path, limit)[0]
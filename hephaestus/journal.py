@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+import threading
+import time
+
+class Journal:
+  """
+  An append-only log of the work done by a run, so that an interrupted run can be resumed.
+
+  Each plan has its own journal file, named after its hash, in the journal directory, so that runs of different
+  manifests never share a file. Every run appends a line marking its start, every task that succeeds on a host
+  is appended as a json line (host, task name, change status and hash of the plan, task names are unique in a
+  plan, see `Plan.validate`), and so is every host the manifest succeeded on (with its result). Lines are only
+  ever appended, never rewritten. Lines are handed to the OS as soon as
+  they are written, but only synced to disk every `sync_every` lines or `sync_interval` seconds (and when the
+  journal is closed), so that journaling costs a write per task rather than a disk flush per task. A crash can
+  lose the last unsynced lines, which only means that those tasks are run again.
+
+  When resuming (`--resume` cli argument) the entries written since the start of the last run that was not
+  resumed are loaded: hosts the manifest succeeded on are skipped without connecting to them and the tasks that
+  succeeded on the other hosts are not run again. Entries of other plans are ignored. Without `--resume` the run
+  starts over: its start line makes the next `--resume` ignore the entries before it.
+
+  Attributes
+  ----------
+  path : str
+      path of the journal file: `<plan hash>.jsonl` in the journal directory (`journal` in the config file)
+  plan_hash : str
+      hash of the plan of the run (see `Plan.hash`)
+  hosts : dict
+      result of each host the manifest succeeded on, loaded from the journal when resuming
+  tasks : dict
+      change status of each task that succeeded, keyed by (host, task name), loaded from the journal when resuming
+  sync_every : int
+      number of lines written between two syncs to disk
+  sync_interval : float
+      maximum number of seconds between two syncs to disk
+
+  Methods
+  -------
+  open()
+      opens the journal file for appending
+  finished(host)
+      returns the result of a host the manifest already succeeded on
+  completed(host, task)
+      checks weather a task already succeeded on a host
+  task(host, task, changed)
+      records a task that succeeded on a host
+  host(host, result)
+      records a host the manifest succeeded on
+  close()
+      syncs and closes the journal file
+  """
+
+  sync_every = 64
+  sync_interval = 1.0
+
+  def __init__(self, directory, plan_hash, resume = False):
+    """
+    Parameters
+    ----------
+    directory : str
+        directory of the journal files
+    plan_hash : str
+        hash of the plan of the run
+    resume : bool
+        True to load the entries of a previous run of the same plan
+    """
+
+    self.log = logging.getLogger(__name__)
+    self.path = os.path.join(os.path.expanduser(directory), '%s.jsonl' % (plan_hash))
+    self.plan_hash = plan_hash
+    self.resume = resume
+    self.hosts = {}
+    self.tasks = {}
+    self.file = None
+    self.lock = threading.Lock()
+    self.pending = 0
+    self.synced = time.time()
+
+    if (resume and os.path.exists(self.path)):
+      self.load()
+
+  def load(self):
+    """ Loads the entries of the same plan written since the start of the last run that was not resumed (lines
+    that can't be parsed, i.e. torn by a crash, are ignored). """
+
+    with open(self.path) as f:
+      for line in f:
+        try:
+          entry = json.loads(line)
+        except ValueError:
+          continue
+        if (entry.get('plan') != self.plan_hash):
+          continue
+        if ('started' in entry):
+          # a run that started over, the work done before it does not count
+          self.hosts = {}
+          self.tasks = {}
+        elif ('task' in entry):
+          self.tasks[(entry['host'], entry['task'])] = entry['changed']
+        else:
+          self.hosts[entry['host']] = entry['result']
+    self.log.info('Resuming from `%s`: %d hosts and %d tasks already done' % (self.path, len(self.hosts), len(self.tasks)))
+
+  def open(self):
+    """ Opens the journal file for appending, marking the start of the run unless it is resumed. """
+
+    if (not os.path.isdir(os.path.dirname(self.path))):
+      os.makedirs(os.path.dirname(self.path))
+    self.file = open(self.path, 'a')
+    self.synced = time.time()
+    if (not self.resume):
+      self.write({'plan': self.plan_hash, 'started': round(time.time(), 3)})
+
+  def finished(self, host):
+    """ Returns the result of a host the manifest already succeeded on, None otherwise. """
+
+    return self.hosts.get(host)
+
+  def completed(self, host, task):
+    """ Returns True if the task already succeeded on the host. """
+
+    return (host, task['name']) in self.tasks
+
+  def task(self, host, task, changed):
+    """ Records a task that succeeded on a host. """
+
+    self.write({'plan': self.plan_hash, 'host': host, 'task': task['name'], 'changed': bool(changed)})
+
+  def host(self, host, result):
+    """ Records a host the manifest succeeded on. """
+
+    self.write({'plan': self.plan_hash, 'host': host, 'result': result})
+
+  def write(self, entry):
+    with self.lock:
+      if (self.file == None):
+        return
+      self.file.write(json.dumps(entry, sort_keys=True) + '\n')
+      self.file.flush()
+      self.pending += 1
+      if (self.pending >= self.sync_every or time.time() - self.synced >= self.sync_interval):
+        self.sync()
+
+  def sync(self):
+    os.fsync(self.file.fileno())
+    self.pending = 0
+    self.synced = time.time()
+
+  def close(self):
+    """ Syncs and closes the journal file. """
+
+    with self.lock:
+      if (self.file != None):
+        self.sync()
+        self.file.close()
+        self.file = None
@@ -0,0 +1,314 @@
+from hephaestus.transport import AGENT_PATH, Output, Transport, TransportError
+import errno
+import fcntl
+import logging
+import os
+import select
+import shutil
+import subprocess
+import sys
+import time
+
+# ioctl sharing the blocks of a file with another one on copy-on-write filesystems (btrfs, xfs), see linux/fs.h
+FICLONE = 0x40049409
+
+def clone(src, dest, size):
+  """ Copies the content of a file to another one with the fastest mechanism available.
+
+  The blocks of src are shared with dest (reflink) on copy-on-write filesystems, otherwise the kernel copies the
+  data without going through user space (`copy_file_range`, python 3.8+ on linux), otherwise it is read and
+  written in chunks.
+
+  Parameters
+  ----------
+  src : file
+      source file, opened for reading
+  dest : file
+      destination file, opened for writing and empty
+  size : int
+      size of the source file
+
+  Returns
+  ------
+  str:
+      the mechanism used: `reflink`, `copy_file_range` or `copy`
+  """
+
+  try:
+    fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+    return 'reflink'
+  except (IOError, OSError):
+    pass # not a copy-on-write filesystem, or the files are on different filesystems
+
+  if (hasattr(os, 'copy_file_range')):
+    try:
+      copied = 0
+      while (copied < size):
+        count = os.copy_file_range(src.fileno(), dest.fileno(), size - copied)
+        if (count == 0):
+          break
+        copied += count
+      return 'copy_file_range'
+    except OSError as e:
+      if (e.errno not in [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP]):
+        raise
+      # start over with a plain copy
+      src.seek(0)
+      dest.seek(0)
+      dest.truncate()
+
+  shutil.copyfileobj(src, dest, 1024 * 1024)
+  return 'copy'
+
+class Local(Transport):
+  """
+  Runs the tasks on the control node itself (the `local` transport, see hephaestus/transport.py), i.e. to
+  converge the machine hep runs on or a container image being built, without the handshake, encryption and
+  channels of an ssh connection to localhost.
+
+  Commands are run with `/bin/sh` through subprocess, files are copied with `clone` (reflink, `copy_file_range`
+  or a plain copy) and the helper agent (hephaestus/agent.py) is a child process of hep talking over pipes.
+
+  Attributes
+  ----------
+  hostname : str
+      name of the host in the results (`localhost` unless the host is defined as `local://name`)
+  python : str
+      python interpreter used to run the helper agent (the one running hep)
+  cache : dict
+      state that modules share across the tasks executed on the host (i.e. apt lists were updated)
+  stats : obj
+      HostStats the commands and agent requests are counted in (nothing is counted by default, see
+      hephaestus/stats.py)
+
+  Methods
+  -------
+  connect()
+      marks the transport as usable
+  execute(command, on_line, tail)
+      executes a shell command, raising a TransportError if it fails
+  execute_many(commands)
+      executes a list of commands and returns the output and exit status of each one
+  copy_file(src, dest)
+      copies a file
+  send_tree(src, dest, paths)
+      copies files to a directory
+  agent()
+      starts the helper agent (once)
+  agent_stderr()
+      returns what the helper agent wrote to stderr
+  close_agent()
+      stops the helper agent
+  is_active()
+      checks weather the transport is still usable
+  close()
+      stops the helper agent
+
+  Queued commands (`queue` and `flush`) and the requests to the helper agent (`call`, `stat_files`, `tree`,
+  `dpkg_status`, ...) are inherited from Transport.
+  """
+
+  def __init__(self, hostname):
+    """
+    Parameters
+    ----------
+    hostname : str
+        name of the host in the results
+    """
+
+    Transport.__init__(self, hostname)
+    self.python = sys.executable
+    self.agent_process = None
+    self.active = False
+    self.log = logging.getLogger(__name__)
+
+  def connect(self):
+    """ Marks the transport as usable, there is nothing to connect to. """
+
+    self.active = True
+    self.log.info('Running the tasks of `%s` locally' % (self.hostname))
+
+  def execute(self, command, on_line = None, tail = None):
+    """ Executes a shell command, reading its stdout and stderr at the same time (see `SSH.execute`).
+
+    Parameters
+    ----------
+    command : str
+        The command to be executed. I.e. `ls`.
+    on_line : function
+        called with the stream name (`stdout` or `stderr`) and the line for each line of output as it arrives
+    tail : int
+        number of lines of each stream to keep (all of them by default)
+
+    Returns
+    ------
+    tuple:
+        lists of the (last) lines of stdout and stderr
+    """
+
+    try:
+      self.stats.add('execute_calls')
+      with open(os.devnull, 'rb') as devnull:
+        process = subprocess.Popen(command, shell=True, stdin=devnull, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      output = Output(self.stats, on_line, tail)
+      streams = {process.stdout.fileno(): 'stdout', process.stderr.fileno(): 'stderr'}
+      while (streams):
+        for fd in select.select(list(streams), [], [])[0]:
+          data = os.read(fd, 32768)
+          if (data):
+            output.feed(streams[fd], data)
+          else:
+            del streams[fd]
+      process.stdout.close()
+      process.stderr.close()
+      status = process.wait()
+      stdout, stderr = output.lines()
+    except Exception as e:
+      msg = 'Failed to run command `%s` locally. \nException: %s' % (command, e)
+      self.log.error(msg)
+      raise TransportError(msg)
+
+    if (status != 0):
+      msg = "Local command `%s` exited with status %d:\n%s" % (command, status, ' '.join(stderr))
+      self.log.error(msg)
+      raise TransportError(msg)
+    self.log.info("Local command: `%s` executed successfully:\n%s" % (command, ' '.join(stdout)))
+    return stdout, stderr
+
+  def execute_many(self, commands):
+    """ Executes a list of commands one after the other, each one with stdin closed (see `SSH.execute_many`).
+
+    Parameters
+    ----------
+    commands : list
+        The commands to be executed. I.e. `['ls', 'uptime']`.
+
+    Returns
+    ------
+    list:
+        a (stdout, stderr, exit status) tuple for each command, a command that fails does not stop the others
+    """
+
+    results = []
+    try:
+      with open(os.devnull, 'rb') as devnull:
+        for command in commands:
+          self.stats.add('execute_calls')
+          process = subprocess.Popen(command, shell=True, stdin=devnull, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+          stdout, stderr = process.communicate()
+          results.append((self.lines(stdout), self.lines(stderr), process.returncode))
+    except Exception as e:
+      msg = 'Failed to run commands %s locally. \nException: %s' % (commands, e)
+      self.log.error(msg)
+      raise TransportError(msg)
+
+    self.log.info("Local commands: %s executed with exit status %s" % (commands, [result[2] for result in results]))
+    return results
+
+  def copy_file(self, src, dest):
+    """ Copies a file with the fastest mechanism available (see `clone`), checking the size of the copy.
+
+    Parameters
+    ----------
+    src : str
+        path to the source file
+    dest : str
+        path to the destination file
+    """
+
+    try:
+      self.stats.add('copy_file_calls')
+      with open(src, 'rb') as source:
+        size = os.fstat(source.fileno()).st_size
+        with open(dest, 'wb') as target:
+          mechanism = clone(source, target, size)
+
+      if (os.path.getsize(dest) != size):
+        raise IOError('size mismatch, copied %d bytes but the file has %d bytes' % (size, os.path.getsize(dest)))
+      self.log.info("Copied `%s` to `%s` successfully (%s)" % (src, dest, mechanism))
+    except Exception as e:
+      msg = 'Failed to copy `%s` to `%s`. \nException: %s' % (src, dest, e)
+      self.log.error(msg)
+      raise TransportError(msg)
+
+  def send_tree(self, src, dest, paths):
+    """ Copies files to a directory (see `SSH.send_tree`).
+
+    Directories are created, each file is copied to a temporary file renamed over the dest file and keeps the mode
+    of the source file, like `tar -x` does.
+
+    Parameters
+    ----------
+    src : str
+        path to the source directory
+    dest : str
+        path to the destination directory
+    paths : list
+        paths of the files (and directories) to copy, relative to src (and dest)
+    """
+
+    try:
+      for path in paths:
+        source, target = os.path.join(src, path), os.path.join(dest, path)
+        if (os.path.isdir(source)):
+          if (not os.path.isdir(target)):
+            os.makedirs(target)
+          continue
+        if (not os.path.isdir(os.path.dirname(target))):
+          os.makedirs(os.path.dirname(target))
+        tmp = '%s.hep-%d.tmp' % (target, os.getpid())
+        self.copy_file(source, tmp)
+        shutil.copymode(source, tmp)
+        os.rename(tmp, target)
+    except Exception as e:
+      msg = 'Failed to send %d files from `%s` to `%s`. \nException: %s' % (len(paths), src, dest, e)
+      self.log.error(msg)
+      raise TransportError(msg)
+    self.log.info("Sent %d files from `%s` to `%s` successfully" % (len(paths), src, dest))
+
+  def agent(self):
+    """ Starts the helper agent as a child process talking over pipes, unless it is running.
+
+    Returns
+    ------
+    obj:
+        the subprocess.Popen of the agent
+    """
+
+    if (self.agent_process == None):
+      self.agent_process = subprocess.Popen([self.python, '-u', AGENT_PATH], stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+      self.agent_stdin = self.agent_process.stdin
+      self.agent_stdout = self.agent_process.stdout
+      self.log.info('Started the helper agent of `%s`' % (self.hostname))
+    return self.agent_process
+
+  def agent_stderr(self):
+    """ Returns what the helper agent wrote to stderr (i.e. the traceback of an agent that died). """
+    return self.agent_process.stderr.read()
+
+  def close_agent(self):
+    """ Stops the helper agent (if any): it exits once its stdin is closed, or is killed if it hung. """
+
+    if (self.agent_process != None):
+      process, self.agent_process = self.agent_process, None
+      process.stdin.close()
+      for i in range(100):
+        if (process.poll() != None):
+          break
+        time.sleep(0.01)
+      else:
+        process.kill()
+      process.wait()
+      process.stdout.close()
+      process.stderr.close()
+
+  def is_active(self):
+    """ Returns True once `connect` was called, until `close` is. """
+    return self.active
+
+  def close(self):
+    """ Stops the helper agent (if any). """
+
+    self.close_agent()
+    self.active = False
@@ -0,0 +1,69 @@
+""" Registry of the hep modules.
+
+The built-in modules are listed in `MODULES`, so resolving a module of a manifest does not search anything.
+Modules shipped by other packages are registered under the `hephaestus.modules` entry point group of their
+setup.py (i.e. `entry_points={'hephaestus.modules': ['cron = hep_cron:Cron']}`); the entry points are only scanned
+when a manifest uses a module that is not built in, since scanning the installed packages is slow. Finally a module
+dropped in this directory is found by the naming convention: hephaestus/modules/<module>.py defines a class named
+after the module, capitalized (i.e. `Apt` for `apt`).
+"""
+import importlib
+
+# entry point group other packages register their modules under
+GROUP = 'hephaestus.modules'
+
+# built-in modules: module name -> `python module:class`
+MODULES = {
+  'apt': 'hephaestus.modules.apt:Apt',
+  'file': 'hephaestus.modules.file:File',
+  'service': 'hephaestus.modules.service:Service',
+}
+
+# entry points of the installed packages, scanned at most once per process
+plugins = None
+
+def entry_points():
+  """ Returns the modules registered under the `hephaestus.modules` entry point group of the installed packages.
+
+  Returns
+  ------
+  dict:
+      `python module:class` keyed by module name
+  """
+
+  global plugins
+  if (plugins == None):
+    try:
+      from importlib.metadata import entry_points as find # python 3.8+
+      found = find()
+      group = found.select(group=GROUP) if hasattr(found, 'select') else found.get(GROUP, [])
+      plugins = dict((entry_point.name, entry_point.value) for entry_point in group)
+    except ImportError:
+      try:
+        import pkg_resources
+        plugins = dict((entry_point.name, '%s:%s' % (entry_point.module_name, '.'.join(entry_point.attrs)))
+                       for entry_point in pkg_resources.iter_entry_points(GROUP))
+      except ImportError:
+        plugins = {}
+  return plugins
+
+def load(module):
+  """ Imports and returns the class implementing a module.
+
+  Parameters
+  ----------
+  module : str
+      name of the module (i.e. `apt`)
+
+  Returns
+  ------
+  class:
+      the class of the module
+  """
+
+  target = MODULES.get(module) or entry_points().get(module) or 'hephaestus.modules.%s:%s' % (module, module.capitalize())
+  path, name = target.split(':')
+  try:
+    return getattr(importlib.import_module(path), name)
+  except (ImportError, AttributeError):
+    raise Exception('unknown module `%s`' % (module))
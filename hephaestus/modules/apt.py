@@ -1,27 +1,83 @@
 from hephaestus.config import config
 import logging
 
+try:
+  from shlex import quote
+except ImportError: # python 2
+  from pipes import quote
+
+# apt-get can print thousands of lines, only the last ones are kept for error reporting
+OUTPUT_TAIL = 100
+
+# apt-get update refreshes this directory, its mtime tells how old the package lists are
+APT_LISTS = '/var/lib/apt/lists'
+
+# dpkg rewrites this file whenever a package is installed or removed
+DPKG_STATUS = '/var/lib/dpkg/status'
+
+def probe_lists_age(ssh_client):
+  """ Queues a probe printing the current time and the mtime of the package lists (see `Transport.queue`). """
+
+  return ssh_client.queue("date +%%s && stat -c %%Y %s" % (quote(APT_LISTS)))
+
+def installed_packages(ssh_client, packages):
+  """ Checks which apt packages are installed on a remote host with a single `dpkg-query`.
+
+  Parameters
+  ----------
+  ssh_client : obj
+      the ssh client used to execute the ssh commands on the remote host
+  packages : list
+      names of the apt packages
+
+  Returns
+  ------
+  set:
+      names of the packages that are installed
+  """
+
+  statuses = ssh_client.dpkg_status(packages)
+  return set(package for package, status in statuses.items() if status.endswith('ok installed'))
+
 class Apt:
   """
   A class used to abstract the management of apt packages.
 
-  This class will either remove or install an apt package on a debian distro. It is designed to be idempotent.
+  This class will either remove or install apt packages on a debian distro. It is designed to be idempotent.
+  Consecutive apt tasks are executed together (see `execute_batch`).
 
   Attributes
   ----------
   task : dict
       name - name of the task
       action - action of the task (remove or install)
-      package - the action is going to be perfomred on an apt package
+      package - the action is going to be perfomred on an apt package (or a list of apt packages)
   ssh_client: obj
       the ssh client used to execute the ssh commands on the remote host
+  cache_valid_time : int
+      package lists younger than this many seconds are not updated before installing packages
+      (`apt.cache_valid_time` in the config file). By default they are updated once per host per run.
 
   Methods
   -------
-  is_installed()
-      checks weather a package is installed (used to guarantee idempotency)
+  validate(task)
+      validates the options of an apt task
+  resources(task)
+      returns the resources a task uses on the remote host
+  fingerprint(task)
+      returns what the state of an apt task depends on (see hephaestus/convergence.py)
+  probe(tasks, ssh_client)
+      queues the read-only probes the tasks will need, before any task runs
+  prestage(tasks, ssh_client)
+      downloads the packages the tasks will install, before any task runs
+  execute_batch(apts)
+      installs or removes the packages of consecutive apt tasks with a single dpkg-query and apt-get per action
   execute_action()
       installs or removes an apt package on a remote host
+  update()
+      updates the package lists of the remote host if needed
+  progress(stream, line)
+      logs the output of apt-get as it runs
   """
   def __init__(self, task, ssh_client):
     self.log = logging.getLogger(__name__)
@@ -29,39 +85,217 @@ class Apt:
     # get module name from module __name__
     module = __name__.split('.')[-1]
 
-    # make sure valid actions are selected `install` or `remove`
-    if (task[module]['action'] in ['remove', 'install']):
-      self.action = task[module]['action']
-    else:
-      msg = 'Invalid actions were provided for Apt module, please correct them. Valid options are: `install` and `remove`'
-      self.log.error(msg)
-      raise Exception(msg)
-
+    # the options were checked by `validate` when the manifest was compiled (see hephaestus/plan.py)
+    self.action = task[module]['action']
     self.name = task['name']
     self.ssh_client = ssh_client
-    self.package = task[module]['package']
-    
-  def is_installed(self):
-    """ Checks weather an apt package is installed on a remote host.
 
-    This method crafts a command based on `dpck-query` to figure out if an apt package is istalled.
+    # package can be a single package or a list of packages
+    if (isinstance(task[module]['package'], list)):
+      self.packages = [str(package) for package in task[module]['package']]
+    else:
+      self.packages = [str(task[module]['package'])]
+    self.package = ' '.join(self.packages)
+    self.cache_valid_time = config.get('apt', {}).get('cache_valid_time')
+
+  @staticmethod
+  def validate(task):
+    """ Validates the options of an apt task.
+
+    Parameters
+    ----------
+    task : dict
+        task loaded from a manifest file
 
     Returns
     ------
-    bool:
-        True if package is installed
-        False if package is not installed
+    dict:
+        the task with `package` normalized to a list of package names
     """
 
-    # use this function to guarantee indempotence
-    cmd = "dpkg-query -W -f='${Status}' %s 2>/dev/null | grep -c \"ok installed\"" % (self.package)
-    stdout, stderr = self.ssh_client.execute(cmd)
+    # get module name from module __name__
+    module = __name__.split('.')[-1]
+    options = task[module]
 
-    # a return value of 1 means the package is present, 0 means its absent
-    if (stdout[0].rstrip() == '1'):
-      return True
-    else:
-      return False
+    # make sure valid actions are selected `install` or `remove`
+    if (not isinstance(options, dict) or options.get('action') not in ['remove', 'install']):
+      raise Exception('Invalid actions were provided for Apt module in task `%s`, please correct them. Valid options are: `install` and `remove`' % (task['name']))
+
+    packages = options.get('package')
+    if (not isinstance(packages, list)):
+      packages = [packages]
+    if (not packages or any(package in [None, ''] or isinstance(package, (dict, list)) for package in packages)):
+      raise Exception('Invalid package was provided for Apt module in task `%s`, `package` must be a package name or a list of package names' % (task['name']))
+
+    return {'name': task['name'], module: {'action': options['action'], 'package': [str(package) for package in packages]}}
+
+  @staticmethod
+  def resources(task):
+    """ Returns the dpkg lock (`apt`) and the packages (`package:<name>`) of an apt task.
+
+    Tasks sharing a resource never run at the same time on a host (see `Plan`).
+    """
+
+    return ['apt'] + ['package:%s' % (package) for package in task['apt']['package']]
+
+  @staticmethod
+  def fingerprint(task):
+    """ Returns the remote files whose state tells if the packages changed (the dpkg status file).
+
+    Returns
+    ------
+    tuple:
+        list of remote paths and the local inputs of the task (none)
+    """
+
+    return [DPKG_STATUS], ''
+
+  def progress(self, stream, line):
+    """ Logs the output of apt-get as it runs. """
+    self.log.debug("%s: %s" % (stream, line.rstrip()))
+
+  def update(self):
+    """ Updates the package lists of the remote host.
+
+    The package lists are updated at most once per host per run. If `cache_valid_time` is set they are only
+    updated if they are older than `cache_valid_time` seconds.
+    """
+
+    if (self.ssh_client.cache.get('apt_updated')):
+      return
+
+    if (self.cache_valid_time != None):
+      # probe queued when the host was connected to (see `probe`), if any
+      probe = self.ssh_client.cache.pop('apt_lists_age', None) or probe_lists_age(self.ssh_client)
+      stdout, stderr, status = probe.result
+      if (status != 0):
+        msg = "Failed to check the age of the apt lists: %s" % (''.join(stderr))
+        self.log.error(msg)
+        raise self.ssh_client.error(msg)
+      now, updated = [int(line) for line in stdout[:2]]
+      if (now - updated < self.cache_valid_time):
+        self.ssh_client.cache['apt_updated'] = True
+        return
+
+    self.ssh_client.execute("apt-get update", on_line=self.progress, tail=OUTPUT_TAIL)
+    self.ssh_client.cache['apt_updated'] = True
+
+  @staticmethod
+  def probe(tasks, ssh_client):
+    """ Queues the read-only probes the apt tasks of a plan will need (see `Transport.queue`): the dpkg status of
+    their packages and the age of the package lists (if `cache_valid_time` is set).
+
+    The probes are queued when the host is connected to, so they are sent in the round trip of the first probe
+    that is read (see `TaskRunner.run_host`).
+
+    Parameters
+    ----------
+    tasks : list
+        the apt tasks of the plan
+    ssh_client : obj
+        the ssh client used to execute the ssh commands on the remote host
+    """
+
+    packages = sorted(set(package for task in tasks for package in task['apt']['package']))
+    if (packages):
+      ssh_client.probe_dpkg_status(packages)
+    if (config.get('apt', {}).get('cache_valid_time') != None and not ssh_client.cache.get('apt_updated')):
+      ssh_client.cache['apt_lists_age'] = probe_lists_age(ssh_client)
+
+  @staticmethod
+  def prestage(tasks, ssh_client):
+    """ Downloads the packages the apt tasks of a plan will install, before any task runs on the host.
+
+    The missing packages are found with a single `dpkg-query` and downloaded to the apt cache of the host with a
+    single `apt-get install --download-only`, so that installing them later only unpacks them (see `--prestage`).
+
+    Parameters
+    ----------
+    tasks : list
+        the apt tasks of the plan
+    ssh_client : obj
+        the ssh client used to execute the ssh commands on the remote host
+    """
+
+    packages = []
+    for task in tasks:
+      if (task['apt']['action'] == 'install'):
+        packages.extend(package for package in task['apt']['package'] if package not in packages)
+    if (not packages):
+      return
+
+    installed = installed_packages(ssh_client, sorted(packages))
+    packages = [package for package in packages if package not in installed]
+    if (not packages):
+      return
+
+    apt = Apt(tasks[0], ssh_client)
+    apt.update()
+    cmd = "apt-get install --download-only %s -y" % (' '.join(quote(package) for package in packages))
+    stdout, stderr = ssh_client.execute(cmd, on_line=apt.progress, tail=OUTPUT_TAIL)
+
+  @staticmethod
+  def execute_batch(apts):
+    """ Installs or removes the packages of consecutive apt tasks.
+
+    This method checks every package of every task with a single `dpkg-query`. Consecutive tasks with the same
+    action are then merged: the packages that are missing (install) or present (remove) are passed to a single
+    `apt-get` command. The package lists are updated before installing packages (see `update`).
+
+    Parameters
+    ----------
+    apts : list
+        Apt objects for consecutive tasks of a manifest running on the same host
+
+    Returns
+    ------
+    list:
+        True for the tasks that installed or removed a package, False for the tasks that had nothing to do
+    """
+
+    if (not apts):
+      return []
+    ssh_client = apts[0].ssh_client
+    installed = installed_packages(ssh_client, sorted(set(package for apt in apts for package in apt.packages)))
+    changes = []
+
+    # split the tasks into runs of consecutive tasks with the same action
+    runs = []
+    for apt in apts:
+      if (runs and runs[-1][0].action == apt.action):
+        runs[-1].append(apt)
+      else:
+        runs.append([apt])
+
+    for run in runs:
+      action = run[0].action
+      packages = []
+      for apt in run:
+        # packages already handled by an earlier task of the run don't count as a change (insure idempotency)
+        if (action == 'install'):
+          todo = [package for package in apt.packages if package not in installed and package not in packages]
+        else:
+          todo = [package for package in apt.packages if package in installed and package not in packages]
+        changes.append(todo != [])
+        packages.extend(todo)
+
+      if (not packages): # everything else assumes no change
+        continue
+
+      if (action == 'install'): # install packages
+        run[0].update()
+        cmd = "echo 'debconf debconf/frontend select Noninteractive' | debconf-set-selections && apt-get install %s -y" % (' '.join(quote(package) for package in packages))
+        stdout, stderr = ssh_client.execute(cmd, on_line=run[0].progress, tail=OUTPUT_TAIL)
+        # the queued dpkg probes (see `probe`) tell the packages before the change
+        ssh_client.cache.pop('dpkg_status', None)
+        installed.update(packages)
+      else: # remove packages
+        cmd = "apt-get remove %s -y" % (' '.join(quote(package) for package in packages))
+        stdout, stderr = ssh_client.execute(cmd, on_line=run[0].progress, tail=OUTPUT_TAIL)
+        ssh_client.cache.pop('dpkg_status', None)
+        installed.difference_update(packages)
+
+    return changes
 
   def execute_action(self):
     """ Installs or removes an apt package on a remote host
@@ -71,20 +305,8 @@ class Apt:
     Returns
     ------
     bool:
-        True if package was removed
+        True if package was installed/removed
         False if no action was taken (i.e. package was already installed)
     """
-    is_package_installed = self.is_installed()
-
-    if ((not is_package_installed) and (self.action == 'install')): # install package
-      cmd = "echo 'debconf debconf/frontend select Noninteractive' | debconf-set-selections && apt-get update && apt-get %s %s -y" % (self.action, self.package)
-      stdout, stderr = self.ssh_client.execute(cmd)
-      return True
-
-    elif ((is_package_installed) and (self.action == 'remove')): # remove package
-      cmd = "apt-get %s %s -y" % (self.action, self.package)
-      stdout, stderr = self.ssh_client.execute(cmd)
-      return True
 
-    else: # everything else assumes no change
-      return False
+    return Apt.execute_batch([self])[0]
@@ -1,241 +1,544 @@
 from hephaestus.config import config
+from hephaestus import delta
+from hephaestus import template
+import binascii
+import hashlib
 import logging
 import sys
 import os
+import tempfile
+import threading
+
+# sha256 of local src files keyed by (path, mtime, size) so that each src file is hashed once per run
+# no matter how many hosts it is deployed on
+local_hashes = {}
+local_hashes_lock = threading.Lock()
+
+def local_sha256(path):
+  """ Returns the sha256 of a local file, hashing it only if it changed since the last call.
+
+  Parameters
+  ----------
+  path : str
+      path to the local file
+
+  Returns
+  ------
+  str:
+      hex digest of the content of the file
+  """
+
+  st = os.stat(path)
+  key = (os.path.realpath(path), st.st_mtime, st.st_size)
+
+  with local_hashes_lock:
+    if (key in local_hashes):
+      return local_hashes[key]
+
+  sha256 = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+      sha256.update(chunk)
+
+  with local_hashes_lock:
+    local_hashes[key] = sha256.hexdigest()
+  return local_hashes[key]
+
+def remember_sha256(path, sha256):
+  """ Records the sha256 of a local file that was computed elsewhere (i.e. when a template was rendered, see
+  hephaestus/template.py), so that `local_sha256` does not hash it again.
+  """
+
+  st = os.stat(path)
+  with local_hashes_lock:
+    local_hashes[(os.path.realpath(path), st.st_mtime, st.st_size)] = sha256
+
+def local_tree(root):
+  """ Describes the files (size, mode and sha256) and directories under a local directory.
+
+  Parameters
+  ----------
+  root : str
+      path to the local directory
+
+  Returns
+  ------
+  tuple:
+      dict of files keyed by path relative to root (`size`, `mode` as an octal string and `sha256`) and the list
+      of directories relative to root
+  """
+
+  if (not os.path.isdir(root)):
+    raise IOError('`%s` is not a directory' % (root))
+
+  files, dirs = {}, []
+  for path, dirnames, filenames in os.walk(root):
+    dirs.extend(os.path.relpath(os.path.join(path, name), root) for name in dirnames)
+    for name in filenames:
+      full = os.path.join(path, name)
+      if (not os.path.isfile(full)):
+        continue
+      st = os.stat(full)
+      files[os.path.relpath(full, root)] = {'size': st.st_size, 'mode': '%o' % (st.st_mode & 0o7777),
+                                            'sha256': local_sha256(full)}
+  return files, dirs
 
 class File:
   """
-  A class used to abstract the management of apt packages.
+  A class used to abstract the management of files on remote hosts.
 
-  This class will either remove or install an apt package on a debian distro. It is designed to be idempotent.
+  This class will either create or remove a file on the remote host, or sync a directory tree to the remote host.
+  It is designed to be idempotent.
 
   Attributes
   ----------
   task : dict
       name - name of the task
-      action - action of the task (present or absent)
-      package - the action is going to be perfomred on an apt package
-      src - path to the source file
-      dest - path to the destination (remote host) file
-      dest_tmp - temporary path to the destination file 
+      action - action of the task (present, absent or sync)
+      src - path to the source file (or directory for sync)
+      dest - path to the destination (remote host) file (or directory for sync)
       owner - user on the remote machine
       group - group on the remote machine
-      mod - mode in octal (i.e 777 read/write/execute for user/group/other)
+      mod - mode in octal (i.e 777 read/write/execute for user/group/other), optional for sync (the files keep
+      their local mode)
+      delete - remove the files of dest that are not in src (sync only, False by default)
+      template - render the variables of the host into src before it is deployed (present only, False by default,
+      see hephaestus/template.py)
   ssh_client: obj
       the ssh client used to execute the ssh commands on the remote host
+  delta_threshold : int
+      changed files of at least this many bytes are sent as a delta against the dest file (`file.delta_threshold`
+      in the config file, 1MB by default, null to always send the whole file)
 
   Methods
   -------
-  file_exists()
-      checks if a file exists on the remote host
+  validate(task)
+      validates the options of a file task
+  resources(task)
+      returns the resources a task uses on the remote host
+  fingerprint(task)
+      returns what the state of a file task depends on (see hephaestus/convergence.py)
+  local_files(task)
+      returns the local files a task reads
+  templates(task)
+      returns the local template files of a task
+  render(task, variables)
+      replaces the template of a task with the file rendered for a host
+  execute_batch(files)
+      creates or removes the dest files of consecutive file tasks, probing the remote host once
   execute_action()
       creates or removes a file on the remote host
-  get_file_mod()
-      gets mod of the dest file
-  set_file_mod()
+  sync()
+      makes the dest directory a copy of the src directory
+  converge(dest)
+      creates or removes the dest file based on the stat of dest
+  upload(dest)
+      replaces the dest file with the src file atomically
+  upload_delta(dest_tmp)
+      rebuilds the src file next to the dest file from the blocks of the dest file and a delta
+  discard(*file_names)
+      removes the temporary files of a failed upload
+  set_file_mod(file_name)
       sets mod of the dest file
-  get_file_owner()
-      gets owner of the dest file
-  set_file_owner()
+  set_file_owner(file_name)
       sets owner of the dest file
-  get_file_group()
-      gets group of the dest file
-  set_file_group()
+  set_file_group(file_name)
       sets group of the dest file
   remove_file(file_name)
       remove a file on the remote host
-  compare_dest_files()
-      compare dest file and dest_temp file to see if the files are identical (does not check owner/group/mod)
   """
 
   def __init__(self, task, ssh_client):
     self.log = logging.getLogger(__name__)
 
-    # get module name from module __name__ 
+    # get module name from module __name__
     module = __name__.split('.')[-1]
 
-    # make sure valid actions are selected `present` and `absent`
-    if (task[module]['action'] in ['present', 'absent']):
-      self.action = task[module]['action']
-    else:
-      msg = "Invalid actions were provided for % module, please correct them. Valid options are: `present` and `absent` " % (__name__)
-      self.log.error(msg)
-      raise Exception(msg)
-
+    # the options were checked by `validate` when the manifest was compiled (see hephaestus/plan.py)
+    self.action = task[module]['action']
     self.name = task['name']
     self.ssh_client = ssh_client
-    self.src = task[module]['src']
+    self.src = task[module].get('src')
     self.dest = task[module]['dest']
-    self.dest_tmp = "/tmp/%s" % (os.path.basename(self.dest))
-    self.owner = task[module]['owner']
-    self.group = task[module]['group']
-    self.mod = task[module]['mod']
-    
+    self.owner = task[module].get('owner')
+    self.group = task[module].get('group')
+    self.mod = task[module].get('mod')
+    self.delete = task[module].get('delete', False)
+    self.delta_threshold = (config.get('file') or {}).get('delta_threshold', 1024 * 1024)
+
+  @staticmethod
+  def validate(task):
+    """ Validates the options of a file task.
 
-  def file_exists(self):
-    """ Checks weather the dest file exists
+    `dest` is required by every action, `src`, `owner` and `group` by the `present` and `sync` actions and `mod`
+    by the `present` action.
 
-    This method crafts a command based on `os.path.isfile` python function to figure out if a file
-    exists on the remote host. It will run the python function through the python cli.
+    Parameters
+    ----------
+    task : dict
+        task loaded from a manifest file
 
     Returns
     ------
-    bool:
-        True if dest file exists
-        False if dest file does not exist
+    dict:
+        the task
     """
 
-    # use this function to guarantee indempotence
-    cmd = "python -c \"exec(\\\"import os\\nprint os.path.isfile('%s')\\\")\"" % (self.dest)
-    stdout, stderr = self.ssh_client.execute(cmd)
+    # get module name from module __name__
+    module = __name__.split('.')[-1]
+    options = task[module]
+
+    # make sure valid actions are selected `present`, `absent` and `sync`
+    if (not isinstance(options, dict) or options.get('action') not in ['present', 'absent', 'sync']):
+      raise Exception("Invalid actions were provided for %s module in task `%s`, please correct them. Valid options are: `present`, `absent` and `sync`" % (module, task['name']))
+
+    required = {'absent': ['dest'], 'present': ['src', 'dest', 'owner', 'group', 'mod'],
+                'sync': ['src', 'dest', 'owner', 'group']}[options['action']]
+    missing = [option for option in required if options.get(option) in [None, '']]
+    if (missing):
+      raise Exception("Missing options for %s module in task `%s`: %s" % (module, task['name'], ', '.join(missing)))
+
+    if (options.get('mod') != None and (not str(options['mod']).isdigit() or '8' in str(options['mod']) or '9' in str(options['mod']))):
+      raise Exception("Invalid mod `%s` for %s module in task `%s`, mod must be in octal (i.e. 644)" % (options['mod'], module, task['name']))
+
+    if (options.get('delete') not in [None, True, False] or (options.get('delete') and options['action'] != 'sync')):
+      raise Exception("Invalid delete `%s` for %s module in task `%s`, delete is a boolean of the `sync` action" % (options['delete'], module, task['name']))
+
+    if (options.get('template') not in [None, True, False] or (options.get('template') and options['action'] != 'present')):
+      raise Exception("Invalid template `%s` for %s module in task `%s`, template is a boolean of the `present` action" % (options['template'], module, task['name']))
+
+    return {'name': task['name'], module: dict((option, options[option]) for option in ['action', 'src', 'dest', 'owner', 'group', 'mod', 'delete', 'template'] if option in options)}
 
-    # a return value of 1 means the package is present, 0 means its absent
-    if ('True' in stdout[0]):
-      return True
-    else:
-      return False
 
+  @staticmethod
+  def resources(task):
+    """ Returns the dest file (`file:<dest>`) of a file task.
 
-  def get_file_mod(self):
-    """ Gets file mod of the dest file
+    Tasks sharing a resource never run at the same time on a host (see `Plan`).
+    """
+
+    return ['file:%s' % (task['file']['dest'])]
 
-    This method crafts a command based on `os.stat` python function to figure the mod of the dest file.
-    It will run the python function through the python cli.
+
+  @staticmethod
+  def fingerprint(task):
+    """ Returns the dest file and the hash of the src file.
 
     Returns
     ------
-    int:
-        mod of the dest file in oct base
+    tuple:
+        list of remote paths and the local inputs of the task (the sha256 of the src file)
     """
 
-    cmd = "python -c \"exec(\\\"import os\\nprint oct(os.stat('%s').st_mode)[4:]\\\")\"" % (self.dest)
-    stdout, stderr = self.ssh_client.execute(cmd)
-    return int(stdout[0])
+    if (task['file']['action'] == 'sync'):
+      # the stat of the dest directory does not tell whether the files under it changed
+      raise Exception('file sync tasks can not be fingerprinted')
+    if (task['file']['action'] == 'absent'):
+      return [task['file']['dest']], ''
+    return [task['file']['dest']], local_sha256(task['file']['src'])
 
 
-  def set_file_mod(self):
-    """ Sets file mod of the dest file
+  @staticmethod
+  def local_files(task):
+    """ Returns the local files (or directory) a file task reads: its src, if the action has one. """
 
-    This method crafts a command based on `os.chmod` python function to set the mod of the dest file.
-    It will run the python function through the python cli.
-    """
+    return [task['file']['src']] if task['file']['action'] != 'absent' else []
+
+
+  @staticmethod
+  def templates(task):
+    """ Returns the local template files of a file task (its src file if it is a template). """
+
+    return [task['file']['src']] if task['file'].get('template') else []
 
-    cmd = "python -c \"exec(\\\"import os\\nos.chmod('%s', 0%d)\\\")\"" % (self.dest, int(self.mod))
-    stdout, stderr = self.ssh_client.execute(cmd)
 
+  @staticmethod
+  def render(task, variables):
+    """ Replaces the src template of a file task with the file rendered with the variables of a host.
 
-  def get_file_owner(self):
-    """ Gets file owner of the dest file
+    The rendered file is shared by the hosts using the same values (see `render_file` in hephaestus/template.py)
+    and its sha256 is known, so the change detection does not hash it again.
 
-    This method crafts a command based on `pwd.getpwuid` python function to figure the owner of the dest file.
-    It will run the python function through the python cli.
+    Parameters
+    ----------
+    task : dict
+        validated task
+    variables : dict
+        variables of the host
 
     Returns
     ------
-    str:
-        owner of the dest file
+    dict:
+        the task deploying the rendered file
     """
 
-    cmd = "python -c \"exec(\\\"import os,pwd\\nprint pwd.getpwuid(os.stat('%s').st_uid).pw_name\\\")\"" % (self.dest)
-    stdout, stderr = self.ssh_client.execute(cmd)
-    return stdout[0]
+    if (not task['file'].get('template')):
+      return task
+    path, sha256 = template.render_file(task['file']['src'], variables)
+    remember_sha256(path, sha256)
+    return dict(task, file=dict(task['file'], src=path))
 
 
-  def set_file_owner(self):
-    """ Sets file owner of the dest file
+  def set_file_mod(self, file_name):
+    """ Sets file mod of the dest file
+
+    This method sets the mod of the dest file through the helper agent running on the remote host.
 
-    This method crafts a command based on `os.chown` python function to set the owner of the dest file.
-    It will run the python function through the python cli.
+    Parameters:
+    ----------
+    file_name : str
+        path to the remote file (the dest file or its temporary upload)
     """
 
-    cmd = "python -c \"exec(\\\"import os,pwd\\nos.chown('%s', pwd.getpwnam('%s').pw_uid, -1)\\\")\"" % (self.dest, self.owner)
-    stdout, stderr = self.ssh_client.execute(cmd)
+    self.ssh_client.chmod(file_name, self.mod)
 
 
-  def get_file_group(self):
-    """ Gets file group of the dest file
+  def set_file_owner(self, file_name):
+    """ Sets file owner of the dest file
 
-    This method crafts a command based on `grp.getgrgid` python function to figure the owner of the dest file.
-    It will run the python function through the python cli.
+    This method sets the owner of the dest file through the helper agent running on the remote host.
 
-    Returns
-    ------
-    str:
-        group of the dest file
+    Parameters:
+    ----------
+    file_name : str
+        path to the remote file (the dest file or its temporary upload)
     """
 
-    cmd = "python -c \"exec(\\\"import os,grp\\nprint grp.getgrgid(os.stat('%s').st_gid).gr_name\\\")\"" % (self.dest)
-    stdout, stderr = self.ssh_client.execute(cmd)
-    return stdout[0]
+    self.ssh_client.chown(file_name, owner=self.owner)
 
 
-  def set_file_group(self):
+  def set_file_group(self, file_name):
     """ Sets file group of the dest file
 
-    This method crafts a command based on `os.chown` python function to set the group of the dest file.
-    It will run the python function through the python cli.
+    This method sets the group of the dest file through the helper agent running on the remote host.
+
+    Parameters:
+    ----------
+    file_name : str
+        path to the remote file (the dest file or its temporary upload)
     """
 
-    cmd = "python -c \"exec(\\\"import os,grp\\nos.chown('%s', -1, grp.getgrnam('%s').gr_gid)\\\")\"" % (self.dest, self.group)
-    stdout, stderr = self.ssh_client.execute(cmd)
-  
+    self.ssh_client.chown(file_name, group=self.group)
+
 
   def remove_file(self, file_name):
     """ Removes a file on the remote host
 
-    This method crafts a command based on `os.remove` python function to remove the file.
-    It will run the python function through the python cli. It will check for the existance of the file
-    before removing it in order to guarantee idempotency
+    This method removes the file through the helper agent running on the remote host. The caller is
+    responsible for checking that the file exists (see `SSH.stat_files`).
 
     Parameters:
     ----------
     file_name : str
         path to the remote file that is to be removed
+    """
+
+    self.ssh_client.remove(file_name)
+
+
+  def upload(self, dest):
+    """ Replaces the dest file with the src file atomically.
+
+    The src file is copied to a temporary file next to the dest file, its owner/group/mod are set and it is then
+    renamed over the dest file, so the dest file is never seen half written or with the wrong permissions. If
+    both files are at least `delta_threshold` bytes only a delta is sent (see `upload_delta`). If any step fails
+    the temporary file (and the delta) are removed before the error is raised again.
+
+    Parameters:
+    ----------
+    dest : dict
+        stat of the dest file
+    """
+
+    dest_tmp = os.path.join(os.path.dirname(self.dest), '.%s.hep-%s' % (os.path.basename(self.dest),
+                            binascii.hexlify(os.urandom(4)).decode('ascii')))
+    try:
+      if (self.delta_threshold != None and dest['exists'] and min(dest['size'], os.path.getsize(self.src)) >= self.delta_threshold):
+        self.upload_delta(dest_tmp)
+      else:
+        self.ssh_client.copy_file(self.src, dest_tmp)
+      self.set_file_mod(dest_tmp)
+      self.set_file_owner(dest_tmp)
+      self.set_file_group(dest_tmp)
+      self.ssh_client.rename(dest_tmp, self.dest)
+    except Exception:
+      self.discard(dest_tmp, '%s.delta' % (dest_tmp))
+      raise
+
+  def discard(self, *file_names):
+    """ Removes the temporary files of a failed upload that exist, logging (rather than raising) the failures so
+    that the error of the upload is the one reported.
+
+    Parameters:
+    ----------
+    file_names : str
+        paths to the remote files
+    """
+
+    for file_name in file_names:
+      try:
+        self.ssh_client.remove(file_name)
+      except Exception as e:
+        self.log.error('Failed to remove the temporary file `%s`: %s' % (file_name, e))
+
+
+  def upload_delta(self, dest_tmp):
+    """ Rebuilds the src file next to the dest file from the blocks of the dest file and a delta.
+
+    The checksums of the blocks of the dest file are fetched with a single request to the helper agent, matched
+    against the src file with a rolling checksum (see hephaestus/delta.py), and only the delta (copy instructions
+    and the literal data that is not in the dest file) is uploaded. The helper agent then writes the temporary
+    file from the dest file and the delta, and its sha256 is checked against the src file.
+
+    Parameters:
+    ----------
+    dest_tmp : str
+        path to the temporary file next to the dest file
+    """
+
+    block_size = delta.block_size(os.path.getsize(self.src))
+    signature = self.ssh_client.signature(self.dest, block_size)
+
+    with tempfile.NamedTemporaryFile(prefix='hep-delta-') as delta_file:
+      literal = delta.delta(self.src, signature['blocks'], block_size, delta_file)
+      delta_file.flush()
+      self.log.info('Sending `%s` as a delta: %d literal bytes out of %d' % (self.src, literal, os.path.getsize(self.src)))
+      self.ssh_client.copy_file(delta_file.name, '%s.delta' % (dest_tmp))
+
+    sha256 = self.ssh_client.patch(self.dest, '%s.delta' % (dest_tmp), dest_tmp, block_size)
+    if (sha256 != local_sha256(self.src)):
+      raise Exception('The delta of `%s` rebuilt a different file on the remote host' % (self.src))
+
+  def converge(self, dest):
+    """ Creates or removes the dest file based on the result of `SSH.stat_files`.
+
+    For the `present` action the src file is uploaded only if dest does not exist or if the hash of its content
+    differs from the hash of the src file, otherwise only the owner/group/mod that don't match the task are set.
+    For the `absent` action the dest file is removed only if it exists. All of this is done to guarantee
+    idempotency.
+
+    Parameters
+    ----------
+    dest : dict
+        stat of the dest file
 
     Returns
     ------
     bool:
-        True, if the file was removed
-        False, if there was no change
+        True, if the action was executed successfully (preset/absent)
+        False, if no changes ocurred
     """
 
-    if (self.file_exists()):
-      cmd = "python -c \"exec(\\\"import os,grp\\nos.remove('%s')\\\")\"" % (file_name)
-      stdout, stderr = self.ssh_client.execute(cmd)
-      return True
-    else:
+    # absent action
+    if (self.action == 'absent'):
+      if (dest['exists']): # (insure idempotency)
+        self.remove_file(self.dest)
+        return True
       return False
 
+    # present action
+    if (not dest['exists'] or dest['sha256'] != local_sha256(self.src)): # files are not identical (insure idempotency)
+      self.upload(dest)
+      return True
+
+    # mod, owner, group are identical (insure idempotency)
+    changed = False
+    if (int(dest['mode']) != int(self.mod)):
+      self.set_file_mod(self.dest)
+      changed = True
+    if (dest['owner'] != self.owner):
+      self.set_file_owner(self.dest)
+      changed = True
+    if (dest['group'] != self.group):
+      self.set_file_group(self.dest)
+      changed = True
+
+    return changed
+
+
+  @staticmethod
+  def execute_batch(files):
+    """ Creates or removes the dest files of consecutive file tasks.
+
+    The dest files of every task are described with a single request to the helper agent (`SSH.stat_files`)
+    and each task then decides whether anything has to change (see `converge`). Src files are only uploaded
+    when their content differs from the dest file.
+
+    Parameters
+    ----------
+    files : list
+        File objects for consecutive tasks of a manifest running on the same host
+
+    Returns
+    ------
+    list:
+        the result of `converge` for each task
+    """
+
+    if (not files):
+      return []
 
-  def compare_dest_files(self):
-    """ Compares two files to figure out if they are identical
+    # sync tasks describe their whole dest directory on their own (see `sync`)
+    dests = [f.dest for f in files if f.action != 'sync']
+    stats = files[0].ssh_client.stat_files(dests) if dests else {}
+    return [f.sync() if f.action == 'sync' else f.converge(stats[f.dest]) for f in files]
 
-    This method crafts a command based on `filecmp.cmp` python function to ccompare the dest file with dest_tmp
-    in order to guarantee idempotency. It doesn't ignored owner/group/mod of the files.
+  def sync(self):
+    """ Makes the dest directory a copy of the src directory.
+
+    The local tree (relative path, size, mode and sha256 of every file) is compared with the remote tree, which is
+    described by a single request to the helper agent (`SSH.tree`). Only the files that are missing or whose
+    content differs are sent, all of them as a single tar archive streamed over one channel (`SSH.send_tree`).
+    The mode (`mod`, or the local mode if `mod` is not set), owner and group of the sent files and of the files
+    and directories whose attributes don't match are then set with a single request, and if `delete` is set the
+    files and directories of dest that are not in src are removed with another one. Each step is skipped when it
+    has nothing to do, so a run that changes nothing costs a single request.
 
     Returns
     ------
     bool:
-        True, if dest file and dest_tmp file are identical
-        False, if dest file and dest_tmp file are NOT identical
+        True, if anything was sent, set or removed
+        False, if no changes ocurred
     """
 
-    cmd = "python -c \"exec(\\\"import filecmp\\nprint filecmp.cmp('%s', '%s')\\\")\"" % (self.dest, self.dest_tmp)
-    stdout, stderr = self.ssh_client.execute(cmd)
+    files, dirs = local_tree(self.src)
+    remote = self.ssh_client.tree(self.dest)
+
+    # missing directories are sent too (before the files) so that empty ones are created
+    send = sorted(path for path in dirs if path not in remote['dirs'])
+    send += sorted(path for path, f in files.items()
+                   if path not in remote['files'] or remote['files'][path]['sha256'] != f['sha256'])
+
+    attrs = {}
+    for path, f in files.items():
+      mode = '%o' % (int(str(self.mod), 8)) if self.mod != None else f['mode']
+      current = remote['files'].get(path)
+      if (path in send or current['mode'] != mode or current['owner'] != self.owner or current['group'] != self.group):
+        attrs[path] = mode
+    for path in dirs:
+      current = remote['dirs'].get(path)
+      if (current == None or current['owner'] != self.owner or current['group'] != self.group):
+        attrs[path] = None
+
+    extraneous_files = [path for path in remote['files'] if path not in files] if self.delete else []
+    extraneous_dirs = [path for path in remote['dirs'] if path not in dirs] if self.delete else []
+
+    if (send):
+      self.ssh_client.send_tree(self.src, self.dest, send)
+    if (attrs):
+      self.ssh_client.set_attrs(self.dest, attrs, owner=self.owner, group=self.group)
+    if (extraneous_files or extraneous_dirs):
+      self.ssh_client.prune(self.dest, extraneous_files, extraneous_dirs)
+
+    return bool(send or attrs or extraneous_files or extraneous_dirs)
 
-    if ('True' in stdout[0]):
-      return True
-    else:
-      return False
-    
 
   def execute_action(self):
     """ Creates or removes a dest file.
 
-    This method puts everything together. For the `present` action it will copy the src file to a /tmp folder,
-    compare it with the dest file (if it exists), then check owner/group/mod of the dest file (if exists), finally
-    it will replace the file only if dest file and dest_tmp files are truly identical (including owner/group/mod).
-    All of this is done to guarantee idempotency. For the `absent` action the method will first check if the
+    This method puts everything together. For the `present` action it will compare the hash of the src file
+    with the hash of the dest file (if it exists) and upload the src file only if they differ, then check
+    owner/group/mod of the dest file. All of this is done to guarantee idempotency. For the `absent` action the method will first check if the
     dest file is present before removing it (guaranteeing idempotency)
 
     Returns
@@ -245,35 +548,4 @@ class File:
         False, if no changes ocurred
     """
 
-    # present action
-    if (self.action == 'present'):
-      try:
-        # copy src file to dest tmp folder
-        self.ssh_client.copy_file(self.src, self.dest_tmp)
-        if (self.file_exists()): # if dest file exists proceed futher, otherwise just copy the src file to dest, no need to do anything else
-          if not (self.compare_dest_files()): # files are identical (insure idempotency)
-            # mod, owner, group are identical (insure idempotency)
-            if not ((self.get_file_mod == self.mod) and (self.get_file_owner == self.owner) and (self.get_file_group == self.group)):
-              # copy src file to dest
-              self.ssh_client.copy_file(self.src, self.dest)
-              return True
-            else:
-              return False
-          else:
-            return False
-        else:
-          # copy src file to dest file because dest file does not exist
-          self.ssh_client.copy_file(self.src, self.dest)
-          return True
-      except:
-        self.log.error('Failed to execute module `%` with action `%s`') % (__name__, self.action) 
-      finally:
-        # remove tmp file
-        self.remove_file(self.dest_tmp)
-    # absent action
-    elif (self.action == 'absent'):
-      if (self.file_exists()): # (insure idempotency)
-        self.remove_file(self.dest)
-        return True
-      else:
-        return False
+    return File.execute_batch([self])[0]
@@ -1,6 +1,5 @@
 from hephaestus.config import config
 import logging
-import sys
 
 class Service:
   """
@@ -19,10 +18,18 @@ class Service:
 
   Methods
   -------
+  validate(task)
+      validates the options of a service task
+  resources(task)
+      returns the resources a task uses on the remote host
+  fingerprint(task)
+      returns what the state of a service task depends on (see hephaestus/convergence.py)
+  probe(tasks, ssh_client)
+      queues the read-only probes the tasks will need, before any task runs
   is_installed()
       checks weather a package is installed (used to guarantee idempotency)
   execute_action()
-      installs or removes an apt package on a remote host
+      restarts the service on a remote host
   """
 
   def __init__(self, task, ssh_client):
@@ -31,86 +38,119 @@ class Service:
     # get module name from module __name__
     module = __name__.split('.')[-1]
 
-    # make sure valid actions are selected `restart`
-    if (task[module]['action'] in ['restart']):
-      self.action = task[module]['action']
-    else:
-      msg = "Invalid actions were provided for % module, please correct them. Valid options are: `restart`" % (__name__)
-      self.log.error(msg)
-      raise Exception(msg)
-
+    # the options were checked by `validate` when the manifest was compiled (see hephaestus/plan.py)
+    self.action = task[module]['action']
     self.name = task['name']
     self.ssh_client = ssh_client
     self.service = task[module]['name']
-    
 
-  def is_installed(self):
-    """ Checks weather an apt package is installed on a remote host.
+  @staticmethod
+  def validate(task):
+    """ Validates the options of a service task.
 
-    This method crafts a command based on `dpck-query` to figure out if an apt package is istalled.
+    Parameters
+    ----------
+    task : dict
+        task loaded from a manifest file
 
     Returns
     ------
-    bool:
-        True if package is installed
-        False if package is not installed
+    dict:
+        the task
     """
-    # use this function to guarantee indempotence
-    cmd = "dpkg-query -W -f='${Status}' %s 2>/dev/null | grep -c \"ok installed\"" % (self.service)
-    stdout, stderr = self.ssh_client.execute(cmd)
 
-    # a return value of 1 means the package is present, 0 means its absent
-    if (stdout[0].rstrip() == '1'):
-      return True
-    else:
-      return False
+    # get module name from module __name__
+    module = __name__.split('.')[-1]
+    options = task[module]
+
+    # make sure valid actions are selected `restart`
+    if (not isinstance(options, dict) or options.get('action') not in ['restart']):
+      raise Exception("Invalid actions were provided for %s module in task `%s`, please correct them. Valid options are: `restart`" % (module, task['name']))
+    if (not options.get('name')):
+      raise Exception("No service `name` was provided for %s module in task `%s`" % (module, task['name']))
+
+    return {'name': task['name'], module: {'action': options['action'], 'name': str(options['name'])}}
+
+  @staticmethod
+  def resources(task):
+    """ Returns the service (`service:<name>`) and the package of the same name (`package:<name>`) of a service task.
+
+    Tasks sharing a resource never run at the same time on a host (see `Plan`).
+    """
+
+    return ['service:%s' % (task['service']['name']), 'package:%s' % (task['service']['name'])]
 
-  def is_running(self):
-    """ Checks weather a service is running.
+  @staticmethod
+  def fingerprint(task):
+    """ Returns the remote files whose state tells if the service's package changed (the dpkg status file).
 
-    This method crafts a command based on `service` program to figure out is running.
+    Whether the service is running is not covered.
 
     Returns
     ------
-    bool:
-        True if service is running
-        False if service is not running
+    tuple:
+        list of remote paths and the local inputs of the task (none)
     """
-    # use this function to guarantee indempotence
-    cmd = "service %s status" % (self.service)
 
-    if (self.is_installed()):
-      stdout, stderr = self.ssh_client.execute(cmd)
-    else: # don't even bother if service is not installed
-      return False
+    return ['/var/lib/dpkg/status'], ''
 
-    # a return value of 1 means the package is present, 0 means its absent
-    if ("%s is running" %(self.service) in ''.join(stdout)):
-      return True
-    else:
-      return False
+  @staticmethod
+  def probe(tasks, ssh_client):
+    """ Queues a probe of the dpkg status of the packages of the services (see `Transport.probe_dpkg_status`), so
+    that it is sent in the round trip of the first probe that is read (see `TaskRunner.run_host`).
+
+    Parameters
+    ----------
+    tasks : list
+        the service tasks of the plan (handlers included)
+    ssh_client : obj
+        the ssh client used to execute the ssh commands on the remote host
+    """
+
+    ssh_client.probe_dpkg_status(sorted(set(task['service']['name'] for task in tasks)))
+
+  def is_installed(self):
+    """ Checks weather an apt package is installed on a remote host.
+
+    This method uses the probe queued by `probe` if any, otherwise it asks the helper agent running on the
+    remote host for the `dpkg-query` status of the package.
 
+    Returns
+    ------
+    bool:
+        True if package is installed
+        False if package is not installed
+    """
+    # use this function to guarantee indempotence
+    status = self.ssh_client.dpkg_status([self.service]).get(self.service, '')
+    return status.endswith('ok installed')
 
   def execute_action(self):
     """ Restarts a service on a remote host
 
-    This method crafts a command based on `service` program to install or remove an apt package.
+    This method crafts a command based on `service` program to restart the service, then makes sure the
+    service is running.
 
     Returns
     ------
     bool:
-        True if package was removed
-        False if no action was taken (i.e. package was already installed)
+        True if the service was restarted
+        False if no action was taken (i.e. the service is not installed)
     """
-    if (self.is_installed()): # install package
-      cmd = "service %s %s" % (self.service, self.action)
-      stdout, stderr = self.ssh_client.execute(cmd)
-      if (self.is_running):
+    if (self.is_installed()): # restart service
+      # restart the service and check its status in a single round trip
+      restart, status = self.ssh_client.execute_many(["service %s %s" % (self.service, self.action),
+                                                      "service %s status" % (self.service)])
+      stdout, stderr, exit_status = status
+      # `service <name> status` exits with 0 when the service is running (LSB init scripts)
+      if (restart[2] == 0 and exit_status == 0):
         return True
       else:
-        self.log.error("Failed to %s `%s`. Please debug manually." % (self.action, self.service))
-        sys.exit(1)
-        
+        msg = "Failed to %s `%s` (`service %s status` exited with %d). Please debug manually:\n%s%s" % (
+          self.action, self.service, self.service, exit_status, ''.join(restart[1]), ''.join(stdout + stderr))
+        self.log.error(msg)
+        raise Exception(msg)
+
     else:
       msg = "Failed to %s `%s` because the service does not exist." % (self.action, self.service)
       self.log.error(msg)
@@ -0,0 +1,409 @@
+from hephaestus.config import config
+from hephaestus import modules
+from hephaestus import template
+import hashlib
+import json
+import logging
+import os
+import threading
+import yaml
+
+# bump when the format of the cached plans changes so that older cache files are ignored
+PLAN_VERSION = 4
+
+# task keys that are not modules
+TASK_OPTIONS = ['name', 'depends_on', 'notify', 'handler', 'flush_handlers']
+
+log = logging.getLogger(__name__)
+
+# module classes keyed by module name, each module is imported once per process
+classes = {}
+
+# plans keyed by the hash of the manifest (and the variables rendered into it), so that a long running process
+# (hepd) compiles a manifest once
+plans = {}
+plans_lock = threading.Lock()
+
+def module_name(task):
+  """ Returns the name of the module a task uses: the only key of the task besides the task options (`name`,
+  `depends_on`, `notify`, `handler` and `flush_handlers`).
+
+  Parameters
+  ----------
+  task : dict
+      task loaded from a manifest file
+
+  Returns
+  ------
+  str:
+      name of the module (i.e. `apt`)
+  """
+
+  modules = [key for key in task if key not in TASK_OPTIONS]
+  if (len(modules) != 1):
+    raise Exception('task `%s` must use exactly one module, found: %s' % (task.get('name'), ', '.join(modules) or 'none'))
+  return modules[0]
+
+def resolve(module):
+  """ Returns the class implementing a module, as found by the module registry (see hephaestus/modules).
+
+  Parameters
+  ----------
+  module : str
+      name of the module
+
+  Returns
+  ------
+  class:
+      the class of the module
+  """
+
+  if (module not in classes):
+    classes[module] = modules.load(module)
+  return classes[module]
+
+class Unit:
+  """
+  Consecutive tasks of a plan using the same module, executed together on a host (see `TaskRunner.run_units`).
+
+  Attributes
+  ----------
+  module : str
+      name of the module
+  cls : class
+      the class of the module
+  tasks : tuple
+      the tasks, in the order of the manifest file
+  deps : frozenset
+      indexes of the units that must be done before this one starts
+  """
+
+  def __init__(self, module, cls, tasks, deps):
+    self.module = module
+    self.cls = cls
+    self.tasks = tuple(tasks)
+    self.deps = frozenset(deps)
+
+class Plan:
+  """
+  A manifest that was parsed and validated once, ready to be run on any number of hosts.
+
+  Every task was checked by the `validate` static method of its module (which also normalizes the options, i.e. a
+  single apt package becomes a list of one package) and its module class was resolved, so running the plan on a
+  host only instantiates the classes.
+
+  Attributes
+  ----------
+  tasks : tuple
+      validated tasks (handlers included), in the order of the manifest file
+  handlers : tuple
+      the handlers (tasks with `handler: true`), only run when another task that changed the host notifies them
+  hash : str
+      sha256 of the validated tasks
+  batches : tuple
+      (module name, module class, tuple of tasks) for each run of consecutive tasks using the same module (a task
+      with `flush_handlers` ends its batch)
+  units : tuple
+      the dependency graph used to run tasks concurrently on a host (see `Plan.schedule`)
+
+  Methods
+  -------
+  validate(tasks)
+      validates the tasks of a manifest and returns the normalized tasks
+  render(tasks, variables)
+      renders the variables of a host into the module options of the tasks
+  schedule()
+      splits the tasks into units of work and finds the units each one has to wait for
+  templated()
+      returns True if the tasks have to be rendered for each host
+  variables()
+      returns the names of the variables the tasks and their templates use
+  """
+
+  def __init__(self, tasks, validated = False, variables = None):
+    """
+    Parameters
+    ----------
+    tasks : list
+        tasks loaded from a manifest file
+    validated : bool
+        True if the tasks were already validated (i.e. loaded from the plan cache)
+    variables : dict
+        variables of a host rendered into the tasks before they are validated (see hephaestus/template.py), the
+        tasks are not rendered by default
+    """
+
+    if (variables != None):
+      tasks = Plan.render(tasks, variables)
+    self.tasks = tuple(tasks if validated else Plan.validate(tasks))
+    if (variables != None):
+      # the modules render their templates (i.e. the src files of the file module)
+      self.tasks = tuple(resolve(module_name(task)).render(task, variables)
+                         if hasattr(resolve(module_name(task)), 'render') else task for task in self.tasks)
+    self.hash = hashlib.sha256(json.dumps(self.tasks, sort_keys=True).encode('utf-8')).hexdigest()
+    self.handlers = tuple(task for task in self.tasks if task.get('handler'))
+    self.batches = batches(task for task in self.tasks if not task.get('handler'))
+    self.units = self.schedule()
+
+  def templated(self):
+    """ Returns True if the tasks have to be rendered for each host: a module option has a placeholder (`$`) or
+    a module renders templates (see the `templates` static method of the modules).
+    """
+
+    for task in self.tasks:
+      module = module_name(task)
+      cls = resolve(module)
+      if (template.templated(task[module]) or (hasattr(cls, 'templates') and cls.templates(task))):
+        return True
+    return False
+
+  def variables(self):
+    """ Returns the names of the variables the module options of the tasks and their templates use.
+
+    Returns
+    ------
+    set:
+        names of the variables (None if the path of a template has a placeholder, then the template can only be
+        read once rendered and any variable may be used)
+    """
+
+    names = set()
+    for task in self.tasks:
+      module = module_name(task)
+      cls = resolve(module)
+      names.update(template.option_names(task[module]))
+      for path in (cls.templates(task) if hasattr(cls, 'templates') else []):
+        if (template.templated(path)):
+          return None
+        names.update(template.template(path)[2])
+    return names
+
+  def schedule(self):
+    """ Splits the tasks into units of work and finds the units each one has to wait for.
+
+    A task that does not declare `depends_on` waits for every task before it, as if the tasks were run one after
+    the other. A task that declares `depends_on` (a list of task names, possibly empty) only waits for the
+    named tasks and for the earlier tasks it shares a resource with (see the `resources` static method of the
+    modules, i.e. the same dest file or the dpkg lock). Such a task starts a new unit, while the other tasks join
+    the unit of the task before them if it uses the same module, does not flush the handlers and already waits
+    for every earlier unit, so that they are still batched together without making the tasks of that unit wait
+    for tasks they don't depend on. Handlers are not part of any unit.
+
+    Returns
+    ------
+    tuple:
+        Unit objects in the order of the manifest file
+    """
+
+    tasks = [task for task in self.tasks if not task.get('handler')]
+
+    # modules without a `resources` static method conflict with every task of the same module
+    resources = []
+    for task in tasks:
+      cls = resolve(module_name(task))
+      resources.append(set(cls.resources(task)) if hasattr(cls, 'resources') else set([module_name(task)]))
+
+    units = []
+    unit_of = [] # index of the unit of each task
+    for i, task in enumerate(tasks):
+      module = module_name(task)
+      cls = resolve(module)
+      if ('depends_on' in task):
+        deps = set(unit_of[j] for j in range(i)
+                   if tasks[j]['name'] in task['depends_on'] or resources[j] & resources[i])
+        units.append({'module': module, 'cls': cls, 'tasks': [task], 'deps': deps})
+      elif (units and units[-1]['module'] == module and not units[-1]['tasks'][-1].get('flush_handlers')
+            and units[-1]['deps'] >= set(range(len(units) - 1))):
+        units[-1]['tasks'].append(task)
+      else:
+        units.append({'module': module, 'cls': cls, 'tasks': [task], 'deps': set(range(len(units)))})
+      unit_of.append(len(units) - 1)
+
+    return tuple(Unit(unit['module'], unit['cls'], unit['tasks'], unit['deps'] - set([index]))
+                 for index, unit in enumerate(units))
+
+  @staticmethod
+  def validate(tasks):
+    """ Validates the tasks of a manifest.
+
+    Every task is validated, so that all the errors of a manifest are reported at once. The task options are
+    checked too: task names are unique (they identify the tasks in `depends_on`, `notify`, the journal and the
+    stats), `depends_on` names earlier tasks, `notify` names handlers and handlers neither depend on, notify nor
+    flush other tasks.
+
+    Parameters
+    ----------
+    tasks : list
+        tasks loaded from a manifest file
+
+    Returns
+    ------
+    list:
+        the tasks as normalized by the `validate` static method of their module
+    """
+
+    if (not isinstance(tasks, (list, tuple))):
+      raise Exception('hep manifest must be a list of tasks')
+
+    validated = []
+    errors = []
+    names = [task.get('name') if isinstance(task, dict) else None for task in tasks]
+    handlers = [task.get('name') for task in tasks if isinstance(task, dict) and task.get('handler')]
+    for i, task in enumerate(tasks):
+      try:
+        if (not isinstance(task, dict) or not task.get('name')):
+          raise Exception('task #%d must be a mapping with a `name`' % (i + 1))
+        if (names.index(task['name']) < i):
+          raise Exception('task `%s` is defined more than once, task names must be unique' % (task['name']))
+        module = module_name(task)
+        cls = resolve(module)
+        validated_task = cls.validate(task) if hasattr(cls, 'validate') else task
+
+        # depends_on names tasks that come before the task
+        if ('depends_on' in task):
+          depends_on = task['depends_on'] if isinstance(task['depends_on'], list) else [task['depends_on']]
+          unknown = [name for name in depends_on if name in handlers or name not in [t.get('name') for t in tasks[:i] if isinstance(t, dict)]]
+          if (unknown):
+            raise Exception('task `%s` depends on unknown or later tasks: %s' % (task['name'], ', '.join(str(name) for name in unknown)))
+          validated_task = dict(validated_task, depends_on=[str(name) for name in depends_on])
+
+        # notify names handlers, which are run at most once per host when a notifying task changed the host
+        if (task.get('handler')):
+          if ([option for option in ['depends_on', 'notify', 'flush_handlers'] if option in task]):
+            raise Exception('handler `%s` can not use `depends_on`, `notify` or `flush_handlers`' % (task['name']))
+          validated_task = dict(validated_task, handler=True)
+        if ('notify' in task):
+          notify = task['notify'] if isinstance(task['notify'], list) else [task['notify']]
+          unknown = [name for name in notify if name not in handlers]
+          if (unknown):
+            raise Exception('task `%s` notifies unknown handlers: %s' % (task['name'], ', '.join(str(name) for name in unknown)))
+          validated_task = dict(validated_task, notify=[str(name) for name in notify])
+        if (task.get('flush_handlers')):
+          validated_task = dict(validated_task, flush_handlers=True)
+
+        validated.append(validated_task)
+      except Exception as e:
+        errors.append(str(e))
+
+    if (errors):
+      msg = 'Invalid manifest:\n%s' % ('\n'.join(' - %s' % (error) for error in errors))
+      log.error(msg)
+      raise Exception(msg)
+    return validated
+
+  @staticmethod
+  def render(tasks, variables):
+    """ Renders the variables of a host into the module options of the tasks of a manifest.
+
+    The task options (`name`, `depends_on`, `notify`, ...) are not rendered, so the tasks refer to each other by
+    the same names on every host.
+
+    Parameters
+    ----------
+    tasks : list
+        tasks loaded from a manifest file
+    variables : dict
+        variables of the host
+
+    Returns
+    ------
+    list:
+        the rendered tasks (anything that is not a task is left as is for `validate` to report)
+    """
+
+    if (not isinstance(tasks, (list, tuple))):
+      return tasks
+    return [dict((key, value if key in TASK_OPTIONS else template.render_option(value, variables, 'task `%s`' % (task.get('name'))))
+                 for key, value in task.items()) if isinstance(task, dict) else task for task in tasks]
+
+def batches(tasks):
+  """ Splits tasks into runs of consecutive tasks using the same module (a task with `flush_handlers` ends its run).
+
+  Parameters
+  ----------
+  tasks : iterable
+      validated tasks
+
+  Returns
+  ------
+  tuple:
+      (module name, module class, tuple of tasks) tuples in the order of the tasks
+  """
+
+  runs = []
+  for task in tasks:
+    module = module_name(task)
+    if (runs and runs[-1][0] == module and not runs[-1][2][-1].get('flush_handlers')):
+      runs[-1][2].append(task)
+    else:
+      runs.append((module, resolve(module), [task]))
+  return tuple((module, cls, tuple(tasks)) for module, cls, tasks in runs)
+
+def compile(path, variables = None):
+  """ Returns the plan of a manifest file.
+
+  Plans are cached in memory and on disk (`plan_cache` directory in the config file, empty to disable the disk
+  cache) keyed by the hash of the manifest's content, so a manifest is only parsed and validated again when it
+  changes. Plans rendered with the variables of a host are only cached in memory, keyed by the variables too
+  (their templates are rendered to temporary files, see hephaestus/template.py).
+
+  Parameters
+  ----------
+  path : str
+      path to the manifest file
+  variables : dict
+      variables of a host to render into the tasks (not rendered by default)
+
+  Returns
+  ------
+  obj:
+      Plan of the manifest
+  """
+
+  with open(os.path.realpath(path), 'rb') as f:
+    content = f.read()
+  key = hashlib.sha256(content + ('\0hep-plan-%d' % (PLAN_VERSION)).encode('ascii')).hexdigest()
+  if (variables != None):
+    key = (key, json.dumps(variables, sort_keys=True))
+
+  with plans_lock:
+    if (key in plans):
+      return plans[key]
+
+  if (variables != None):
+    plan = Plan(yaml.safe_load(content), variables=variables)
+    with plans_lock:
+      plans[key] = plan
+    return plan
+
+  cache_file = os.path.join(config['plan_cache'], '%s.json' % (key)) if config.get('plan_cache') else None
+  plan = None
+
+  if (cache_file != None and os.path.exists(cache_file)):
+    try:
+      with open(cache_file) as f:
+        plan = Plan(json.load(f), validated=True)
+    except Exception as e:
+      log.debug('Ignoring the cached plan `%s`: %s' % (cache_file, e))
+
+  if (plan == None):
+    plan = Plan(yaml.safe_load(content))
+    if (cache_file != None):
+      save(cache_file, plan)
+
+  with plans_lock:
+    plans[key] = plan
+  return plan
+
+def save(cache_file, plan):
+  """ Writes the tasks of a plan to the plan cache (failures are logged and ignored). """
+
+  try:
+    if (not os.path.isdir(os.path.dirname(cache_file))):
+      os.makedirs(os.path.dirname(cache_file))
+    tmp = '%s.%d.tmp' % (cache_file, os.getpid())
+    with open(tmp, 'w') as f:
+      json.dump(list(plan.tasks), f)
+    os.rename(tmp, cache_file)
+  except (IOError, OSError, TypeError, ValueError) as e:
+    log.debug('Failed to cache the plan in `%s`: %s' % (cache_file, e))
@@ -1,37 +1,118 @@
 from hephaestus.config import config
-import paramiko
+from hephaestus.transport import AGENT_PATH, Output, Transport, TransportError
+import base64
+import binascii
 import logging
-import sys
+import os
+import select
+import socket
+import tarfile
+import threading
+import time
 import pprint
 
-class SSH:
+try:
+  from shlex import quote
+except ImportError: # python 2
+  from pipes import quote
+
+def import_paramiko():
+  """ Imports paramiko the first time a connection is opened, so that commands that never connect to a host (i.e.
+  `hep --check-manifest`) don't pay for it: it is the slowest import of hep. """
+  import paramiko
+  return paramiko
+
+# source of the helper agent started on the remote hosts (see hephaestus/agent.py)
+with open(AGENT_PATH, 'rb') as agent_file:
+  AGENT_SOURCE = base64.b64encode(agent_file.read()).decode('ascii')
+
+class SSHError(TransportError):
+  """ Raised when a command, a file transfer or a request to the helper agent fails on the remote host. """
+
+class ConnectError(SSHError):
+  """ Raised when the ssh connection to the remote host can't be established. """
+
+class SSH(Transport):
   """
   A class used to manage ssh connections, execute commands over ssh and copy files 
-  using the paramiko library.
+  using the paramiko library (the `ssh` transport, see hephaestus/transport.py).
 
   Attributes
   ----------
   hostname : str
       the hostname to create ssh connection with
+  port : int
+      the ssh port of the remote host (22 unless the host is defined as `hostname:port`)
+  compress : bool
+      compress the ssh traffic (`ssh.compress` in the config file, disabled by default)
+  chunk_size : int
+      size of the chunks files are uploaded in (`ssh.chunk_size` in the config file, 32KB by default)
+  max_pending_writes : int
+      number of uploaded chunks that can wait for the remote host's acknowledgment
+      (`ssh.max_pending_writes` in the config file, 64 by default)
+  cache : dict
+      state that modules share across the tasks executed over this connection (i.e. apt lists were updated)
+  python : str
+      python interpreter used to run the helper agent on the remote host (`ssh.python` in the config file)
+  keepalive : int
+      send a keepalive packet after this many seconds of inactivity (`ssh.keepalive` in the config file,
+      disabled by default)
+  timeout : int
+      seconds to wait for the host to accept the connection (`ssh.timeout` in the config file, 10 by default)
+  agent_timeout : float
+      seconds to wait for the helper agent to answer a request (`ssh.agent_timeout` in the config file, 300 by
+      default), a hung agent fails the request instead of blocking the host forever
+  connect_retries : int
+      number of times a transient connection failure is retried (`ssh.connect_retries` in the config file, 2 by
+      default)
+  connect_backoff : float
+      seconds to wait before the first retry, doubled before each next one (`ssh.connect_backoff` in the config
+      file, 1 by default)
+  stats : obj
+      HostStats the connect time, round trips and bytes of the connection are counted in (nothing is counted
+      by default, see hephaestus/stats.py)
 
   Methods
   -------
   connect()
       creates the ssh connection
-  execute(command)
+  execute(command, on_line, tail)
       executes shell commands on a remote host over ssh
+  stream(channel, on_line, tail)
+      reads the stdout and stderr of a command at the same time into bounded buffers
+  execute_many(commands)
+      executes a list of commands in a single round trip and returns the output and exit status of each one
   close()
       closes the ssh connection
+  is_active()
+      checks weather the ssh connection is still usable
   copy_file(src, dest)
       copies a local file to a remote host over sftp
+  send_tree(src, dest, paths)
+      streams local files to a remote directory as a single tar archive
+  sftp()
+      returns an idle sftp session of the connection
+  release_sftp(sftp_client)
+      hands a sftp session back once a transfer is done with it
+  agent()
+      returns the channel of the helper agent running on the remote host
+  close_agent()
+      closes the channel of the helper agent
+  agent_stderr()
+      returns what the helper agent wrote to stderr
+
+  Queued commands (`queue` and `flush`) and the requests to the helper agent (`call`, `stat_files`, `tree`,
+  `dpkg_status`, ...) are inherited from Transport.
   """
 
+  error = SSHError
+
   def __init__(self, hostname):
     """
     Parameters
     ----------
     hostname : str
-        hostname of the remote machine
+        hostname of the remote machine, optionally followed by the ssh port (i.e. `10.0.0.1:2222`)
     username : str
         remote machine's username
     password : str
@@ -39,38 +120,86 @@ class SSH:
     log : 
         logging object used to collect logs
     """
-    self.hostname = hostname
+    Transport.__init__(self, hostname)
+    self.port = 22
+    self.ssh_client = None
+
+    # hosts can be defined as `hostname:port`
+    if (':' in hostname):
+      self.hostname, port = hostname.rsplit(':', 1)
+      self.port = int(port)
+
     self.username = config['ssh']['username'] 
     self.password = config['ssh']['password']
+    self.compress = config['ssh'].get('compress', False)
+    self.chunk_size = config['ssh'].get('chunk_size', 32768)
+    self.max_pending_writes = config['ssh'].get('max_pending_writes', 64)
+    self.sftp_clients = []
+    self.sftp_idle = []
+    self.sftp_lock = threading.Lock()
+    self.python = config['ssh'].get('python', 'python')
+    self.keepalive = config['ssh'].get('keepalive', 0)
+    self.timeout = config['ssh'].get('timeout', 10)
+    self.agent_timeout = config['ssh'].get('agent_timeout', 300)
+    self.connect_retries = config['ssh'].get('connect_retries', 2)
+    self.connect_backoff = config['ssh'].get('connect_backoff', 1.0)
+    self.agent_channel = None
     self.log = logging.getLogger(__name__)
 
   def connect(self):
-    """ Creates a ssh connection with the remote host. 
-    
-    If it can't establish an ssh connection it will log the error and exit with a status code of 1.
+    """ Creates a ssh connection with the remote host.
+
+    Transient failures (the host can't be reached, the connection is reset or times out) are retried up to
+    `connect_retries` times, waiting `connect_backoff` seconds before the first retry and twice as long before each
+    of the next ones. If it can't establish an ssh connection it will log the error and raise a ConnectError.
     """
 
-    try:
-      self.ssh_client = paramiko.SSHClient()
-      self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-      self.ssh_client.connect(hostname=self.hostname, username=self.username, password=self.password, look_for_keys=False, allow_agent=False)
-      self.log.info('Created the SSH connection successfully')
-    except:
-      self.log.error('Failed to create the SSH connection. Please check your username/password/host.')
-      sys.exit(1)
-
-  def execute(self, command):
+    paramiko = import_paramiko()
+    delay = self.connect_backoff
+    for attempt in range(self.connect_retries + 1):
+      try:
+        started = time.time()
+        self.ssh_client = paramiko.SSHClient()
+        self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.ssh_client.connect(hostname=self.hostname, port=self.port, username=self.username, password=self.password, look_for_keys=False, allow_agent=False, compress=self.compress, timeout=self.timeout)
+        self.ssh_client.get_transport().set_keepalive(self.keepalive)
+        self.stats.add('connect_seconds', time.time() - started)
+        self.log.info('Created the SSH connection successfully')
+        return
+      except paramiko.AuthenticationException as e:
+        # retrying won't fix the credentials
+        msg = 'Failed to create the SSH connection to `%s`. Please check your username/password.' % (self.hostname)
+        self.log.error(msg)
+        raise ConnectError('%s (%s)' % (msg, e))
+      except (socket.error, socket.timeout, EOFError, paramiko.SSHException) as e:
+        self.ssh_client.close()
+        if (attempt == self.connect_retries):
+          msg = 'Failed to create the SSH connection to `%s` after %d attempt(s). Please check your host.' % (self.hostname, attempt + 1)
+          self.log.error(msg)
+          raise ConnectError('%s (%s)' % (msg, e))
+        self.log.warning('Failed to connect to `%s` (%s), retrying in %.1f seconds' % (self.hostname, e, delay))
+        time.sleep(delay)
+        delay *= 2
+
+  def execute(self, command, on_line = None, tail = None):
     """ Execute a command on the remote host. 
     
-    If the command returns a non-empty stderr object then the program exit with a status code of 1.
-    Sometimes commands return non-empty stderr and stdout. The program will assume that the command executed
-    correctly as is the case with `apt-get install php5` on a debian distro. It does just that but installs
-    the package correctly.
+    If the command exits with a non-zero status then a SSHError is raised. Commands can
+    print to stderr and still succeed, as is the case with `apt-get install php5` on a debian distro, so only the
+    exit status is taken into account.
+
+    stdout and stderr are read at the same time as the command runs (see `stream`), so a command that prints a
+    lot to one of them can't block while we wait on the other. Commands with a lot of output (i.e.
+    `apt-get install`) should set `tail` so that only the last lines are kept in memory.
 
     Parameters
     ----------
     command : str
         The command to be executed on the remote host. I.e. `ls`.
+    on_line : function
+        called with the stream name (`stdout` or `stderr`) and the line for each line of output as it arrives
+    tail : int
+        number of lines of each stream to keep (all of them by default)
 
     Returns
     ------
@@ -79,49 +208,313 @@ class SSH:
         stderr is the second value in the tuple and contains a string of the command's stderr
     """
     try:
-      stdin, stdout, stderr = self.ssh_client.exec_command(command)
-
-      # read stdout && stderr values    
-      stdout = stdout.readlines()
-      stderr = stderr.readlines()
-      
-      # assume that if both stderr and stdout are not empty then there is no real error
-      if (stderr != [] and stdout == []): # exit when there is an error
-        msg = "SSH command `%s` returned an error:\n%s" % (command, ' '.join(stderr))
-        self.log.error(msg)
-        print(msg)
-        sys.exit(1)
-      else:
-        self.log.info("SSH command: `%s` executed successfully:\n%s" % (command, ' '.join(stdout)))
+      self.stats.add('execute_calls')
+      self.stats.add('bytes_sent', len(command))
+      channel = self.ssh_client.get_transport().open_session()
+      channel.exec_command(command)
+      channel.shutdown_write()
+
+      # read stdout && stderr values
+      stdout, stderr = self.stream(channel, on_line, tail)
+      status = channel.recv_exit_status()
+      channel.close()
 
     except Exception as e:
-      self.log.error('Failed to run command `%s` through the SSH connection. \nException: %s' % (command, e))
-      sys.exit(1)
+      msg = 'Failed to run command `%s` through the SSH connection. \nException: %s' % (command, e)
+      self.log.error(msg)
+      raise SSHError(msg)
+
+    if (status != 0): # raise when there is an error
+      msg = "SSH command `%s` exited with status %d:\n%s" % (command, status, ' '.join(stderr))
+      self.log.error(msg)
+      raise SSHError(msg)
+    else:
+      self.log.info("SSH command: `%s` executed successfully:\n%s" % (command, ' '.join(stdout)))
 
     return stdout, stderr
 
+  def stream(self, channel, on_line = None, tail = None):
+    """ Reads the stdout and stderr of a command at the same time until it exits.
+
+    Output is split into lines as it arrives and only the last `tail` lines of each stream are kept (see `Output`
+    in hephaestus/transport.py), so memory stays flat no matter how much the command prints.
+
+    Parameters
+    ----------
+    channel : obj
+        paramiko Channel the command was executed on
+    on_line : function
+        called with the stream name (`stdout` or `stderr`) and the line for each line of output as it arrives
+    tail : int
+        number of lines of each stream to keep (all of them by default)
+
+    Returns
+    ------
+    tuple:
+        lists of the (last) lines of stdout and stderr
+    """
+
+    output = Output(self.stats, on_line, tail)
+
+    while True:
+      received = False
+      if (channel.recv_ready()):
+        output.feed('stdout', channel.recv(32768))
+        received = True
+      if (channel.recv_stderr_ready()):
+        output.feed('stderr', channel.recv_stderr(32768))
+        received = True
+
+      if (not received):
+        if (channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready()):
+          break
+        # only stdout wakes up select, stderr is polled every 50ms
+        select.select([channel], [], [], 0.05)
+
+    return output.lines()
+
+  def execute_many(self, commands):
+    """ Executes a list of commands on the remote host in a single round trip.
+
+    The commands are executed one after the other by a single remote shell, each one in its own subshell with
+    stdin closed. The output of each command is captured separately and sent back prefixed by a header that holds
+    a random boundary, the exit status of the command and the size of its stdout and stderr. Unlike `execute`,
+    a command that fails does not stop the program, its exit status is returned to the caller.
+
+    Parameters
+    ----------
+    commands : list
+        The commands to be executed on the remote host. I.e. `['ls', 'uptime']`.
+
+    Returns
+    ------
+    list:
+        a (stdout, stderr, exit status) tuple for each command, stdout and stderr being lists of lines like the
+        ones returned by `execute`
+    """
+
+    if (not commands):
+      return []
+
+    boundary = 'hep-%s' % (binascii.hexlify(os.urandom(8)).decode('ascii'))
+    script = ['d=$(mktemp -d) || exit 1']
+    for command in commands:
+      script.append('( %s\n) >"$d/o" 2>"$d/e" </dev/null' % (command))
+      script.append('printf \'%s %%d %%d %%d\\n\' $? $(($(wc -c <"$d/o"))) $(($(wc -c <"$d/e")))' % (boundary))
+      script.append('cat "$d/o" "$d/e"')
+    script.append('rm -rf "$d"')
+
+    errors = ''
+    try:
+      script = '\n'.join(script)
+      self.stats.add('execute_calls')
+      self.stats.add('bytes_sent', len(script))
+      stdin, stdout, stderr = self.ssh_client.exec_command(script)
+      output = stdout.read()
+      errors = stderr.read()
+      self.stats.add('bytes_received', len(output) + len(errors))
+
+      results = []
+      offset = 0
+      for command in commands:
+        end = output.index(b'\n', offset)
+        header = output[offset:end].decode('ascii').split(' ')
+        if (header[0] != boundary):
+          raise Exception('unexpected output:\n%s' % (output[offset:].decode('utf-8', 'replace')))
+        status, stdout_size, stderr_size = [int(field) for field in header[1:]]
+        offset = end + 1 + stdout_size + stderr_size
+        results.append((self.lines(output[end + 1:end + 1 + stdout_size]),
+                        self.lines(output[end + 1 + stdout_size:offset]), status))
+    except Exception as e:
+      msg = 'Failed to run commands %s through the SSH connection. \nException: %s %s' % (commands, e, errors)
+      self.log.error(msg)
+      raise SSHError(msg)
+
+    self.log.info("SSH commands: %s executed with exit status %s" % (commands, [result[2] for result in results]))
+    return results
+
+  def is_active(self):
+    """ Returns True if the ssh connection is open and usable. """
+
+    if (self.ssh_client == None or self.ssh_client.get_transport() == None):
+      return False
+    return self.ssh_client.get_transport().is_active()
+
   def close(self):
-    """ Closes the ssh connection. """    
+    """ Closes the helper agent and the sftp sessions (if any) and the ssh connection. """
+
+    self.close_agent()
+
+    for sftp_client in self.sftp_clients:
+      sftp_client.close()
+    self.sftp_clients = []
+    self.sftp_idle = []
+
+    if (self.ssh_client != None):
+      self.ssh_client.close()
+      self.ssh_client = None
+
+  def sftp(self):
+    """ Returns an idle sftp session of the connection.
+
+    Sessions are opened when no idle one is left and reused by every transfer after that, so transfers made one
+    after the other share a single session while concurrent transfers (see `TaskRunner.run_units`) each get their
+    own channel. The session must be handed back with `release_sftp`.
+
+    Returns
+    ------
+    obj:
+        paramiko SFTPClient
+    """
+
+    with self.sftp_lock:
+      if (self.sftp_idle):
+        return self.sftp_idle.pop()
+
+    sftp_client = self.ssh_client.open_sftp()
+    with self.sftp_lock:
+      self.sftp_clients.append(sftp_client)
+    return sftp_client
+
+  def release_sftp(self, sftp_client):
+    """ Hands a sftp session returned by `sftp` back once a transfer is done with it. """
+
+    with self.sftp_lock:
+      self.sftp_idle.append(sftp_client)
 
   def copy_file(self, src, dest):
     """ Copies a file from the local host to the remote host over sftp.
-    
-    The program will exit with a exit code of `1` if it can't copy the file successfully.
-    
+
+    The file is streamed in `chunk_size` chunks without waiting for the remote host to acknowledge each write
+    (up to `max_pending_writes` writes can be in flight), so on high latency links the upload is limited by the
+    bandwidth rather than by round trips. The size of the remote file is checked once the upload is done.
+    A SSHError is raised if it can't copy the file successfully.
+
     Parameters
     ----------
-    command : str
-        The command to be executed on the remote host. I.e. `ls`.
+    src : str
+        path to the local file
+    dest : str
+        path to the remote file
     """
 
     try:
-      ftp_client=self.ssh_client.open_sftp()
-      ftp_client.put(src, dest)
-      ftp_client.close() 
+      self.stats.add('copy_file_calls')
+      sftp = self.sftp()
+      size = 0
+
+      with open(src, 'rb') as local_file:
+        remote_file = sftp.open(dest, 'wb', 0)
+        try:
+          for i, chunk in enumerate(iter(lambda: local_file.read(self.chunk_size), b'')):
+            # every `max_pending_writes` chunks one write is not pipelined: it waits for the acknowledgments of
+            # the writes in flight (and raises their errors), so a large file can't queue up unbounded writes
+            remote_file.set_pipelined((i + 1) % self.max_pending_writes != 0)
+            remote_file.write(chunk)
+            size += len(chunk)
+            self.stats.add('bytes_sent', len(chunk))
+        finally:
+          remote_file.close()
+
+      if (sftp.stat(dest).st_size != size):
+        raise IOError('size mismatch, copied %d bytes but the remote file has %d bytes' % (size, sftp.stat(dest).st_size))
       self.log.info("Copied `%s` to `%s` successfully" % (src, dest))
+      self.release_sftp(sftp)
     except Exception as e:
-      self.log.error('Failed to copy `%s` to `%s`. Make sure your source file exists(relative to hephaestus source code dir, same goes for the destination dir. \nException: %s' % (src, dest, e))
+      msg = 'Failed to copy `%s` to `%s`. Make sure your source file exists(relative to hephaestus source code dir, same goes for the destination dir. \nException: %s' % (src, dest, e)
+      self.log.error(msg)
+      # the session may be broken, it is not handed back (it is closed with the connection)
+      raise SSHError(msg)
+
+  def send_tree(self, src, dest, paths):
+    """ Streams local files to a remote directory as a single tar archive.
+
+    The archive is built on the fly and written to the stdin of `tar -x` on the remote host over a single channel,
+    so sending many files costs one round trip and nothing is staged on either disk. Missing directories are
+    created. A SSHError is raised if the files can't be extracted successfully.
+
+    Parameters
+    ----------
+    src : str
+        path to the local directory
+    dest : str
+        path to the remote directory
+    paths : list
+        paths of the files to send, relative to src (and dest)
+    """
+
+    command = 'mkdir -p %s && tar -xf - -C %s' % (quote(dest), quote(dest))
+    stats = self.stats
+
+    class Writer:
+      """ Counts the bytes of the archive as they are written to the channel. """
+      def __init__(self, stream):
+        self.stream = stream
+      def write(self, data):
+        stats.add('bytes_sent', len(data))
+        self.stream.write(data)
+
+    try:
+      self.stats.add('execute_calls')
+      channel = self.ssh_client.get_transport().open_session()
+      channel.exec_command(command)
+      stdin = channel.makefile('wb')
+      archive = tarfile.open(fileobj=Writer(stdin), mode='w|')
+      for path in paths:
+        archive.add(os.path.join(src, path), arcname=path, recursive=False)
+      archive.close()
+      stdin.flush()
+      channel.shutdown_write()
+
+      stdout, stderr = self.stream(channel, tail=100)
+      status = channel.recv_exit_status()
+      channel.close()
+    except Exception as e:
+      msg = 'Failed to send %d files from `%s` to `%s`. \nException: %s' % (len(paths), src, dest, e)
+      self.log.error(msg)
+      raise SSHError(msg)
+
+    if (status != 0):
+      msg = "Failed to extract %d files to `%s`, `%s` exited with status %d:\n%s" % (len(paths), dest, command, status, ' '.join(stderr))
+      self.log.error(msg)
+      raise SSHError(msg)
+    self.log.info("Sent %d files from `%s` to `%s` successfully" % (len(paths), src, dest))
+
+  def agent(self):
+    """ Returns the channel of the helper agent running on the remote host.
+
+    The agent (hephaestus/agent.py) is started the first time it is needed and keeps running until the connection
+    is closed. Its source is passed on the command line, so nothing is written to the remote disk and there is
+    nothing to clean up. Every request after that is a line written to the same channel instead of a new remote
+    process.
+
+    Returns
+    ------
+    obj:
+        paramiko Channel the agent reads requests from and writes responses to
+    """
+
+    if (self.agent_channel == None):
+      cmd = "%s -u -c \"import base64;exec(base64.b64decode('%s'))\"" % (self.python, AGENT_SOURCE)
+      self.agent_channel = self.ssh_client.get_transport().open_session()
+      self.agent_channel.settimeout(self.agent_timeout)
+      self.agent_channel.exec_command(cmd)
+      self.agent_stdin = self.agent_channel.makefile('wb')
+      self.agent_stdout = self.agent_channel.makefile('r')
+      self.log.info('Started the helper agent on `%s`' % (self.hostname))
+    return self.agent_channel
+
+  def agent_stderr(self):
+    """ Returns what the helper agent wrote to stderr (i.e. the traceback of an agent that died). """
+
+    try:
+      return self.agent_channel.recv_stderr(65536)
+    except socket.timeout:
+      return ''
+
+  def close_agent(self):
+    """ Closes the channel of the helper agent (if any), the agent exits as soon as its stdin is closed. """
 
-      sys.exit(1)
-    finally:
-      ftp_client.close()
+    if (self.agent_channel != None):
+      self.agent_channel.close()
+      self.agent_channel = None
@@ -0,0 +1,227 @@
+from hephaestus.config import config
+
+import json
+import os
+import threading
+import time
+
+# counters recorded for each host, in the order they are reported
+COUNTERS = [
+  ('connect_seconds', 'Time spent opening the ssh connection'),
+  ('execute_calls', 'Number of commands (or batches of commands) executed through the ssh connection'),
+  ('copy_file_calls', 'Number of files uploaded over sftp'),
+  ('agent_calls', 'Number of requests sent to the helper agent'),
+  ('bytes_sent', 'Bytes sent to the host (commands, agent requests and file content)'),
+  ('bytes_received', 'Bytes received from the host (command output and agent responses)'),
+  ('seconds', 'Time spent running the manifest on the host'),
+]
+
+class HostStats:
+  """
+  Counters and task timings of a single host.
+
+  The tasks of a host can run concurrently (see `TaskRunner.run_units`), so the counters are updated under a lock.
+
+  Attributes
+  ----------
+  counters : dict
+      value of each counter (see `COUNTERS`)
+  tasks : list
+      name, module, wall time (seconds) and change status of each task, in the order they were run
+  modules : dict
+      number of tasks and wall time (seconds) of each module
+
+  Methods
+  -------
+  add(counter, value)
+      adds value to a counter
+  task(module, name, seconds, changed)
+      records the wall time and the change status of a task
+  report()
+      returns the counters and timings as a dict
+  """
+
+  def __init__(self):
+    self.counters = dict((counter, 0) for counter, description in COUNTERS)
+    self.tasks = []
+    self.modules = {}
+    self.lock = threading.Lock()
+
+  def add(self, counter, value = 1):
+    with self.lock:
+      self.counters[counter] += value
+
+  def task(self, module, name, seconds, changed):
+    with self.lock:
+      self.tasks.append({'name': name, 'module': module, 'seconds': seconds, 'changed': bool(changed)})
+      totals = self.modules.setdefault(module, {'tasks': 0, 'seconds': 0.0})
+      totals['tasks'] += 1
+      totals['seconds'] += seconds
+
+  def report(self):
+    report = dict(self.counters)
+    report['tasks'] = self.tasks
+    report['modules'] = self.modules
+    return report
+
+class NullHostStats:
+  """ Stands in for HostStats when instrumentation is disabled, every method does nothing. """
+
+  def add(self, counter, value = 1):
+    pass
+
+  def task(self, module, name, seconds, changed):
+    pass
+
+  def report(self):
+    return {}
+
+class Stats:
+  """
+  Collects the counters and timings of a run for every host.
+
+  `SSH` counts its connect time, round trips and bytes, while `TaskRunner` records the wall time of each task
+  and host. At the end of the run the report is written as json and/or as a Prometheus textfile (see `save`).
+
+  Attributes
+  ----------
+  json : str
+      path of the json report (`stats.json` in the config file or `--stats` cli argument)
+  prometheus : str
+      path of the Prometheus textfile (`stats.prometheus` in the config file)
+
+  Methods
+  -------
+  host(host)
+      returns the HostStats of a host
+  report()
+      returns the counters and timings of every host as a dict
+  save()
+      writes the report to the configured files
+  """
+
+  enabled = True
+
+  def __init__(self, json = None, prometheus = None):
+    self.json = json
+    self.prometheus = prometheus
+    self.started = time.time()
+    self.hosts = {}
+    self.lock = threading.Lock()
+
+  def host(self, host):
+    with self.lock:
+      return self.hosts.setdefault(host, HostStats())
+
+  def report(self):
+    return {'seconds': time.time() - self.started,
+            'hosts': dict((host, stats.report()) for host, stats in self.hosts.items())}
+
+  def save(self):
+    save(self.report(), self.json, self.prometheus)
+
+class NullStats:
+  """ Stands in for Stats when instrumentation is disabled, so that recording costs a no-op method call. """
+
+  enabled = False
+  host_stats = NullHostStats()
+
+  def host(self, host):
+    return self.host_stats
+
+  def report(self):
+    return None
+
+  def save(self):
+    pass
+
+def collector():
+  """ Returns a Stats object if a report file is configured, a NullStats object otherwise.
+
+  Returns
+  ------
+  obj:
+      Stats or NullStats
+  """
+
+  if (config['stats'].get('json') or config['stats'].get('prometheus')):
+    return Stats(config['stats'].get('json'), config['stats'].get('prometheus'))
+  return NullStats()
+
+def save(report, json_path = None, prometheus_path = None):
+  """ Writes a report (see `Stats.report`) as json and/or as a Prometheus textfile.
+
+  Files are written to a temporary file which is then renamed over the destination, so a reader (i.e. the
+  node_exporter textfile collector) never sees a half written report.
+
+  Parameters
+  ----------
+  report : dict
+      the report of a run
+  json_path : str
+      path of the json report
+  prometheus_path : str
+      path of the Prometheus textfile
+  """
+
+  if (json_path):
+    write(json_path, json.dumps(report, indent=2, sort_keys=True) + '\n')
+  if (prometheus_path):
+    write(prometheus_path, prometheus(report))
+
+def write(path, content):
+  tmp = '%s.tmp' % (path)
+  with open(tmp, 'w') as f:
+    f.write(content)
+  os.rename(tmp, path)
+
+def prometheus(report):
+  """ Formats a report in the Prometheus text exposition format.
+
+  Parameters
+  ----------
+  report : dict
+      the report of a run (see `Stats.report`)
+
+  Returns
+  ------
+  str:
+      metrics prefixed by `hep_`, labeled by host (and module/task)
+  """
+
+  def label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+  def metric(name, description, samples):
+    lines.append('# HELP hep_%s %s' % (name, description))
+    lines.append('# TYPE hep_%s gauge' % (name))
+    for labels, value in samples:
+      labels = ','.join('%s="%s"' % (key, label(val)) for key, val in labels)
+      lines.append('hep_%s{%s} %s' % (name, labels, repr(value)) if labels else 'hep_%s %s' % (name, repr(value)))
+
+  lines = []
+  hosts = sorted(report['hosts'].items())
+  metric('run_seconds', 'Time spent running the manifest on every host', [([], report['seconds'])])
+  for counter, description in COUNTERS:
+    metric('host_%s' % (counter), description, [([('host', host)], stats[counter]) for host, stats in hosts])
+  metric('module_tasks', 'Number of tasks run by each module', [
+    ([('host', host), ('module', module)], totals['tasks'])
+    for host, stats in hosts for module, totals in sorted(stats['modules'].items())])
+  metric('module_seconds', 'Time spent running the tasks of each module', [
+    ([('host', host), ('module', module)], totals['seconds'])
+    for host, stats in hosts for module, totals in sorted(stats['modules'].items())])
+  # a handler notified by several tasks runs more than once: its runs are summed into a single sample per task
+  tasks = []
+  for host, stats in hosts:
+    totals = {}
+    for task in stats['tasks']:
+      if (task['name'] not in totals):
+        totals[task['name']] = {'module': task['module'], 'seconds': 0.0, 'changed': False}
+        tasks.append((host, task['name'], totals[task['name']]))
+      totals[task['name']]['seconds'] += task['seconds']
+      totals[task['name']]['changed'] = totals[task['name']]['changed'] or bool(task['changed'])
+  metric('task_seconds', 'Time spent running each task (every run of a handler)', [
+    ([('host', host), ('module', task['module']), ('task', name)], task['seconds']) for host, name, task in tasks])
+  metric('task_changed', 'Whether each task changed the host (1) or not (0)', [
+    ([('host', host), ('module', task['module']), ('task', name)], int(task['changed'])) for host, name, task in tasks])
+  return '\n'.join(lines) + '\n'
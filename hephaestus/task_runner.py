@@ -1,83 +1,820 @@
 from hephaestus.config import config
-from hephaestus.ssh import SSH
-import importlib
+from hephaestus import inventory
+from hephaestus.convergence import ConvergenceCache
+from hephaestus.events import EventStream, sinks
+from hephaestus.journal import Journal
+from hephaestus.plan import batches, compile, module_name, resolve
+from hephaestus.transport import for_host
+from hephaestus.stats import collector
 
-import os
 import sys
+import hashlib
 import logging
-import yaml
+import math
+import threading
+import time
+
+try:
+  import queue
+except ImportError: # python 2
+  import Queue as queue
 
 class TaskRunner:
   """
   A class used to run tasks on a remote hosts.
 
-  This class is responsible for running a list of tasks encapsulated in a manifest file. It will also figure out
-  the module (`apt`, `service`, `file`) responsible for executing a particular task.The tasks runner can run 
+  This class is responsible for running a list of tasks encapsulated in a manifest file. The manifest is compiled
+  into a plan (see hephaestus/plan.py) before any host is contacted, which validates every task and figures out
+  the module (`apt`, `service`, `file`) responsible for executing it. The tasks runner can run
   a manifest against multiple hosts by iterating over the hosts file that contains one hostname per line.
+  Up to `forks` hosts are converged in parallel, each one by a worker thread that owns its ssh connection.
 
   Attributes
   ----------
-  tasks : dict
-      tasks to be executed loaded from a manifest YAML file.
+  plan : obj
+      Plan of the manifest YAML file (validated tasks and their module classes)
   hosts : list
-      list of hostnames that the manifest will be applied on 
+      list of hostnames that the manifest will be applied on
+  plans : dict
+      Plan rendered with the variables of each host, keyed by hostname (empty if the manifest has nothing to
+      render, then every host runs `plan`, see hephaestus/template.py)
+  forks : int
+      maximum number of hosts the manifest is applied on in parallel
+  task_concurrency : int
+      maximum number of tasks running at the same time on a host (1 runs the tasks one after the other)
+  converged : obj
+      ConvergenceCache used to skip the hosts that did not change since their last successful run (None if
+      `converge_cache` is not set in the config file)
+  force : bool
+      True to run the manifest on every host, even the ones that did not change (`--force` cli argument)
+  journal : obj
+      Journal recording the work done, so that an interrupted run can be resumed (None if `journal` is empty in
+      the config file)
+  prestage : bool
+      True to let the modules prepare the hosts of a batch before the tasks run (`--prestage` cli argument), i.e.
+      download the apt packages the plan will install
+  prestage_concurrency : int
+      maximum number of hosts being prestaged at the same time (`prestage_concurrency` in the config file, `forks`
+      by default)
+  staged : dict
+      connections to the prestaged hosts kept for the task pass, keyed by hostname
+  serial : int or str
+      number (or percentage, i.e. `25%`) of hosts per rolling batch (every host in one batch by default)
+  max_fail_percentage : float
+      the remaining batches are not run if more than this percentage of the hosts of a batch failed
+  notified : dict
+      names of the handlers notified on each host and not run yet
+  stats : obj
+      Stats collecting the timings and counters of the run (NullStats if no report file is configured)
+  events : obj
+      EventStream the progress of the run is reported to (see hephaestus/events.py), workers never wait on it
 
   Methods
   -------
-  mgs()
-      helper method to display the status of the task execution
   run()
       executes tasks from a manifest file on hostnames from the hosts file.
+  rolling_batches()
+      splits the hosts into rolling batches of `serial` hosts
+  run_batch(batch, results)
+      executes tasks from a manifest file on a batch of hosts
+  prestage_batch(batch)
+      prestages the hosts of a batch before any of their tasks runs
+  run_host(host)
+      executes tasks from a manifest file on a single host
+  probe(host, ssh_client)
+      lets the modules queue the read-only probes their tasks will need
+  prestaged(host, ssh_client, host_stats)
+      lets the modules prepare the host before the tasks run
+  execute(host, module, hep_class, tasks, ssh_client, result, host_stats)
+      executes consecutive tasks using the same module on a host
+  run_units(host, ssh_client, result, host_stats)
+      executes the tasks on a host, running independent tasks at the same time
+  notify(host, task, changed)
+      queues the handlers a task notifies if it changed the host
+  run_handlers(host, ssh_client, result, host_stats)
+      executes the handlers notified on a host
+  connect(host)
+      returns a ssh connection to the host
+  disconnect(host, ssh_client, failed)
+      releases the ssh connection once the manifest was run on the host
+  render(manifest, variables)
+      renders the plan once per distinct set of variables of the hosts
+  plan_for(host)
+      returns the plan run on a host
+  batches(host)
+      returns the runs of consecutive tasks using the same module
+  units(host)
+      returns the units of work of the plan and their dependencies
+  handlers(host)
+      returns the handlers of the plan
+  skipped(host)
+      reports that a host is skipped because it did not change
+  resumed(host)
+      reports that a host is skipped because the manifest succeeded on it in the interrupted run
+  started(host, module, task)
+      reports that a task starts
+  record(result, host, module, task, changed, seconds, error)
+      reports the status of a task and adds it to the result of the host
+  done(host, result, seconds)
+      reports the result of a host
+  report(results, seconds)
+      reports the per host results at the end of the run
   """
 
-  def __init__(self):
+  def __init__(self, manifest = None, hosts = None, variables = None):
+    """
+    Parameters
+    ----------
+    manifest : str
+        path to the manifest file (`manifest` from the config by default)
+    hosts : list
+        hostnames the manifest will be applied on (the hosts of the `hosts` file from the config matching `limit`
+        by default, see hephaestus/inventory.py)
+    variables : dict
+        variables of each host keyed by hostname (the ones from the hosts file when hosts are not given, none
+        otherwise)
+    """
     self.log = logging.getLogger(__name__)
+    self.forks = config['forks']
+    self.task_concurrency = config['task_concurrency']
+    self.output_lock = threading.Lock()
+    self.notified = {}
+    self.converged = ConvergenceCache(config['converge_cache']) if config.get('converge_cache') else None
+    self.force = config.get('force', False)
+    self.serial = config.get('serial')
+    self.max_fail_percentage = config['max_fail_percentage']
+    self.prestage = config.get('prestage', False)
+    self.prestage_concurrency = config.get('prestage_concurrency') or config['forks']
+    self.staged = {}
+    self.stats = collector()
+    self.events = EventStream(sinks(), config['events']['queue_size'])
 
-    # load manifest file
-    with open(os.path.realpath(config['manifest'])) as yml_file:
-      self.tasks = yaml.load(yml_file)
+    # load and validate manifest file (before connecting to any host)
+    self.manifest = manifest or config['manifest']
+    self.plan = compile(self.manifest)
 
-    # load hosts file
-    with open(os.path.realpath(config['hosts'])) as f:
-      self.hosts = [x.strip() for x in f.readlines()]
+    # load the hosts of the hosts file matching `limit`
+    if (hosts == None):
+      hosts, variables = inventory.select()
+    self.hosts = hosts
 
-  def msg(self, task):
-    if task:
-      print "SUCCESS\n"
+    # render the variables of the hosts into the plan (before connecting to any host)
+    self.plans = self.render(self.manifest, variables or {})
+    if (self.plans):
+      plan_hash = hashlib.sha256(' '.join(sorted(set(plan.hash for plan in self.plans.values()))).encode('ascii')).hexdigest()
     else:
-      print "NO CHANGE\n"
+      plan_hash = self.plan.hash
+    self.journal = Journal(config['journal'], plan_hash, config['resume']) if config.get('journal') else None
 
   def run(self):
     """ Executes tasks from a manifest file on hostnames from the hosts file.
 
-    This method will iterate over each host in the hosts file and execute a list of tasks from a manifest file.
+    The hosts are split into rolling batches of `serial` hosts (every host at once by default, see
+    `rolling_batches`). The hosts of a batch are handed to a pool of `forks` worker threads. Each worker picks
+    the next host from a queue and executes the list of tasks from a manifest file on it (see `run_host`). A
+    failure on one host does not stop the other workers. The work done is recorded in the journal as it completes
+    (see hephaestus/journal.py). If more than `max_fail_percentage` percent of the hosts
+    of a batch failed, the remaining batches are not run. Once every host has been processed the per host
+    results are reported. The progress of the run is written by the background thread of `events`, which is
+    stopped once the queued events are written.
+
+    Returns
+    ------
+    dict:
+        the result of each host keyed by hostname (see `run_host`)
+    """
+
+    results = {}
+    started = time.time()
+    batches = self.rolling_batches()
+    self.events.start()
+    self.events.emit('run_start', manifest=self.manifest, hosts=len(self.hosts), plan=self.plan.hash, forks=self.forks)
+    if (self.journal != None):
+      self.journal.open()
+    try:
+      try:
+        for number, batch in enumerate(batches):
+          self.run_batch(batch, results)
+
+          failed = len([host for host in batch if results[host]['failed']])
+          if (100.0 * failed / len(batch) > self.max_fail_percentage):
+            error = 'not run, %d of the %d hosts of batch %d failed (max_fail_percentage is %s)' % (failed, len(batch), number + 1, self.max_fail_percentage)
+            self.log.error('Aborting the run: %s' % (error))
+            for remaining in batches[number + 1:]:
+              for host in remaining:
+                results[host] = {'ok': 0, 'changed': 0, 'failed': True, 'error': error}
+            break
+      finally:
+        # the work done so far is synced to disk even if the run is interrupted
+        if (self.journal != None):
+          self.journal.close()
+
+      if (self.converged != None):
+        self.converged.save()
+      self.report(results, time.time() - started)
+    finally:
+      # the events queued so far are written even if the run is interrupted
+      self.events.close()
+    self.stats.save()
+    return results
+
+  def rolling_batches(self):
+    """ Splits the hosts into rolling batches of `serial` hosts.
+
+    `serial` is either a number of hosts or a percentage of the hosts (i.e. `25%`, rounded up). By default every
+    host is in the same batch.
+
+    Returns
+    ------
+    list:
+        lists of hostnames, in the order of the hosts file
+    """
+
+    if (self.serial == None):
+      size = len(self.hosts)
+    elif (str(self.serial).endswith('%')):
+      size = int(math.ceil(len(self.hosts) * float(str(self.serial)[:-1]) / 100))
+    else:
+      size = int(self.serial)
+    size = max(size, 1)
+    return [self.hosts[i:i + size] for i in range(0, len(self.hosts), size)]
+
+  def run_batch(self, batch, results):
+    """ Executes tasks from a manifest file on a batch of hosts, `forks` hosts at a time (after prestaging every
+    host of the batch with `--prestage`, see `prestage_batch`).
+
+    Parameters
+    ----------
+    batch : list
+        hostnames the manifest is applied on
+    results : dict
+        the result of each host is added to it, keyed by hostname (see `run_host`)
+    """
+
+    if (self.prestage):
+      self.prestage_batch(batch)
+
+    hosts = queue.Queue()
+    for host in batch:
+      hosts.put(host)
+
+    def worker():
+      while True:
+        try:
+          host = hosts.get_nowait()
+        except queue.Empty:
+          return
+        results[host] = self.run_host(host)
+
+    workers = [threading.Thread(target=worker) for i in range(min(self.forks, len(batch)))]
+    for thread in workers:
+      thread.daemon = True
+      thread.start()
+    for thread in workers:
+      thread.join()
+
+  def prestage_batch(self, batch):
+    """ Prestages the hosts of a batch before any of their tasks runs, `prestage_concurrency` hosts at a time.
+
+    Every host of the batch is connected to and prepared by the modules (see `prestaged`), i.e. the apt packages
+    are downloaded on all the hosts at the same time, so the batch waits for the slowest download rather than the
+    sum of them, and the install tasks only unpack the packages. The connections are kept for the task pass (see
+    `run_host`), so every host of the batch stays connected in between (`serial` bounds the size of the batches).
+    A host that fails to be prestaged is left to the task pass, which reports its failure.
+
+    Parameters
+    ----------
+    batch : list
+        hostnames the manifest is applied on
+    """
+
+    hosts = queue.Queue()
+    for host in batch:
+      if (self.journal == None or self.journal.finished(host) == None):
+        hosts.put(host)
+    lock = threading.Lock()
+
+    def worker():
+      while True:
+        try:
+          host = hosts.get_nowait()
+        except queue.Empty:
+          return
+        ssh_client = None
+        started = time.time()
+        try:
+          ssh_client = self.connect(host)
+          self.events.emit('host_connect', host=host, seconds=round(time.time() - started, 3))
+          self.prestaged(host, ssh_client, self.stats.host(host))
+          with lock:
+            self.staged[host] = ssh_client
+        except Exception as e:
+          self.log.warning('Failed to prestage `%s`, its tasks will run without it: %s' % (host, e))
+          if (ssh_client != None):
+            self.disconnect(host, ssh_client, True)
+
+    workers = [threading.Thread(target=worker) for i in range(min(self.prestage_concurrency, hosts.qsize()))]
+    for thread in workers:
+      thread.daemon = True
+      thread.start()
+    for thread in workers:
+      thread.join()
+
+  def run_host(self, host):
+    """ Executes tasks from a manifest file on a single host.
+
     Each task is going to be assigned a module responsible for the executing it. It will also make sure to close
-    the ssh connection after running all tasks for a particular host. The progress of the task runner will be
+    the ssh connection after running all tasks for the host. The progress of the task runner will be
     output to the screen in the following format: TASK( {{ module_name }} - [ {{ hostname }} ]): {{ task_name }}
+
+    Parameters
+    ----------
+    host : str
+        hostname the manifest is applied on
+
+    Returns
+    ------
+    dict:
+        ok - number of tasks that did not change anything
+        changed - number of tasks that changed the host
+        failed - True if the host could not be converged
+        error - description of the failure (if any)
     """
 
+    # the manifest already succeeded on the host in the interrupted run (see `--resume`)
+    if (self.journal != None and self.journal.finished(host) != None):
+      self.resumed(host)
+      self.done(host, self.journal.finished(host), 0)
+      return dict(self.journal.finished(host))
+
+    result = {'ok': 0, 'changed': 0, 'failed': False, 'error': None}
+    ssh_client = None
+    self.notified[host] = []
+    host_stats = self.stats.host(host)
+    started = time.time()
+
     try:
-      for host in self.hosts:
-        # create ssh connection
-        ssh_client = SSH(host)
-        ssh_client.connect()
-
-        for task in self.tasks:
-          module = list(task)[1]
-          print ("TASK(%s module - [ %s ]): %s" %((module), host, task['name']))
-
-          # load module and instantiate class objects dynamically
-          # the following convention should be followed: Class name is capitalized.
-          hep_module = importlib.import_module("%s" % (module))
-          hep_class = getattr(hep_module, module.capitalize())
-          hep_task = hep_class(task, ssh_client)
-          self.msg(hep_task.execute_action())
+      # create ssh connection (unless it was kept when the host was prestaged)
+      ssh_client = self.staged.pop(host, None)
+      if (ssh_client != None and not ssh_client.is_active()):
+        self.disconnect(host, ssh_client, True)
+        ssh_client = None
+      if (ssh_client == None):
+        ssh_client = self.connect(host)
+        self.events.emit('host_connect', host=host, seconds=round(time.time() - started, 3))
 
-      # close ssh connection
-      ssh_client.close()
+      # queue the read-only probes of the modules and of the convergence cache, the first one that is read sends
+      # them all in a single round trip
+      plan = self.plan_for(host)
+      self.probe(host, ssh_client)
+      probe = self.converged.probe(plan, ssh_client) if self.converged != None else None
+
+      # skip the host if it did not change since the last successful run
+      if (self.converged != None):
+        fingerprint = self.converged.fingerprint(plan, ssh_client, probe)
+        if (not self.force and self.converged.unchanged(host, fingerprint)):
+          result['ok'] = len(plan.tasks) - len(plan.handlers)
+          self.skipped(host)
+          if (self.journal != None):
+            self.journal.host(host, result)
+          self.done(host, result, time.time() - started)
+          return result
+
+      if (self.task_concurrency > 1):
+        self.run_units(host, ssh_client, result, host_stats)
+      else:
+        for module, hep_class, tasks in self.batches(host):
+          self.execute(host, module, hep_class, tasks, ssh_client, result, host_stats)
+          if (tasks[-1].get('flush_handlers')):
+            self.run_handlers(host, ssh_client, result, host_stats)
+      self.run_handlers(host, ssh_client, result, host_stats)
+
+      # remember the state the host converged to
+      if (self.converged != None):
+        self.converged.converged(host, self.converged.fingerprint(plan, ssh_client))
+      if (self.journal != None):
+        self.journal.host(host, result)
     except Exception as e:
-      self.log.error('A failure occured while executing the task runner:\n %s' % (e))
-      # log an error here
+      # failures are isolated to the host, the other workers keep going
+      result['failed'] = True
+      result['error'] = str(e)
+      self.log.error('A failure occured while executing the task runner on `%s`:\n %s' % (host, e))
     finally:
+      if (result['failed'] and self.converged != None):
+        self.converged.forget(host)
       # close ssh connection
-      ssh_client.close()
+      if (ssh_client != None):
+        self.disconnect(host, ssh_client, result['failed'])
+      host_stats.add('seconds', time.time() - started)
+
+    self.done(host, result, time.time() - started)
+    return result
+
+  def probe(self, host, ssh_client):
+    """ Lets the modules queue the read-only probes their tasks will need (see `Transport.queue`).
+
+    The tasks of the plan (handlers included) are handed to the `probe` static method of their module, if it has
+    one, before any probe is read.
+
+    Parameters
+    ----------
+    host : str
+        hostname the manifest is applied on
+    ssh_client : obj
+        SSH object connected to the host
+    """
+
+    # tasks of each module that can probe, in the order of the manifest file
+    modules = {}
+    for task in self.plan_for(host).tasks:
+      hep_class = resolve(module_name(task))
+      if (hasattr(hep_class, 'probe')):
+        modules.setdefault(module_name(task), (hep_class, []))[1].append(task)
+
+    for module, (hep_class, tasks) in sorted(modules.items()):
+      hep_class.probe(tasks, ssh_client)
+
+  def prestaged(self, host, ssh_client, host_stats):
+    """ Lets the modules prepare the host before the tasks run (i.e. download the apt packages to install).
+
+    The tasks of the plan are handed to the `prestage` static method of their module, if it has one (see
+    `prestage_batch`).
+
+    Parameters
+    ----------
+    host : str
+        hostname the manifest is applied on
+    ssh_client : obj
+        SSH object connected to the host
+    host_stats : obj
+        HostStats of the host
+    """
+
+    # tasks of each module that can prestage, in the order of the manifest file
+    modules = {}
+    for module, hep_class, tasks in self.batches(host):
+      if (hasattr(hep_class, 'prestage')):
+        modules.setdefault(module, (hep_class, []))[1].extend(tasks)
+    if (not modules):
+      return
+
+    for module, (hep_class, tasks) in sorted(modules.items()):
+      started = time.time()
+      hep_class.prestage(tasks, ssh_client)
+      host_stats.task('prestage', module, time.time() - started, False)
+
+  def execute(self, host, module, hep_class, tasks, ssh_client, result, host_stats):
+    """ Executes consecutive tasks using the same module on a host.
+
+    Parameters
+    ----------
+    host : str
+        hostname the tasks are executed on
+    module : str
+        name of the module
+    hep_class : class
+        the class of the module
+    tasks : tuple
+        the tasks
+    ssh_client : obj
+        SSH object connected to the host
+    result : dict
+        result of the host (see `run_host`)
+    host_stats : obj
+        HostStats of the host
+    """
+
+    # tasks that already succeeded in the interrupted run are not run again (see `--resume`)
+    if (self.journal != None):
+      for task in [task for task in tasks if self.journal.completed(host, task)]:
+        with self.output_lock:
+          self.started(host, module, task)
+          self.record(result, host, module, task, self.journal.tasks[(host, task['name'])])
+          self.notify(host, task, self.journal.tasks[(host, task['name'])])
+      tasks = tuple(task for task in tasks if not self.journal.completed(host, task))
+      if (not tasks):
+        return
+
+    # instantiate class objects, the module classes were resolved when the manifest was compiled
+    hep_tasks = [hep_class(task, ssh_client) for task in tasks]
+
+    # modules can execute consecutive tasks of their own in one go (i.e. to probe the remote host only once)
+    if (hasattr(hep_class, 'execute_batch')):
+      for task in tasks:
+        self.started(host, module, task)
+      task_started = time.time()
+      try:
+        changes = hep_class.execute_batch(hep_tasks)
+      except Exception as e:
+        # the tasks of a failed batch are all reported as failed
+        for task in tasks:
+          self.record(result, host, module, task, None, time.time() - task_started, str(e))
+        raise
+      # the tasks of a batch are run together, each one is accounted an equal share of the batch
+      seconds = (time.time() - task_started) / len(tasks)
+      for task, changed in zip(tasks, changes):
+        host_stats.task(module, task['name'], seconds, changed)
+        if (self.journal != None):
+          self.journal.task(host, task, changed)
+        with self.output_lock:
+          self.record(result, host, module, task, changed, seconds)
+          self.notify(host, task, changed)
+    else:
+      for task, hep_task in zip(tasks, hep_tasks):
+        self.started(host, module, task)
+        task_started = time.time()
+        try:
+          changed = hep_task.execute_action()
+        except Exception as e:
+          self.record(result, host, module, task, None, time.time() - task_started, str(e))
+          raise
+        host_stats.task(module, task['name'], time.time() - task_started, changed)
+        if (self.journal != None):
+          self.journal.task(host, task, changed)
+        with self.output_lock:
+          self.record(result, host, module, task, changed, time.time() - task_started)
+          self.notify(host, task, changed)
+
+  def run_units(self, host, ssh_client, result, host_stats):
+    """ Executes the tasks of the manifest on a host, running independent tasks at the same time.
+
+    Up to `task_concurrency` units of the plan (see `Plan.schedule`) are executed at the same time, each one by a
+    worker thread using its own channels of the same ssh connection. A unit starts as soon as the units it depends
+    on are done. Once a unit fails no other unit is started, and the failure is raised when the running ones are
+    done.
+
+    Parameters
+    ----------
+    host : str
+        hostname the manifest is applied on
+    ssh_client : obj
+        SSH object connected to the host
+    result : dict
+        result of the host (see `run_host`)
+    host_stats : obj
+        HostStats of the host
+    """
+
+    units = self.units(host)
+    pending = list(range(len(units)))
+    done = set()
+    failures = []
+    condition = threading.Condition()
+
+    def worker():
+      while True:
+        with condition:
+          while True:
+            if (failures or not pending):
+              return
+            ready = [index for index in pending if units[index].deps <= done]
+            if (ready):
+              index = ready[0]
+              pending.remove(index)
+              break
+            condition.wait()
+
+        unit = units[index]
+        try:
+          self.execute(host, unit.module, unit.cls, unit.tasks, ssh_client, result, host_stats)
+          if (unit.tasks[-1].get('flush_handlers')):
+            self.run_handlers(host, ssh_client, result, host_stats)
+        except Exception as e: # raised again by run_units
+          with condition:
+            failures.append(e)
+            condition.notify_all()
+          return
+
+        with condition:
+          done.add(index)
+          condition.notify_all()
+
+    workers = [threading.Thread(target=worker) for i in range(min(self.task_concurrency, len(units)))]
+    for thread in workers:
+      thread.daemon = True
+      thread.start()
+    for thread in workers:
+      thread.join()
+
+    if (failures):
+      raise failures[0]
+
+  def notify(self, host, task, changed):
+    """ Queues the handlers a task notifies if it changed the host (a handler is queued once per host).
+
+    Parameters
+    ----------
+    host : str
+        hostname the task was executed on
+    task : dict
+        the task
+    changed : bool
+        True if the task changed the host
+    """
+
+    if (changed):
+      notified = self.notified.setdefault(host, [])
+      notified.extend(name for name in task.get('notify', []) if name not in notified)
+
+  def run_handlers(self, host, ssh_client, result, host_stats):
+    """ Executes the handlers notified on a host, once each and in the order of the manifest file.
+
+    Handlers run at the end of the plan, or after a task with `flush_handlers` (then the handlers notified later
+    run again at the end of the plan).
+
+    Parameters
+    ----------
+    host : str
+        hostname the manifest is applied on
+    ssh_client : obj
+        SSH object connected to the host
+    result : dict
+        result of the host (see `run_host`)
+    host_stats : obj
+        HostStats of the host
+    """
+
+    with self.output_lock:
+      notified = self.notified.get(host, [])
+      self.notified[host] = []
+    handlers = [handler for handler in self.handlers(host) if handler['name'] in notified]
+
+    for module, hep_class, tasks in batches(handlers):
+      self.execute(host, module, hep_class, tasks, ssh_client, result, host_stats)
+
+  def connect(self, host):
+    """ Returns a connection to the host, over the transport of the host (ssh unless told otherwise, see
+    hephaestus/transport.py).
+
+    Parameters
+    ----------
+    host : str
+        hostname to connect to
+
+    Returns
+    ------
+    obj:
+        connected SSH (or other Transport) object
+    """
+
+    ssh_client = for_host(host)
+    ssh_client.stats = self.stats.host(host)
+    ssh_client.connect()
+    return ssh_client
+
+  def disconnect(self, host, ssh_client, failed):
+    """ Releases the ssh connection once the manifest was run on the host (closes it).
+
+    Parameters
+    ----------
+    host : str
+        hostname of the connection
+    ssh_client : obj
+        SSH object returned by `connect`
+    failed : bool
+        True if the manifest failed on the host
+    """
+
+    ssh_client.close()
+
+  def render(self, manifest, variables):
+    """ Renders the variables of the hosts into the plan, once per distinct set of variables.
+
+    Only the variables the tasks and their templates use (and `hostname` if they use it) tell the hosts apart,
+    so hosts that share their values share the rendered plan and templates (see `compile` in hephaestus/plan.py
+    and hephaestus/template.py). Everything is rendered here, before any host is contacted, so that an
+    undefined variable fails the run early and the workers only pick the plan of their host.
+
+    Parameters
+    ----------
+    manifest : str
+        path to the manifest file
+    variables : dict
+        variables of each host keyed by hostname
+
+    Returns
+    ------
+    dict:
+        Plan of each host keyed by hostname (empty if the plan has nothing to render)
+    """
+
+    if (not self.plan.templated()):
+      return {}
+
+    names = self.plan.variables()
+    plans = {}
+    for host in self.hosts:
+      host_variables = dict(variables.get(host) or {}, hostname=host)
+      if (names != None):
+        host_variables = dict((name, host_variables[name]) for name in names if name in host_variables)
+      plans[host] = compile(manifest, host_variables)
+
+    self.log.info('Rendered %d plans for %d hosts' % (len(set(plans.values())), len(self.hosts)))
+    return plans
+
+  def plan_for(self, host):
+    """ Returns the plan run on a host (rendered with its variables, see `render`). """
+
+    return self.plans.get(host, self.plan)
+
+  def batches(self, host):
+    """ Returns the runs of consecutive tasks using the same module, as compiled in the plan of a host.
+
+    Returns
+    ------
+    tuple:
+        (module name, module class, tuple of tasks) tuples in the order of the manifest file
+    """
+
+    return self.plan_for(host).batches
+
+  def units(self, host):
+    """ Returns the units of work of the plan of a host and their dependencies (see `Plan.schedule`).
+
+    Returns
+    ------
+    tuple:
+        Unit objects in the order of the manifest file
+    """
+
+    return self.plan_for(host).units
+
+  def handlers(self, host):
+    """ Returns the handlers of the plan of a host (see `Plan.handlers`).
+
+    Returns
+    ------
+    tuple:
+        handlers in the order of the manifest file
+    """
+
+    return self.plan_for(host).handlers
+
+  def skipped(self, host):
+    """ Reports that a host is skipped because it did not change since its last successful run. """
+
+    self.events.emit('host_skip', host=host, reason='unchanged')
+
+  def resumed(self, host):
+    """ Reports that a host is skipped because the manifest succeeded on it in the interrupted run. """
+
+    self.events.emit('host_skip', host=host, reason='resumed')
+
+  def started(self, host, module, task):
+    """ Reports that a task starts on a host. """
+
+    self.events.emit('task_start', host=host, module=module, task=task['name'])
+
+  def record(self, result, host, module, task, changed, seconds = 0, error = None):
+    """ Reports the status of a task and adds it to the result of the host.
+
+    Parameters
+    ----------
+    result : dict
+        result of the host (see `run_host`)
+    host : str
+        hostname the task was executed on
+    module : str
+        name of the module
+    task : dict
+        the task
+    changed : bool
+        True if the task changed the host (None if it failed)
+    seconds : float
+        time it took to execute the task
+    error : str
+        why the task failed (None if it did not)
+    """
+
+    if (error != None):
+      status = 'failed'
+    elif (changed):
+      status = 'changed'
+      result['changed'] += 1
+    else:
+      status = 'ok'
+      result['ok'] += 1
+    event = {'host': host, 'module': module, 'task': task['name'], 'status': status, 'seconds': round(seconds, 3)}
+    if (error != None):
+      event['error'] = error
+    self.events.emit('task_result', **event)
+
+  def done(self, host, result, seconds):
+    """ Reports the result of a host (see `run_host`). """
+
+    self.events.emit('host_done', host=host, ok=result['ok'], changed=result['changed'], failed=result['failed'],
+                     error=result['error'], seconds=round(seconds, 3))
+
+  def report(self, results, seconds):
+    """ Reports the result of each host in the order of the hosts file.
+
+    Parameters
+    ----------
+    results : dict
+        the result of each host keyed by hostname (see `run_host`)
+    seconds : float
+        duration of the run
+    """
+
+    self.events.send('run_summary', results=[dict(results[host], host=host) for host in self.hosts],
+                     seconds=round(seconds, 3), dropped=self.events.dropped)
@@ -0,0 +1,191 @@
+""" Rendering of the variables of the hosts (see hephaestus/inventory.py) into the tasks of a manifest.
+
+The module options of the tasks and the templated files (`template: true` in a file task) use the `string.Template`
+syntax: `$name` or `${name}` is replaced by the value of the variable `name` of the host and `$$` is a literal `$`.
+Besides the variables of the hosts file, `hostname` is the name of the host. A variable that is not defined fails
+the run before any host is contacted.
+
+A template is only rendered once per distinct set of the variables it uses: rendered files are cached by (sha256 of
+the template, values of the variables it uses), so hosts that share those values share the rendered file, and its
+sha256 is returned with it so that the file module never hashes it again (see `File.render` in
+hephaestus/modules/file.py).
+"""
+import atexit
+import hashlib
+import json
+import logging
+import os
+import shutil
+import string
+import tempfile
+import threading
+
+try:
+  STRINGS = (str, unicode)
+except NameError: # python 3
+  STRINGS = (str,)
+
+log = logging.getLogger(__name__)
+
+# templates keyed by (path, mtime, size): the sha256 of their content, their content and the variables they use
+templates = {}
+templates_lock = threading.Lock()
+
+# paths of the rendered files keyed by (sha256 of the template, values of the variables it uses)
+rendered = {}
+rendered_lock = threading.Lock()
+
+# directory of the rendered files, created on the first render and removed when the process exits
+render_dir = []
+
+def names(text):
+  """ Returns the names of the variables a template uses.
+
+  Parameters
+  ----------
+  text : str
+      the template
+
+  Returns
+  ------
+  set:
+      names of the variables
+  """
+
+  found = set()
+  for match in string.Template.pattern.finditer(text):
+    name = match.group('named') or match.group('braced')
+    if (name != None):
+      found.add(name)
+  return found
+
+def option_names(value):
+  """ Returns the names of the variables used by the strings of an option (strings of lists and dicts included). """
+
+  if (isinstance(value, dict)):
+    return set().union(*[option_names(item) for item in value.values()]) if value else set()
+  if (isinstance(value, (list, tuple))):
+    return set().union(*[option_names(item) for item in value]) if value else set()
+  if (isinstance(value, STRINGS) and '$' in value):
+    return names(value)
+  return set()
+
+def templated(value):
+  """ Returns True if the strings of an option have any placeholder (`$` included) to render. """
+
+  if (isinstance(value, dict)):
+    return any(templated(item) for item in value.values())
+  if (isinstance(value, (list, tuple))):
+    return any(templated(item) for item in value)
+  return isinstance(value, STRINGS) and '$' in value
+
+def substitute(text, variables, where):
+  """ Renders variables into a template, raising an exception naming `where` if a variable is not defined. """
+
+  try:
+    return string.Template(text).substitute(variables)
+  except KeyError as e:
+    raise Exception('undefined variable `%s` in %s' % (e.args[0], where))
+  except ValueError as e:
+    raise Exception('invalid placeholder in %s: %s' % (where, e))
+
+def render_option(value, variables, where):
+  """ Renders variables into the strings of an option (strings of lists and dicts included).
+
+  Parameters
+  ----------
+  value : obj
+      value of the option
+  variables : dict
+      variables of the host
+  where : str
+      description of the option for the error messages (i.e. task `nginx config`)
+
+  Returns
+  ------
+  obj:
+      the rendered value
+  """
+
+  if (isinstance(value, dict)):
+    return dict((key, render_option(item, variables, where)) for key, item in value.items())
+  if (isinstance(value, (list, tuple))):
+    return [render_option(item, variables, where) for item in value]
+  if (isinstance(value, STRINGS) and '$' in value):
+    return substitute(value, variables, where)
+  return value
+
+def template(path):
+  """ Returns the sha256 of a template file, its content and the variables it uses, reading it only if it changed
+  since the last call.
+
+  Parameters
+  ----------
+  path : str
+      path to the local template file
+
+  Returns
+  ------
+  tuple:
+      sha256, content and set of the names of the variables
+  """
+
+  st = os.stat(path)
+  key = (os.path.realpath(path), st.st_mtime, st.st_size)
+
+  with templates_lock:
+    if (key in templates):
+      return templates[key]
+
+  with open(path) as f:
+    text = f.read()
+  sha256 = hashlib.sha256(text.encode('utf-8') if not isinstance(text, bytes) else text).hexdigest()
+
+  with templates_lock:
+    templates[key] = (sha256, text, names(text))
+  return templates[key]
+
+def render_file(path, variables):
+  """ Returns the path and the sha256 of a template file rendered with the variables of a host.
+
+  The file is only rendered if no other host with the same values for the variables the template uses was
+  rendered before. Rendered files are named after the sha256 of their content, so different sets of variables
+  that render the same content share a file too.
+
+  Parameters
+  ----------
+  path : str
+      path to the local template file
+  variables : dict
+      variables of the host
+
+  Returns
+  ------
+  tuple:
+      path to the rendered file and sha256 of its content
+  """
+
+  sha256, text, used = template(path)
+  values = dict((name, variables[name]) for name in used if name in variables)
+  key = (sha256, json.dumps(values, sort_keys=True))
+
+  with rendered_lock:
+    if (key in rendered):
+      return rendered[key]
+
+  content = substitute(text, values, 'template `%s`' % (path))
+  data = content.encode('utf-8') if not isinstance(content, bytes) else content
+  content_sha256 = hashlib.sha256(data).hexdigest()
+
+  with rendered_lock:
+    if (not render_dir):
+      render_dir.append(tempfile.mkdtemp(prefix='hep-render-'))
+      atexit.register(shutil.rmtree, render_dir[0], True)
+    rendered_path = os.path.join(render_dir[0], content_sha256)
+    if (not os.path.exists(rendered_path)):
+      with open(rendered_path, 'wb') as f:
+        f.write(data)
+    rendered[key] = (rendered_path, content_sha256)
+
+  log.debug('Rendered `%s` with %s to `%s`' % (path, values, rendered_path))
+  return rendered[key]
@@ -0,0 +1,499 @@
+from hephaestus.config import config
+from hephaestus.stats import NullStats
+import collections
+import importlib
+import json
+import logging
+import os
+import threading
+
+try:
+  from shlex import quote
+except ImportError: # python 2
+  from pipes import quote
+
+# path of the helper agent run on the hosts (see hephaestus/agent.py)
+AGENT_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'agent.py')
+
+# longest line kept by `Output`, longer lines are cut
+MAX_LINE = 65536
+
+# transport classes keyed by name, imported when a host uses them
+TRANSPORTS = {
+  'ssh': 'hephaestus.ssh:SSH',
+  'local': 'hephaestus.local:Local',
+}
+
+class TransportError(Exception):
+  """ Raised when a command, a file transfer or a request to the helper agent fails on a host. """
+
+def for_host(host):
+  """ Returns the (not connected) transport object of a host.
+
+  A host can name its transport, i.e. `local://build` runs the manifest on the control node itself, while hosts
+  without a prefix use the `transport` of the config file (`--transport` cli argument, `ssh` by default).
+
+  Parameters
+  ----------
+  host : str
+      host as written in the hosts file (i.e. `10.0.0.1:2222` or `local://build`)
+
+  Returns
+  ------
+  obj:
+      SSH, Local or any other Transport object for the host
+  """
+
+  name, hostname = config.get('transport', 'ssh'), host
+  if ('://' in host):
+    name, hostname = host.split('://', 1)
+
+  if (name not in TRANSPORTS):
+    msg = 'Unknown transport `%s` for host `%s`, valid transports are: %s' % (name, host, ', '.join(sorted(TRANSPORTS)))
+    logging.getLogger(__name__).error(msg)
+    raise TransportError(msg)
+
+  path, cls = TRANSPORTS[name].split(':')
+  return getattr(importlib.import_module(path), cls)(hostname or 'localhost')
+
+class PendingCommand:
+  """
+  A command queued with `Transport.queue`.
+
+  Attributes
+  ----------
+  command : str
+      the command to be executed on the host
+  result : tuple
+      (stdout, stderr, exit status) of the command, reading it executes the queued commands if needed (the
+      transport's `error` is raised if they could not be executed)
+  """
+
+  def __init__(self, transport, command):
+    self.transport = transport
+    self.command = command
+    self.value = None
+    self.error = None
+
+  @property
+  def result(self):
+    if (self.value == None):
+      # waits for a flush in progress in another thread, if any
+      self.transport.flush()
+    if (self.value == None):
+      raise self.transport.error('Failed to run the queued command `%s`: %s' % (self.command, self.error or 'it was discarded'))
+    return self.value
+
+class Output:
+  """
+  The stdout and stderr of a command, split into lines as they arrive.
+
+  Each stream keeps its last `tail` lines in a ring buffer, and lines longer than `MAX_LINE` bytes (i.e. progress
+  bars redrawn with `\\r`) are cut, so memory stays flat no matter how much the command prints.
+
+  Methods
+  -------
+  feed(name, data)
+      adds data read from a stream (`stdout` or `stderr`)
+  lines()
+      returns the (last) lines of stdout and stderr once the command exited
+  """
+
+  def __init__(self, stats, on_line = None, tail = None):
+    """
+    Parameters
+    ----------
+    stats : obj
+        HostStats the received bytes are counted in
+    on_line : function
+        called with the stream name (`stdout` or `stderr`) and the line for each line of output as it arrives
+    tail : int
+        number of lines of each stream to keep (all of them by default)
+    """
+
+    self.stats = stats
+    self.on_line = on_line
+    self.buffers = {'stdout': collections.deque(maxlen=tail), 'stderr': collections.deque(maxlen=tail)}
+    self.partial = {'stdout': b'', 'stderr': b''}
+
+  def feed(self, name, data):
+    self.stats.add('bytes_received', len(data))
+    self.partial[name] += data
+    while (b'\n' in self.partial[name] or len(self.partial[name]) >= MAX_LINE):
+      if (b'\n' in self.partial[name]):
+        end = self.partial[name].index(b'\n') + 1
+      else:
+        end = MAX_LINE
+      self.emit(name, self.partial[name][:end])
+      self.partial[name] = self.partial[name][end:]
+
+  def emit(self, name, data):
+    line = data.decode('utf-8', 'replace')
+    self.buffers[name].append(line)
+    if (self.on_line != None):
+      self.on_line(name, line)
+
+  def lines(self):
+    for name in ['stdout', 'stderr']:
+      if (self.partial[name]):
+        self.emit(name, self.partial[name])
+        self.partial[name] = b''
+    return list(self.buffers['stdout']), list(self.buffers['stderr'])
+
+class Transport:
+  """
+  The way hep talks to a host: run commands, copy files and send requests to the helper agent.
+
+  Modules only use the methods of this class, so they work the same over ssh (hephaestus/ssh.py) or on the
+  control node itself (hephaestus/local.py). A transport implements `connect`, `execute`, `execute_many`,
+  `copy_file`, `send_tree`, `agent`, `agent_stderr`, `close_agent`, `is_active` and `close`; queuing commands and the requests to the helper agent
+  are built on top of them.
+
+  Attributes
+  ----------
+  hostname : str
+      the host the transport talks to
+  cache : dict
+      state that modules share across the tasks executed over this transport (i.e. apt lists were updated)
+  stats : obj
+      HostStats the round trips and bytes of the transport are counted in (nothing is counted by default, see
+      hephaestus/stats.py)
+  error : class
+      exception raised when something fails on the host
+
+  Methods
+  -------
+  connect()
+      opens the transport
+  execute(command, on_line, tail)
+      executes a shell command on the host, raising if it fails
+  execute_many(commands)
+      executes a list of commands and returns the output and exit status of each one
+  queue(command)
+      queues a read-only command to be executed with other queued commands in a single round trip
+  flush()
+      executes the queued commands
+  copy_file(src, dest)
+      copies a local file to the host
+  send_tree(src, dest, paths)
+      copies local files to a directory of the host
+  agent()
+      starts the helper agent on the host (once)
+  call(op, **args)
+      sends a request to the helper agent and returns its result
+  close_agent()
+      stops the helper agent
+  is_active()
+      checks weather the transport is still usable
+  close()
+      closes the transport
+  stat_files(paths, checksum)
+      describes files on the host (existence, mode, owner, group, size and sha256)
+  hash_files(paths)
+      returns the sha256 of files on the host
+  tree(root)
+      describes every file and directory under a directory of the host
+  set_attrs(root, paths, owner, group)
+      sets the mode, owner and group of many paths of the host
+  signature(path, block_size)
+      returns the checksums of the blocks of a file of the host
+  patch(base, delta, dest, block_size)
+      rebuilds a file of the host from the blocks of another one and a delta
+  prune(root, files, dirs)
+      removes files and empty directories of the host
+  chmod(path, mode)
+      sets the mode of a file of the host
+  chown(path, owner, group)
+      sets the owner and/or group of a file of the host
+  remove(path)
+      removes a file of the host
+  rename(src, dest)
+      renames a file of the host
+  probe_dpkg_status(packages)
+      queues a probe of the dpkg status of apt packages
+  dpkg_status(packages)
+      returns the dpkg status of apt packages
+  service_status(name)
+      returns the exit status and output of `service <name> status`
+  """
+
+  error = TransportError
+
+  def __init__(self, hostname):
+    """
+    Parameters
+    ----------
+    hostname : str
+        the host the transport talks to
+    """
+
+    self.hostname = hostname
+    self.cache = {}
+    self.stats = NullStats().host(hostname)
+    self.agent_stdin = None
+    self.agent_stdout = None
+    self.agent_lock = threading.Lock()
+    self.queued = []
+    self.queue_lock = threading.Lock()
+    self.flush_lock = threading.Lock()
+    self.log = logging.getLogger(__name__)
+
+  def connect(self):
+    """ Opens the transport, raising `error` if the host can't be reached. """
+    raise NotImplementedError()
+
+  def execute(self, command, on_line = None, tail = None):
+    """ Executes a shell command on the host and returns its stdout and stderr (lists of lines), raising `error` if
+    it exits with a non-zero status. See `SSH.execute`. """
+    raise NotImplementedError()
+
+  def execute_many(self, commands):
+    """ Executes a list of commands on the host and returns a (stdout, stderr, exit status) tuple for each one, a
+    command that fails does not stop the others. See `SSH.execute_many`. """
+    raise NotImplementedError()
+
+  def copy_file(self, src, dest):
+    """ Copies a local file to the host, raising `error` if it fails. """
+    raise NotImplementedError()
+
+  def send_tree(self, src, dest, paths):
+    """ Copies local files (paths relative to src) to a directory of the host, creating the missing directories. """
+    raise NotImplementedError()
+
+  def agent(self):
+    """ Starts the helper agent on the host unless it is running, and sets `agent_stdin` and `agent_stdout`. """
+    raise NotImplementedError()
+
+  def agent_stderr(self):
+    """ Returns what the helper agent wrote to stderr (i.e. the traceback of an agent that died). """
+    raise NotImplementedError()
+
+  def close_agent(self):
+    """ Stops the helper agent (if any), the next request starts a new one. """
+    raise NotImplementedError()
+
+  def is_active(self):
+    """ Returns True if the transport is open and usable. """
+    raise NotImplementedError()
+
+  def close(self):
+    """ Closes the helper agent (if any) and the transport. """
+    raise NotImplementedError()
+
+  def lines(self, data):
+    """ Splits command output into lines, keeping the line endings (same as `readlines`). """
+    return data.decode('utf-8', 'replace').splitlines(True)
+
+  def queue(self, command):
+    """ Queues a command to be executed with the other queued commands in a single round trip.
+
+    This is meant for read-only probes whose result is not needed right away. The queued commands are executed
+    (see `execute_many`) when `flush` is called or when the result of one of them is first accessed.
+
+    Parameters
+    ----------
+    command : str
+        The command to be executed on the host. I.e. `ls`.
+
+    Returns
+    ------
+    obj:
+        a PendingCommand whose `result` is the (stdout, stderr, exit status) tuple of the command
+    """
+
+    pending = PendingCommand(self, command)
+    with self.queue_lock:
+      self.queued.append(pending)
+    return pending
+
+  def flush(self):
+    """ Executes every queued command in a single round trip (see `queue`).
+
+    Flushes are serialized, so that a command queued by one thread and flushed by another one has its result
+    once `flush` returns. If the commands can't be executed, `error` is raised (and by their `result`).
+    """
+
+    with self.flush_lock:
+      with self.queue_lock:
+        queued, self.queued = self.queued, []
+      if (not queued):
+        return
+
+      try:
+        results = self.execute_many([pending.command for pending in queued])
+      except Exception as e:
+        for pending in queued:
+          pending.error = str(e)
+        raise
+      for pending, result in zip(queued, results):
+        pending.value = result
+
+  def call(self, op, **args):
+    """ Sends a request to the helper agent and returns its result.
+
+    If the agent reports an error (or dies) the error is logged and `error` is raised.
+
+    Parameters
+    ----------
+    op : str
+        name of the operation (see `OPS` in hephaestus/agent.py)
+    args : dict
+        arguments of the operation
+
+    Returns
+    ------
+    obj:
+        the result of the operation
+    """
+
+    try:
+      with self.agent_lock:
+        self.agent()
+        request = json.dumps({'op': op, 'args': args}) + '\n'
+        self.agent_stdin.write(request)
+        self.agent_stdin.flush()
+        line = self.agent_stdout.readline()
+        self.stats.add('agent_calls')
+        self.stats.add('bytes_sent', len(request))
+        self.stats.add('bytes_received', len(line))
+
+        if (not line):
+          raise Exception('the helper agent exited: %s' % (self.agent_stderr()))
+      response = json.loads(line)
+    except Exception as e:
+      msg = 'Failed to run `%s` through the helper agent. \nException: %s' % (op, e)
+      self.log.error(msg)
+      # a hung or dead agent is stopped, the next request starts a new one
+      with self.agent_lock:
+        self.close_agent()
+      raise self.error(msg)
+
+    if (not response['ok']):
+      msg = "Helper agent `%s` %s returned an error:\n%s" % (op, args, response['error'])
+      self.log.error(msg)
+      raise self.error(msg)
+
+    self.log.info("Helper agent `%s` executed successfully" % (op))
+    return response['result']
+
+  def stat_files(self, paths, checksum = True):
+    """ Describes files on the remote host.
+
+    Parameters
+    ----------
+    paths : list
+        paths to the remote files
+    checksum : bool
+        include the sha256 of the content of the files
+
+    Returns
+    ------
+    dict:
+        keyed by path, `exists` is False if the file does not exist, otherwise `mode` (octal string),
+        `owner`, `group`, `size` and `sha256` describe the file
+    """
+    return self.call('stat', paths=list(paths), checksum=checksum)
+
+  def hash_files(self, paths):
+    """ Returns the sha256 of files on the remote host keyed by path (None for missing files). """
+    return self.call('hash', paths=list(paths))
+
+  def tree(self, root):
+    """ Describes every file and directory under a remote directory (see `tree` in hephaestus/agent.py).
+
+    Returns
+    ------
+    dict:
+        `files` keyed by relative path (`mode`, `owner`, `group`, `size` and `sha256`) and `dirs` keyed by relative
+        path (`mode`, `owner` and `group`), both empty if root does not exist
+    """
+    return self.call('tree', root=root)
+
+  def set_attrs(self, root, paths, owner = None, group = None):
+    """ Sets the mode (octal, None to leave it alone), owner and group of many paths relative to root at once.
+
+    Parameters
+    ----------
+    root : str
+        path to the remote directory
+    paths : dict
+        mode of each path relative to root
+    owner : str
+        user the paths belong to
+    group : str
+        group the paths belong to
+    """
+    self.call('set_attrs', root=root, paths=dict((path, str(mode) if mode != None else None) for path, mode in paths.items()),
+              owner=owner, group=group)
+
+  def signature(self, path, block_size):
+    """ Returns the size of a remote file (`size`) and the adler32 and md5 of each of its blocks (`blocks`). """
+    return self.call('signature', path=path, block_size=block_size)
+
+  def patch(self, base, delta, dest, block_size):
+    """ Writes the remote file dest from the blocks of base and a delta uploaded to the remote host (see
+    hephaestus/delta.py), removes the delta and returns the sha256 of dest. """
+    return self.call('patch', base=base, delta=delta, dest=dest, block_size=block_size)
+
+  def prune(self, root, files, dirs):
+    """ Removes remote files, then directories that are left empty (paths relative to root). """
+    self.call('prune', root=root, files=list(files), dirs=list(dirs))
+
+  def chmod(self, path, mode):
+    """ Sets the mode of a remote file, mode is in octal (i.e 644). """
+    self.call('chmod', path=path, mode=str(mode))
+
+  def chown(self, path, owner = None, group = None):
+    """ Sets the owner and/or group of a remote file. """
+    self.call('chown', path=path, owner=owner, group=group)
+
+  def remove(self, path):
+    """ Removes a remote file, returns False if it did not exist. """
+    return self.call('remove', path=path)
+
+  def rename(self, src, dest):
+    """ Renames a remote file, replacing dest atomically if it exists. """
+    self.call('rename', src=src, dest=dest)
+
+  def probe_dpkg_status(self, packages):
+    """ Queues a `dpkg-query` of apt packages (see `queue`), the next `dpkg_status` call for some of them is
+    answered by it rather than by the helper agent.
+
+    The probe tells the state of the packages when it is flushed, so modules that install or remove packages
+    drop the probes that were not used yet (`dpkg_status` key of `cache`).
+    """
+
+    pending = self.queue("dpkg-query -W -f='${Package} ${Status}\\n' %s" % (' '.join(quote(package) for package in packages)))
+    with self.queue_lock:
+      self.cache.setdefault('dpkg_status', []).append((set(packages), pending))
+
+  def dpkg_status(self, packages):
+    """ Returns the dpkg status (i.e. `install ok installed`) of apt packages keyed by package name.
+
+    Packages unknown to dpkg are left out. A probe queued for the packages (see `probe_dpkg_status`) is used,
+    once, if there is one.
+    """
+
+    probe = None
+    with self.queue_lock:
+      probes = self.cache.get('dpkg_status', [])
+      for packages_probed, pending in probes:
+        if (set(packages) <= packages_probed):
+          probes.remove((packages_probed, pending))
+          probe = pending
+          break
+    if (probe == None):
+      return self.call('dpkg_status', packages=list(packages))
+
+    # dpkg-query exits with 1 if a package is unknown, the other packages are still listed
+    stdout, stderr, status = probe.result
+    statuses = {}
+    for line in stdout:
+      fields = line.rstrip('\n').split(' ', 1)
+      if (len(fields) == 2 and fields[0] in packages):
+        statuses[fields[0]] = fields[1]
+    return statuses
+
+  def service_status(self, name):
+    """ Returns the exit status (`status`) and output (`output`) of `service <name> status`. """
+    return self.call('service_status', name=name)
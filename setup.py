@@ -2,12 +2,16 @@ from setuptools import setup
 
 setup(
     name='hephaestus',
-    scripts=['bin/hep'],
+    scripts=['bin/hep', 'bin/hepd'],
     version='0.1',
     description='Hephaestus rudimentary configuration management tool',
     url='https://github.com/olarudan/hephaestus',
     author='Dan Olaru',
     author_email='none@github.com',
     license='MIT',
-    packages=['hephaestus'],
+    packages=['hephaestus', 'hephaestus.modules'],
+    # modules of other packages are registered under the same group (see hephaestus/modules/__init__.py)
+    entry_points={'hephaestus.modules': ['apt = hephaestus.modules.apt:Apt',
+                                         'file = hephaestus.modules.file:File',
+                                         'service = hephaestus.modules.service:Service']},
     zip_safe=False)
@@ -0,0 +1,54 @@
+import grp
+import os
+import pwd
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+TESTS = os.path.join(ROOT, 'tests')
+
+sys.path.insert(0, ROOT)
+
+# load the test config (tests/config.yml) rather than parsing pytest's cli args
+from hephaestus.config import config
+config.load(['--config', os.path.join(TESTS, 'config.yml')])
+
+import sshd
+
+# owner and group of the files deployed by the tests (the user running them)
+OWNER = pwd.getpwuid(os.getuid()).pw_name
+GROUP = grp.getgrgid(os.getgid()).gr_name
+
+DEPLOY_MANIFEST = """
+- name: "Install apache2 package"
+  apt:
+    package: "apache2"
+    action: "install"
+
+- name: "Deploy index.html"
+  file: {src: "%(src)s", dest: "%(dest)s", owner: "%(owner)s", group: "%(group)s", mod: 644, action: "present"}
+"""
+
+@pytest.fixture
+def fake_hosts():
+  """ Returns a factory that starts fake ssh hosts (see tests/sshd.py) which are stopped after the test. """
+  servers = []
+
+  def start(count = 1, **kwargs):
+    hosts = [sshd.FakeSSHServer(**kwargs) for i in range(count)]
+    servers.extend(hosts)
+    return hosts
+
+  yield start
+
+  for server in servers:
+    server.stop()
+
+@pytest.fixture
+def deploy_manifest(tmpdir):
+  """ Writes tmpdir/manifest.yml, which installs apache2 and deploys tmpdir/index.html to tmpdir/dest.html (owned
+  by the user running the tests), and returns its path. index.html is left to the test. """
+  tmpdir.join('manifest.yml').write(DEPLOY_MANIFEST % {'src': tmpdir.join('index.html'),
+                                                       'dest': tmpdir.join('dest.html'), 'owner': OWNER,
+                                                       'group': GROUP})
+  return str(tmpdir.join('manifest.yml'))
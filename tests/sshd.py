@@ -0,0 +1,354 @@
+""" A local stand-in for the remote hosts hep converges.
+
+FakeSSHServer listens on a random localhost port and accepts password authenticated ssh connections. Commands
+are executed with the local `/bin/sh`, but the stubs in `tests/fakebin` (`dpkg-query`, ...) shadow the real
+programs and keep their state in the fake host's root directory, so nothing on the machine running the tests
+is touched. Files are transferred over sftp to the local filesystem. Every command waits `latency` seconds before it starts to emulate the round trip to a remote host.
+"""
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import paramiko
+
+try:
+  import queue
+except ImportError: # python 2
+  import Queue as queue
+
+class StubSFTPHandle(paramiko.SFTPHandle):
+  """ SFTP handle backed by a local file. """
+
+  def stat(self):
+    try:
+      return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+
+  def chattr(self, attr):
+    try:
+      paramiko.SFTPServer.set_file_attr(self.filename, attr)
+      return paramiko.SFTP_OK
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+
+class StubSFTPServer(paramiko.SFTPServerInterface):
+  """ SFTP server interface serving the local filesystem (remote paths are local paths). """
+
+  def __init__(self, server, *args, **kwargs):
+    paramiko.SFTPServerInterface.__init__(self, server, *args, **kwargs)
+    self.host = server.server
+
+  def session_started(self):
+    self.host.sftp_sessions += 1
+
+  def canonicalize(self, path):
+    return os.path.normpath(os.path.join('/', path))
+
+  def list_folder(self, path):
+    path = self.canonicalize(path)
+    try:
+      entries = []
+      for name in os.listdir(path):
+        attr = paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)))
+        attr.filename = name
+        entries.append(attr)
+      return entries
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+
+  def stat(self, path):
+    try:
+      return paramiko.SFTPAttributes.from_stat(os.stat(self.canonicalize(path)))
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+
+  def lstat(self, path):
+    try:
+      return paramiko.SFTPAttributes.from_stat(os.lstat(self.canonicalize(path)))
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+
+  def open(self, path, flags, attr):
+    path = self.canonicalize(path)
+    try:
+      mode = getattr(attr, 'st_mode', None) or 0o666
+      fd = os.open(path, flags, mode)
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+
+    if (flags & os.O_WRONLY):
+      fstr = 'ab' if (flags & os.O_APPEND) else 'wb'
+    elif (flags & os.O_RDWR):
+      fstr = 'a+b' if (flags & os.O_APPEND) else 'r+b'
+    else:
+      fstr = 'rb'
+    f = os.fdopen(fd, fstr)
+
+    handle = StubSFTPHandle(flags)
+    handle.filename = path
+    handle.readfile = f
+    handle.writefile = f
+    return handle
+
+  def remove(self, path):
+    try:
+      os.remove(self.canonicalize(path))
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+    return paramiko.SFTP_OK
+
+  def rename(self, oldpath, newpath):
+    try:
+      os.rename(self.canonicalize(oldpath), self.canonicalize(newpath))
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+    return paramiko.SFTP_OK
+
+  def posix_rename(self, oldpath, newpath):
+    return self.rename(oldpath, newpath)
+
+  def mkdir(self, path, attr):
+    try:
+      os.mkdir(self.canonicalize(path))
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+    return paramiko.SFTP_OK
+
+  def rmdir(self, path):
+    try:
+      os.rmdir(self.canonicalize(path))
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+    return paramiko.SFTP_OK
+
+  def chattr(self, path, attr):
+    try:
+      paramiko.SFTPServer.set_file_attr(self.canonicalize(path), attr)
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+    return paramiko.SFTP_OK
+
+FAKEBIN = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fakebin')
+HOST_KEY = paramiko.RSAKey.generate(1024)
+
+class FakeHost(paramiko.ServerInterface):
+  """ paramiko server interface that authenticates users and hands exec requests to the FakeSSHServer. """
+
+  def __init__(self, server):
+    self.server = server
+
+  def get_allowed_auths(self, username):
+    return 'password'
+
+  def check_auth_password(self, username, password):
+    if ((username, password) == (self.server.username, self.server.password)):
+      return paramiko.AUTH_SUCCESSFUL
+    return paramiko.AUTH_FAILED
+
+  def check_channel_request(self, kind, chanid):
+    if (kind == 'session'):
+      return paramiko.OPEN_SUCCEEDED
+    return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+  def check_channel_exec_request(self, channel, command):
+    thread = threading.Thread(target=self.server.exec_command, args=(channel, command))
+    thread.daemon = True
+    thread.start()
+    return True
+
+class FakeSSHServer:
+  """
+  A fake remote host reachable over ssh.
+
+  Attributes
+  ----------
+  address : str
+      `hostname:port` the server listens on, ready to be used in a hosts file
+  root : str
+      directory holding the state of the fake host (i.e. installed packages)
+  commands : list
+      every command executed on the host, in order
+  sftp_sessions : int
+      number of sftp sessions opened on the host
+  """
+
+  def __init__(self, latency = 0.0, username = 'hep', password = 'hep'):
+    self.latency = latency
+    self.username = username
+    self.password = password
+    self.root = tempfile.mkdtemp(prefix = 'hep-fake-host-')
+    self.commands = []
+    self.sftp_sessions = 0
+    self.transports = []
+
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.socket.bind(('127.0.0.1', 0))
+    self.socket.listen(128)
+    self.address = '127.0.0.1:%d' % (self.socket.getsockname()[1])
+
+    thread = threading.Thread(target=self.serve)
+    thread.daemon = True
+    thread.start()
+
+  def serve(self):
+    """ Accepts ssh connections until the server is stopped. """
+    while True:
+      try:
+        sock, address = self.socket.accept()
+      except (socket.error, OSError):
+        return
+
+      transport = paramiko.Transport(sock)
+      transport.add_server_key(HOST_KEY)
+      transport.set_subsystem_handler('sftp', paramiko.SFTPServer, StubSFTPServer)
+      transport.start_server(event=threading.Event(), server=FakeHost(self))
+      self.transports.append(transport)
+
+  def exec_command(self, channel, command):
+    """ Runs a command with the fakebin stubs first in PATH and relays its io over the channel. """
+    self.commands.append(command)
+    time.sleep(self.latency)
+
+    env = dict(os.environ)
+    env['PATH'] = os.pathsep.join([FAKEBIN, os.path.dirname(sys.executable), env.get('PATH', '')])
+    env['HEP_FAKE_ROOT'] = self.root
+    process = subprocess.Popen(['/bin/sh', '-c', command], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, cwd=self.root, env=env)
+
+    def relay_stdin():
+      while True:
+        try:
+          data = channel.recv(32768)
+          if (not data):
+            break
+          process.stdin.write(data)
+          process.stdin.flush()
+        except (IOError, OSError, socket.error):
+          break
+      try:
+        process.stdin.close()
+      except (IOError, OSError):
+        pass
+
+    def relay_output(stream, send):
+      while True:
+        data = os.read(stream.fileno(), 32768)
+        if (not data):
+          break
+        send(data)
+
+    stdin = threading.Thread(target=relay_stdin)
+    stdin.daemon = True
+    stdin.start()
+    relays = [threading.Thread(target=relay_output, args=(process.stdout, channel.sendall)),
+              threading.Thread(target=relay_output, args=(process.stderr, channel.sendall_stderr))]
+    for relay in relays:
+      relay.start()
+    for relay in relays:
+      relay.join()
+
+    channel.send_exit_status(process.wait())
+    channel.close()
+
+  def install(self, *packages):
+    """ Marks apt packages as installed on the fake host. """
+    with open(os.path.join(self.root, 'dpkg'), 'a') as f:
+      for package in packages:
+        f.write('%s\n' % (package))
+
+  def stop(self):
+    """ Stops accepting connections, drops the existing ones and removes the fake host's state. """
+    # shutdown wakes up the blocked accept(), a plain close() would leave the port listening
+    try:
+      self.socket.shutdown(socket.SHUT_RDWR)
+    except (socket.error, OSError):
+      pass
+    self.socket.close()
+    for transport in self.transports:
+      transport.close()
+    shutil.rmtree(self.root, ignore_errors=True)
+
+class DelayedLink:
+  """
+  A tcp proxy that delays the traffic going through it to emulate a high latency link.
+
+  Every chunk of data is forwarded `rtt / 2` seconds after it was received in each direction, without limiting
+  how much data can be in flight, so protocols that wait for a reply to every request slow down while pipelined
+  ones keep their throughput. If `bandwidth` (bytes per second) is set, sending a chunk also takes
+  `len(chunk) / bandwidth` seconds in each direction.
+
+  Attributes
+  ----------
+  address : str
+      `hostname:port` the proxy listens on
+  """
+
+  def __init__(self, target, rtt, bandwidth = None):
+    self.target = target.rsplit(':', 1)
+    self.delay = rtt / 2.0
+    self.bandwidth = bandwidth
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.socket.bind(('127.0.0.1', 0))
+    self.socket.listen(128)
+    self.address = '127.0.0.1:%d' % (self.socket.getsockname()[1])
+
+    thread = threading.Thread(target=self.serve)
+    thread.daemon = True
+    thread.start()
+
+  def serve(self):
+    while True:
+      try:
+        client, address = self.socket.accept()
+      except (socket.error, OSError):
+        return
+      upstream = socket.create_connection((self.target[0], int(self.target[1])))
+      for source, sink in [(client, upstream), (upstream, client)]:
+        self.forward(source, sink)
+
+  def forward(self, source, sink):
+    """ Relays data from source to sink, each chunk being sent `delay` seconds after it was received. """
+    chunks = queue.Queue()
+
+    def receive():
+      while True:
+        try:
+          data = source.recv(65536)
+        except (socket.error, OSError):
+          data = b''
+        chunks.put((time.time() + self.delay, data))
+        if (not data):
+          return
+
+    def send():
+      while True:
+        due, data = chunks.get()
+        time.sleep(max(0, due - time.time()))
+        if (self.bandwidth):
+          time.sleep(len(data) / float(self.bandwidth))
+        try:
+          if (not data):
+            sink.shutdown(socket.SHUT_WR)
+            return
+          sink.sendall(data)
+        except (socket.error, OSError):
+          return
+
+    for target in [receive, send]:
+      thread = threading.Thread(target=target)
+      thread.daemon = True
+      thread.start()
+
+  def stop(self):
+    try:
+      self.socket.shutdown(socket.SHUT_RDWR)
+    except (socket.error, OSError):
+      pass
+    self.socket.close()
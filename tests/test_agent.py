@@ -0,0 +1,75 @@
+import io
+import json
+import time
+
+from hephaestus import agent
+from hephaestus.ssh import SSH, SSHError
+
+class Responses(list):
+  """ Collects the lines written by the agent. """
+  def write(self, line):
+    self.append(line)
+
+  def flush(self):
+    pass
+
+def serve(*requests):
+  """ Feeds json requests to the agent and returns its responses. """
+  responses = Responses()
+  agent.serve(io.StringIO(u''.join(json.dumps(request) + u'\n' for request in requests)), responses)
+  return [json.loads(line) for line in responses]
+
+def test_agent_answers_each_request_in_order(tmpdir):
+  tmpdir.join('a').write('hello')
+  path = str(tmpdir.join('a'))
+
+  responses = serve({'op': 'chmod', 'args': {'path': path, 'mode': '600'}},
+                    {'op': 'stat', 'args': {'paths': [path], 'checksum': False}},
+                    {'op': 'remove', 'args': {'path': path}},
+                    {'op': 'remove', 'args': {'path': path}},
+                    {'op': 'unknown'})
+
+  assert responses[0] == {'ok': True, 'result': None}
+  assert responses[1]['result'][path]['mode'] == '600'
+  assert 'sha256' not in responses[1]['result'][path]
+  assert [response['result'] for response in responses[2:4]] == [True, False]
+  assert responses[4]['ok'] == False
+
+def test_agent_is_started_once_per_connection(tmpdir, fake_hosts):
+  """ all requests share one remote process and one channel """
+  host = fake_hosts(1)[0]
+  host.install('apache2')
+  tmpdir.join('a').write('hello')
+  ssh_client = SSH(host.address)
+  ssh_client.connect()
+
+  assert ssh_client.hash_files([str(tmpdir.join('a'))]) == {str(tmpdir.join('a')): agent.sha256(str(tmpdir.join('a')))}
+  assert ssh_client.dpkg_status(['apache2', 'php5']) == {'apache2': 'install ok installed'}
+  assert ssh_client.service_status('apache2')['output'] == ' * apache2 is running\n'
+  ssh_client.rename(str(tmpdir.join('a')), str(tmpdir.join('b')))
+  ssh_client.close()
+
+  assert tmpdir.join('b').read() == 'hello'
+  assert len(host.commands) == 1
+
+def test_hung_agent_times_out_and_is_closed(tmpdir, fake_hosts):
+  """ a request the agent never answers fails the host after `agent_timeout` and the agent is replaced """
+  host = fake_hosts(1)[0]
+  tmpdir.join('a').write('hello')
+  ssh_client = SSH(host.address)
+  ssh_client.connect()
+  ssh_client.agent_timeout = 0.5
+  python, ssh_client.python = ssh_client.python, 'sleep 30 #'
+
+  started = time.time()
+  try:
+    ssh_client.hash_files([str(tmpdir.join('a'))])
+    assert False, 'the request should time out'
+  except SSHError:
+    pass
+  assert time.time() - started < 5
+  assert ssh_client.agent_channel == None
+
+  ssh_client.python = python
+  assert ssh_client.hash_files([str(tmpdir.join('a'))]) == {str(tmpdir.join('a')): agent.sha256(str(tmpdir.join('a')))}
+  ssh_client.close()
@@ -0,0 +1,51 @@
+import os
+
+from hephaestus.ssh import SSH
+from hephaestus.modules import apt
+from hephaestus.modules.apt import Apt
+
+def apt_task(package, action = 'install'):
+  return {'name': 'Manage %s' % (package), 'apt': {'package': package, 'action': action}}
+
+def connect(host):
+  ssh_client = SSH(host.address)
+  ssh_client.connect()
+  return ssh_client
+
+def test_consecutive_installs_are_merged(fake_hosts):
+  """ one dpkg-query, one apt-get update and one apt-get install for the whole batch """
+  host = fake_hosts(1)[0]
+  host.install('apache2')
+  ssh_client = connect(host)
+  tasks = [apt_task('apache2'), apt_task('php5'), apt_task(['libapache2-mod-php5', 'php5'])]
+
+  assert Apt.execute_batch([Apt(task, ssh_client) for task in tasks]) == [False, True, True]
+  assert len(host.commands) == 3
+  assert [command for command in host.commands if 'apt-get install' in command][0].endswith('apt-get install php5 libapache2-mod-php5 -y')
+
+  # the package lists are not updated twice in the same run
+  del host.commands[:]
+  assert Apt.execute_batch([Apt(apt_task('curl'), ssh_client)]) == [True]
+  ssh_client.close()
+  assert not any('apt-get update' in command for command in host.commands)
+
+def test_install_then_remove_keeps_manifest_order(fake_hosts):
+  host = fake_hosts(1)[0]
+  ssh_client = connect(host)
+  tasks = [apt_task('php5'), apt_task('php5', 'remove'), apt_task('php5', 'remove')]
+
+  assert Apt.execute_batch([Apt(task, ssh_client) for task in tasks]) == [True, True, False]
+  ssh_client.close()
+  assert open(os.path.join(host.root, 'dpkg')).read() == ''
+
+def test_fresh_package_lists_are_not_updated(fake_hosts, tmpdir, monkeypatch):
+  """ with cache_valid_time set, apt-get update only runs if the package lists are too old """
+  host = fake_hosts(1)[0]
+  monkeypatch.setattr(apt, 'APT_LISTS', str(tmpdir))
+  ssh_client = connect(host)
+  task = Apt(apt_task('php5'), ssh_client)
+  task.cache_valid_time = 3600
+
+  assert task.execute_action() == True
+  ssh_client.close()
+  assert not any('apt-get update' in command for command in host.commands)
@@ -1,8 +1,21 @@
 import pytest
 
-from hephaestus.config import Config
+from hephaestus.config import Config, LazyConfig
 
 def test_config_without_manifest_file():
   """ The program will throw and exception if the configuration file is misconfigured """
   with pytest.raises(Exception):
-    test_config = Config("examples/config/bad.config.yml") 
+    test_config = Config("examples/config/bad.config.yml", argv = [])
+
+def test_config_built_from_code():
+  """ the config can be built from a dict, the defaults are applied and the cli arguments still override it """
+  config = LazyConfig()
+  assert not config.loaded()
+
+  config.use({'ssh': {}, 'manifest': 'manifest.yml', 'hosts': 'hosts', 'log_level': 'ERROR'}, ['--forks', '20'])
+
+  assert config['forks'] == 20
+  assert config['task_concurrency'] == 1
+  assert config.get('converge_cache') == None
+  with pytest.raises(Exception):
+    config.use({'ssh': {}, 'manifest': 'manifest.yml', 'hosts': 'hosts', 'log_level': 'ERROR', 'forks': 0})
@@ -0,0 +1,100 @@
+import json
+import os
+
+from hephaestus.config import config
+from hephaestus.convergence import ConvergenceCache
+from hephaestus.events import EventStream
+from hephaestus.plan import compile
+from hephaestus.ssh import SSH
+from hephaestus.task_runner import TaskRunner
+
+class Events:
+  """ A sink keeping the events written to it. """
+
+  def __init__(self, events):
+    self.events = events
+
+  def write(self, event):
+    self.events.append(event)
+
+  def flush(self):
+    pass
+
+  def close(self):
+    pass
+
+def use_manifest(tmpdir, monkeypatch, host, manifest):
+  """ Writes tmpdir/index.html, enables the convergence cache and returns a function running the manifest. """
+  tmpdir.join('index.html').write('hello')
+  monkeypatch.setitem(config, 'converge_cache', str(tmpdir.join('converged.json')))
+  return lambda: TaskRunner(manifest, [host.address]).run()[host.address]
+
+def test_unchanged_host_is_skipped_after_a_single_probe(tmpdir, monkeypatch, fake_hosts, deploy_manifest):
+  host = fake_hosts(1)[0]
+  run = use_manifest(tmpdir, monkeypatch, host, deploy_manifest)
+
+  assert run()['changed'] == 2
+  commands = len(host.commands)
+  assert run() == {'ok': 2, 'changed': 0, 'failed': False, 'error': None}
+  assert len(host.commands) == commands + 1
+
+def test_changes_are_noticed(tmpdir, monkeypatch, fake_hosts, deploy_manifest):
+  """ a new src file, a dest file changed on the host or --force make the host run again """
+  host = fake_hosts(1)[0]
+  run = use_manifest(tmpdir, monkeypatch, host, deploy_manifest)
+  run()
+
+  tmpdir.join('index.html').write('hello world')
+  assert run()['changed'] == 1
+
+  os.chmod(str(tmpdir.join('dest.html')), 0o600)
+  assert run()['changed'] == 1
+
+  commands = len(host.commands)
+  monkeypatch.setitem(config, 'force', True)
+  assert run() == {'ok': 2, 'changed': 0, 'failed': False, 'error': None}
+  assert len(host.commands) > commands + 1
+
+def test_probe_shares_the_round_trip_of_queued_probes(tmpdir, fake_hosts, deploy_manifest):
+  """ the fingerprint probe is sent with the read-only probes already queued on the connection """
+  host = fake_hosts(1)[0]
+  tmpdir.join('index.html').write('hello')
+  plan = compile(deploy_manifest)
+  ssh_client = SSH(host.address)
+  ssh_client.connect()
+
+  commands = len(host.commands)
+  queued = ssh_client.queue('echo queued')
+  assert ConvergenceCache(str(tmpdir.join('converged.json'))).fingerprint(plan, ssh_client) != None
+  assert queued.value == (['queued\n'], [], 0)
+  ssh_client.close()
+  assert len(host.commands) == commands + 1
+
+def test_skipped_host_is_done_and_journaled(tmpdir, monkeypatch, fake_hosts, deploy_manifest):
+  """ a host skipped by the convergence cache finishes like any other host: `host_done` and a journal entry """
+  host = fake_hosts(1)[0]
+  run = use_manifest(tmpdir, monkeypatch, host, deploy_manifest)
+  monkeypatch.setitem(config, 'journal', str(tmpdir.join('journal')))
+  run()
+
+  events = []
+  runner = TaskRunner(deploy_manifest, [host.address])
+  runner.events = EventStream([Events(events)])
+  assert runner.run()[host.address] == {'ok': 2, 'changed': 0, 'failed': False, 'error': None}
+
+  assert [event['event'] for event in events if event['event'].startswith('host_')] == ['host_connect', 'host_skip',
+                                                                                        'host_done']
+  entries = [json.loads(line) for line in tmpdir.join('journal').listdir()[0].readlines()]
+  assert entries[-1]['host'] == host.address and entries[-1]['result']['ok'] == 2
+
+def test_probes_of_the_host_share_a_round_trip(tmpdir, monkeypatch, fake_hosts, deploy_manifest):
+  """ the fingerprint, dpkg status and apt lists probes are queued when the host is connected to and sent together """
+  host = fake_hosts(1)[0]
+  run = use_manifest(tmpdir, monkeypatch, host, deploy_manifest)
+  monkeypatch.setitem(config, 'apt', {'cache_valid_time': 3600})
+
+  commands = len(host.commands)
+  assert run()['changed'] == 2
+  probes = [command for command in host.commands[commands:] if 'dpkg-query' in command or 'stat -' in command]
+  assert len(probes) == 2 # the probes of the host, then the fingerprint once the host converged
+  assert 'dpkg-query' in probes[0] and 'stat -L' in probes[0] and 'date +%s' in probes[0]
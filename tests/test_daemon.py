@@ -0,0 +1,134 @@
+import os
+import stat
+import threading
+import time
+
+from hephaestus.daemon import Daemon, submit
+
+MANIFEST = """
+- name: "Install apache2 package"
+  apt:
+    package: "apache2"
+    action: "install"
+
+- name: "Restart apache2"
+  service:
+    name: "apache2"
+    action: "restart"
+"""
+
+def start_daemon(tmpdir, hosts):
+  """ Starts a daemon listening on a socket in tmpdir, returns it with the path of the manifest. """
+  tmpdir.join('manifest.yml').write(MANIFEST)
+  daemon = Daemon(str(tmpdir.join('hepd.sock')), hosts)
+  daemon.warm_up()
+  thread = threading.Thread(target=daemon.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return daemon, str(tmpdir.join('manifest.yml'))
+
+def run(daemon, manifest, hosts):
+  """ Submits the manifest to the daemon and returns the events it streamed back. """
+  return list(submit(daemon.socket_path, manifest, hosts))
+
+def test_runs_reuse_warm_connections(tmpdir, fake_hosts):
+  """ The connections are opened once when the daemon starts and reused by every run """
+  hosts = fake_hosts(2)
+  for host in hosts:
+    host.install('apache2')
+  addresses = [host.address for host in hosts]
+  daemon, manifest = start_daemon(tmpdir, addresses)
+
+  try:
+    for i in range(3):
+      events = run(daemon, manifest, addresses)
+      assert [event['event'] for event in events].count('task_result') == 4
+      assert events[-1]['event'] == 'done'
+      for address in addresses:
+        assert events[-1]['results'][address] == {'ok': 1, 'changed': 1, 'failed': False, 'error': None}
+  finally:
+    daemon.shutdown()
+
+  for host in hosts:
+    assert len(host.transports) == 1
+  assert not os.path.exists(daemon.socket_path)
+
+def test_reconnects_dropped_connections(tmpdir, fake_hosts):
+  """ A connection closed by the host is reopened by the next run """
+  host = fake_hosts(1)[0]
+  host.install('apache2')
+  daemon, manifest = start_daemon(tmpdir, [host.address])
+
+  try:
+    host.transports[0].close()
+    deadline = time.time() + 5
+    while (daemon.connections[host.address].is_active() and time.time() < deadline):
+      time.sleep(0.05)
+    events = run(daemon, manifest, [host.address])
+  finally:
+    daemon.shutdown()
+
+  assert events[-1]['results'][host.address]['failed'] == False
+  assert len(host.transports) == 2
+
+def test_rejects_relative_local_files(tmpdir, fake_hosts):
+  """ The daemon does not run from the client's directory, a relative src fails the request before any host is
+  contacted """
+  host = fake_hosts(1)[0]
+  daemon, manifest = start_daemon(tmpdir, [host.address])
+  tmpdir.join('relative.yml').write('- name: "Deploy index.html"\n  file:\n    src: "index.html"\n    dest: "/var/www/index.html"\n'
+                                    '    owner: "root"\n    group: "root"\n    mod: 644\n    action: "present"\n')
+
+  try:
+    commands = len(host.commands)
+    events = run(daemon, str(tmpdir.join('relative.yml')), [host.address])
+  finally:
+    daemon.shutdown()
+
+  assert [event['event'] for event in events] == ['error']
+  assert 'relative path `index.html`' in events[0]['error']
+  assert len(host.commands) == commands
+
+def test_client_options_apply_to_the_run(tmpdir, fake_hosts):
+  """ the run options and the variables of the hosts are the client's, not the daemon's """
+  hosts = fake_hosts(2)
+  for host in hosts:
+    host.install('apache2')
+  addresses = [host.address for host in hosts]
+  daemon, manifest = start_daemon(tmpdir, addresses)
+  tmpdir.join('templated.yml').write('- name: "Restart the web server"\n  service:\n    name: "${server}"\n    action: "restart"\n')
+  options = {'forks': 1, 'task_concurrency': 2, 'serial': 1, 'max_fail_percentage': 0, 'force': True,
+             'prestage': False, 'prestage_concurrency': None}
+
+  try:
+    events = list(submit(daemon.socket_path, str(tmpdir.join('templated.yml')), addresses, options=options,
+                         variables=dict((address, {'server': 'apache2'}) for address in addresses)))
+  finally:
+    daemon.shutdown()
+
+  assert events[0]['event'] == 'run_start' and events[0]['forks'] == 1
+  assert events[-1]['event'] == 'done'
+  for address in addresses:
+    assert events[-1]['results'][address] == {'ok': 0, 'changed': 1, 'failed': False, 'error': None}
+
+def test_rejects_options_it_can_not_honour(tmpdir, fake_hosts):
+  host = fake_hosts(1)[0]
+  daemon, manifest = start_daemon(tmpdir, [host.address])
+
+  try:
+    resumed = list(submit(daemon.socket_path, manifest, [host.address], options={'resume': True}))
+    local = list(submit(daemon.socket_path, manifest, [host.address], options={'transport': 'local'}))
+  finally:
+    daemon.shutdown()
+
+  assert [event['event'] for event in resumed] == ['error'] and '--resume' in resumed[0]['error']
+  assert [event['event'] for event in local] == ['error'] and '--transport local' in local[0]['error']
+
+def test_socket_is_private(tmpdir, fake_hosts):
+  """ only the user running the daemon can connect to the socket """
+  host = fake_hosts(1)[0]
+  daemon, manifest = start_daemon(tmpdir, [host.address])
+  try:
+    assert stat.S_IMODE(os.stat(daemon.socket_path).st_mode) == 0o600
+  finally:
+    daemon.shutdown()
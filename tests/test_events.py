@@ -0,0 +1,98 @@
+import grp
+import io
+import json
+import os
+import pwd
+import threading
+import time
+
+from hephaestus.events import EventStream, Human, JsonLines, event
+from hephaestus.task_runner import TaskRunner
+
+OWNER = pwd.getpwuid(os.getuid()).pw_name
+GROUP = grp.getgrgid(os.getgid()).gr_name
+
+MANIFEST = """
+- name: "Deploy the index"
+  file:
+    src: "%(src)s"
+    dest: "%(dest)s"
+    owner: "%(owner)s"
+    group: "%(group)s"
+    mod: 644
+    action: "present"
+"""
+
+class Lines:
+  """ A text stream keeping the lines written to it. """
+
+  def __init__(self):
+    self.text = ''
+
+  def write(self, text):
+    self.text += text
+
+  def flush(self):
+    pass
+
+def run(tmpdir, src):
+  tmpdir.join('manifest.yaml').write(MANIFEST % {'src': src, 'dest': tmpdir.join('index.html'), 'owner': OWNER,
+                                                 'group': GROUP})
+  runner = TaskRunner(str(tmpdir.join('manifest.yaml')), ['local://web1'])
+  stream = Lines()
+  runner.events = EventStream([JsonLines(stream)])
+  results = runner.run()
+  return results, [json.loads(line) for line in stream.text.splitlines()]
+
+def test_runs_stream_typed_json_lines(tmpdir):
+  tmpdir.join('index.html.src').write('hello')
+  results, events = run(tmpdir, tmpdir.join('index.html.src'))
+
+  assert [e['event'] for e in events] == ['run_start', 'host_connect', 'task_start', 'task_result', 'host_done',
+                                          'run_summary']
+  assert events[3]['status'] == 'changed' and events[3]['task'] == 'Deploy the index' and events[3]['seconds'] >= 0
+  assert events[4]['changed'] == 1 and not events[4]['failed']
+  assert events[5]['results'] == [dict(results['local://web1'], host='local://web1')]
+  assert events[5]['dropped'] == 0
+
+def test_failed_tasks_are_reported(tmpdir):
+  results, events = run(tmpdir, tmpdir.join('missing'))
+
+  assert results['local://web1']['failed']
+  [task] = [e for e in events if e['event'] == 'task_result']
+  assert task['status'] == 'failed' and task['error']
+  assert [e for e in events if e['event'] == 'host_done'][0]['failed']
+
+def test_workers_never_wait_on_a_slow_sink():
+  """ events are dropped (and counted) rather than blocking the workers when the writer can't keep up """
+  release = threading.Event()
+  written = []
+
+  class Slow:
+    def write(self, item):
+      release.wait()
+      written.append(item)
+    def flush(self):
+      pass
+    def close(self):
+      pass
+
+  events = EventStream([Slow()], queue_size=2)
+  events.start()
+  started = time.time()
+  for i in range(10):
+    events.emit('task_start', host='web1', module='apt', task=str(i))
+  assert time.time() - started < 1
+  assert events.dropped >= 7
+
+  release.set()
+  events.close()
+  assert len(written) + events.dropped == 10
+
+def test_human_rendering():
+  human = Human(io.StringIO())
+  assert human.render(event('task_start', host='web1', module='apt', task='Install')) == None
+  assert human.render(event('task_result', host='web1', module='apt', task='Install', status='ok', seconds=0.1)) == 'TASK(apt module - [ web1 ]): Install: NO CHANGE'
+  assert human.render(event('host_skip', host='web1', reason='unchanged')) == 'HOST [ web1 ]: UNCHANGED since the last successful run, skipping'
+  assert human.render(event('run_summary', results=[{'host': 'web1', 'ok': 1, 'changed': 0, 'failed': True, 'error': 'boom'}],
+                            seconds=1, dropped=0)) == 'HOSTS:\nweb1 : ok=1 changed=0 failed=True (boom)'
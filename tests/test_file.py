@@ -0,0 +1,176 @@
+import grp
+import os
+import pwd
+
+import pytest
+
+from hephaestus.ssh import SSH, SSHError
+from hephaestus.stats import HostStats
+from hephaestus.modules.file import File
+
+OWNER = pwd.getpwuid(os.getuid()).pw_name
+GROUP = grp.getgrgid(os.getgid()).gr_name
+
+def file_task(src, dest, action = 'present', mod = 640):
+  return {'name': 'Deploy %s' % (dest), 'file': {'src': src, 'dest': dest, 'owner': OWNER, 'group': GROUP,
+                                                 'mod': mod, 'action': action}}
+
+def connect(host):
+  ssh_client = SSH(host.address)
+  ssh_client.connect()
+  return ssh_client
+
+def test_stat_files_describes_every_path(tmpdir, fake_hosts):
+  """ existence, mode, owner, group, size and hash of several files come from a single agent request """
+  host = fake_hosts(1)[0]
+  tmpdir.join('a').write('hello')
+  os.chmod(str(tmpdir.join('a')), 0o640)
+  ssh_client = connect(host)
+
+  stats = ssh_client.stat_files([str(tmpdir.join('a')), str(tmpdir.join('missing'))])
+  ssh_client.close()
+
+  assert len(host.commands) == 1
+  assert stats[str(tmpdir.join('missing'))] == {'exists': False}
+  assert stats[str(tmpdir.join('a'))] == {'exists': True, 'mode': '640', 'owner': OWNER, 'group': GROUP, 'size': 5,
+                                          'sha256': '2cf24dba5fb0a30e26e83b2ac5b9e29e1b161e5c1fa7425e73043362938b9824'}
+
+def test_execute_batch_is_idempotent(tmpdir, fake_hosts):
+  """ files are created with the right mode on the first run and left alone on the second one """
+  host = fake_hosts(1)[0]
+  tmpdir.join('src').write('content')
+  tasks = [file_task(str(tmpdir.join('src')), str(tmpdir.join('dest%d' % (i)))) for i in range(3)]
+  ssh_client = connect(host)
+
+  assert File.execute_batch([File(task, ssh_client) for task in tasks]) == [True, True, True]
+  for i in range(3):
+    assert tmpdir.join('dest%d' % (i)).read() == 'content'
+    assert oct(os.stat(str(tmpdir.join('dest%d' % (i)))).st_mode & 0o777)[-3:] == '640'
+
+  assert File.execute_batch([File(task, ssh_client) for task in tasks]) == [False, False, False]
+  ssh_client.close()
+
+  # every check went through the helper agent started by the first run
+  assert len(host.commands) == 1
+
+def test_changed_file_is_replaced_atomically(tmpdir, fake_hosts):
+  """ only a file whose content changed is uploaded, through a temporary file next to dest """
+  host = fake_hosts(1)[0]
+  tmpdir.join('src').write('new content')
+  tmpdir.join('dest').write('old content')
+  os.chmod(str(tmpdir.join('dest')), 0o640)
+  ssh_client = connect(host)
+
+  assert File(file_task(str(tmpdir.join('src')), str(tmpdir.join('dest'))), ssh_client).execute_action() == True
+  ssh_client.close()
+
+  assert tmpdir.join('dest').read() == 'new content'
+  assert sorted(os.listdir(str(tmpdir))) == ['dest', 'src']
+
+def test_failed_upload_leaves_no_temporary_file(tmpdir, fake_hosts):
+  """ the temporary file is removed when setting its owner fails, and dest is left untouched """
+  host = fake_hosts(1)[0]
+  tmpdir.join('src').write('new content')
+  tmpdir.join('dest').write('old content')
+  task = file_task(str(tmpdir.join('src')), str(tmpdir.join('dest')))
+  task['file']['owner'] = 'no-such-user-hep'
+  ssh_client = connect(host)
+
+  with pytest.raises(Exception):
+    File(task, ssh_client).execute_action()
+  ssh_client.close()
+
+  assert tmpdir.join('dest').read() == 'old content'
+  assert sorted(os.listdir(str(tmpdir))) == ['dest', 'src']
+
+def test_absent_removes_existing_file(tmpdir, fake_hosts):
+  host = fake_hosts(1)[0]
+  tmpdir.join('dest').write('content')
+  ssh_client = connect(host)
+  task = file_task(str(tmpdir.join('src')), str(tmpdir.join('dest')), action = 'absent')
+
+  assert File(task, ssh_client).execute_action() == True
+  assert not tmpdir.join('dest').exists()
+  assert File(task, ssh_client).execute_action() == False
+  ssh_client.close()
+
+def test_sync_sends_only_the_changes_of_a_tree(tmpdir, fake_hosts):
+  """ a directory is synced with one tree request, one tar stream and one request setting the attributes """
+  host = fake_hosts(1)[0]
+  src = tmpdir.mkdir('src')
+  for i in range(50):
+    src.join('static', 'file%d.txt' % (i)).write('file %d' % (i), ensure = True)
+  src.join('index.php').write('<?php echo "hello";')
+  src.mkdir('empty')
+  dest = tmpdir.join('dest')
+  task = {'name': 'Deploy app', 'file': {'src': str(src), 'dest': str(dest), 'owner': OWNER, 'group': GROUP,
+                                         'mod': 640, 'action': 'sync', 'delete': True}}
+  ssh_client = connect(host)
+  ssh_client.stats = HostStats()
+
+  assert File(task, ssh_client).execute_action()
+  assert dest.join('static', 'file7.txt').read() == 'file 7'
+  assert dest.join('empty').isdir()
+  assert oct(os.stat(str(dest.join('index.php'))).st_mode & 0o777)[-3:] == '640'
+  # the helper agent and the tar stream
+  assert len(host.commands) == 2
+  assert ssh_client.stats.counters['agent_calls'] == 2
+
+  assert not File(task, ssh_client).execute_action()
+  assert len(host.commands) == 2
+
+  # one changed file, one new file and one extraneous file
+  src.join('index.php').write('<?php echo "hello world";')
+  src.join('new.txt').write('new')
+  dest.join('static', 'stale.txt').write('stale')
+  sent = ssh_client.stats.counters['bytes_sent']
+  assert File(task, ssh_client).execute_action()
+  ssh_client.close()
+
+  assert dest.join('index.php').read() == '<?php echo "hello world";'
+  assert dest.join('new.txt').read() == 'new'
+  assert not dest.join('static', 'stale.txt').exists()
+  assert len(host.commands) == 3
+  assert ssh_client.stats.counters['bytes_sent'] - sent < 16 * 1024
+
+def test_large_changed_file_is_sent_as_a_delta(tmpdir, fake_hosts):
+  """ only the changed bytes of a large file cross the network, the remote host rebuilds the rest """
+  host = fake_hosts(1)[0]
+  data = os.urandom(8 * 1024 * 1024)
+  tmpdir.join('dest').write(data, mode = 'wb')
+  os.chmod(str(tmpdir.join('dest')), 0o640)
+  # a few records appended, a few bytes inserted and a block overwritten in the middle
+  changed = data[:1000000] + b'inserted' + data[1000000:4000000] + os.urandom(4096) + data[4004096:] + os.urandom(64 * 1024)
+  tmpdir.join('src').write(changed, mode = 'wb')
+  ssh_client = connect(host)
+  ssh_client.stats = HostStats()
+
+  assert File(file_task(str(tmpdir.join('src')), str(tmpdir.join('dest'))), ssh_client).execute_action()
+  ssh_client.close()
+
+  assert tmpdir.join('dest').read(mode = 'rb') == changed
+  assert oct(os.stat(str(tmpdir.join('dest'))).st_mode & 0o777)[-3:] == '640'
+  assert ssh_client.stats.counters['bytes_sent'] < 200 * 1024
+  assert sorted(path.basename for path in tmpdir.listdir()) == ['dest', 'src']
+
+def test_failed_delta_leaves_no_temporary_file(tmpdir, fake_hosts):
+  """ the uploaded delta is removed when the remote host fails to rebuild the file from it """
+  host = fake_hosts(1)[0]
+  data = os.urandom(2 * 1024 * 1024)
+  tmpdir.join('dest').write(data, mode = 'wb')
+  tmpdir.join('src').write(data[:-10] + b'0123456789', mode = 'wb')
+  ssh_client = connect(host)
+  deltas = []
+
+  def patch(base, delta, dest, block_size):
+    deltas.append(os.path.exists(delta))
+    raise SSHError('the helper agent died')
+  ssh_client.patch = patch
+
+  with pytest.raises(SSHError):
+    File(file_task(str(tmpdir.join('src')), str(tmpdir.join('dest'))), ssh_client).execute_action()
+  ssh_client.close()
+
+  assert deltas == [True]
+  assert tmpdir.join('dest').read(mode = 'rb') == data
+  assert sorted(os.listdir(str(tmpdir))) == ['dest', 'src']
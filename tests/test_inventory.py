@@ -0,0 +1,60 @@
+import pytest
+
+from hephaestus.config import config
+from hephaestus.inventory import Inventory, expand, load
+
+HOSTS = """
+# hosts before the first group
+10.0.0.1
+
+local://build   # the control node
+
+[web]
+web[001:003].example.com
+web-canary.example.com:2222
+
+[db]
+db[a:b]-[1:2]
+10.0.0.1
+
+[prod:children]
+web
+db
+"""
+
+def inventory(tmpdir, content = HOSTS):
+  tmpdir.join('hosts').write(content)
+  return Inventory(str(tmpdir.join('hosts')))
+
+def test_ranges_expand_on_demand():
+  assert list(expand('web[08:10]')) == ['web08', 'web09', 'web10']
+  assert list(expand('db[a:b]-[1:2]')) == ['dba-1', 'dba-2', 'dbb-1', 'dbb-2']
+  assert list(expand('10.0.0.1:2222')) == ['10.0.0.1:2222']
+
+  # a huge range costs nothing until its hosts are read
+  hosts = expand('node[0000001:9999999]')
+  assert next(hosts) == 'node0000001'
+
+def test_blank_lines_comments_and_duplicates_are_skipped(tmpdir):
+  assert list(inventory(tmpdir).hosts()) == ['10.0.0.1', 'local://build', 'web001.example.com', 'web002.example.com',
+                                             'web003.example.com', 'web-canary.example.com:2222', 'dba-1', 'dba-2',
+                                             'dbb-1', 'dbb-2']
+
+@pytest.mark.parametrize('limit, expected', [
+  ('web', ['web001.example.com', 'web002.example.com', 'web003.example.com', 'web-canary.example.com:2222']),
+  ('prod,!web*', ['dba-1', 'dba-2', 'dbb-1', 'dbb-2', '10.0.0.1']),
+  ('web00[13]*,local://*', ['local://build', 'web001.example.com', 'web003.example.com']),
+  ('~-2$,10.0.0.1', ['10.0.0.1', 'dba-2', 'dbb-2']),
+  ('all,!prod', ['10.0.0.1', 'local://build']),
+  ('missing', []),
+])
+def test_limit_selects_hosts_before_connecting(tmpdir, limit, expected):
+  assert list(inventory(tmpdir).hosts(limit)) == expected
+
+def test_load_uses_the_config_limit(tmpdir, monkeypatch):
+  tmpdir.join('hosts').write(HOSTS)
+  monkeypatch.setitem(config, 'hosts', str(tmpdir.join('hosts')))
+  monkeypatch.setitem(config, 'limit', 'db')
+
+  assert load() == ['dba-1', 'dba-2', 'dbb-1', 'dbb-2', '10.0.0.1']
+  assert len(load(limit='')) == 10
@@ -0,0 +1,55 @@
+import json
+
+from hephaestus.config import config
+from hephaestus.task_runner import TaskRunner
+
+def test_resume_skips_completed_work(tmpdir, monkeypatch, fake_hosts, deploy_manifest):
+  """ an interrupted run is resumed where it stopped: completed tasks and hosts are not run again """
+  host = fake_hosts(1)[0]
+  monkeypatch.setitem(config, 'journal', str(tmpdir.join('journal')))
+  run = lambda: TaskRunner(deploy_manifest, [host.address]).run()[host.address]
+
+  # the src file is missing, the apt task succeeds and the file task fails
+  assert run()['failed']
+  [journal] = tmpdir.join('journal').listdir()
+  entries = [json.loads(line) for line in journal.readlines()]
+  assert [entry.get('task') for entry in entries] == [None, 'Install apache2 package']
+
+  tmpdir.join('index.html').write('hello')
+  monkeypatch.setitem(config, 'resume', True)
+  commands = len(host.commands)
+  assert run() == {'ok': 0, 'changed': 2, 'failed': False, 'error': None}
+  assert not [command for command in host.commands[commands:] if 'dpkg-query' in command or 'apt-get' in command]
+  assert tmpdir.join('dest.html').read() == 'hello'
+
+  # the manifest succeeded on the host, it is not contacted again
+  transports = len(host.transports)
+  assert run() == {'ok': 0, 'changed': 2, 'failed': False, 'error': None}
+  assert len(host.transports) == transports
+
+  # without --resume the run starts over, the journal is only appended to
+  monkeypatch.setitem(config, 'resume', False)
+  lines = journal.readlines()
+  assert run() == {'ok': 2, 'changed': 0, 'failed': False, 'error': None}
+  assert len(host.transports) == transports + 1
+  assert journal.readlines()[:len(lines)] == lines
+
+def test_manifests_have_their_own_journal(tmpdir, monkeypatch, fake_hosts, deploy_manifest):
+  """ a run of another manifest does not touch the journal an interrupted run is resumed from """
+  host = fake_hosts(1)[0]
+  monkeypatch.setitem(config, 'journal', str(tmpdir.join('journal')))
+  assert TaskRunner(deploy_manifest, [host.address]).run()[host.address]['failed']
+  [journal] = tmpdir.join('journal').listdir()
+  lines = journal.readlines()
+
+  tmpdir.join('other.yml').write('- name: "Install php"\n  apt:\n    package: "php"\n    action: "install"\n')
+  assert not TaskRunner(str(tmpdir.join('other.yml')), [host.address]).run()[host.address]['failed']
+  assert len(tmpdir.join('journal').listdir()) == 2
+  assert journal.readlines() == lines
+
+  tmpdir.join('index.html').write('hello')
+  monkeypatch.setitem(config, 'resume', True)
+  commands = len(host.commands)
+  assert TaskRunner(deploy_manifest, [host.address]).run()[host.address] == {'ok': 0, 'changed': 2, 'failed': False,
+                                                                             'error': None}
+  assert not [command for command in host.commands[commands:] if 'apt-get' in command]
@@ -0,0 +1,113 @@
+import grp
+import os
+import pwd
+import sys
+
+import pytest
+import sshd
+
+from hephaestus.config import config
+from hephaestus.local import Local
+from hephaestus.modules.apt import Apt
+from hephaestus.modules.file import File
+from hephaestus.modules.service import Service
+from hephaestus.task_runner import TaskRunner
+from hephaestus.transport import TransportError, for_host
+
+OWNER = pwd.getpwuid(os.getuid()).pw_name
+GROUP = grp.getgrgid(os.getgid()).gr_name
+
+MANIFEST = """
+- name: "Install apache2 package"
+  apt:
+    package: "apache2"
+    action: "install"
+
+- name: "Deploy the index"
+  file:
+    src: "%(src)s"
+    dest: "%(dest)s"
+    owner: "%(owner)s"
+    group: "%(group)s"
+    mod: 644
+    action: "present"
+  notify: "Restart the apache2 service"
+
+- name: "Restart the apache2 service"
+  handler: true
+  service:
+    name: "apache2"
+    action: "restart"
+"""
+
+@pytest.fixture
+def root(tmpdir, monkeypatch):
+  """ Puts the fakebin stubs (see tests/sshd.py) first in PATH, keeping their state in a temporary directory. """
+  tmpdir.mkdir('root')
+  monkeypatch.setenv('PATH', os.pathsep.join([sshd.FAKEBIN, os.path.dirname(sys.executable), os.environ.get('PATH', '')]))
+  monkeypatch.setenv('HEP_FAKE_ROOT', str(tmpdir.join('root')))
+  return tmpdir.join('root')
+
+def test_hosts_pick_their_transport(monkeypatch):
+  assert isinstance(for_host('local://build'), Local)
+  assert for_host('local://build').hostname == 'build'
+  assert for_host('local://').hostname == 'localhost'
+
+  monkeypatch.setitem(config, 'transport', 'local')
+  assert isinstance(for_host('10.0.0.1'), Local)
+
+  with pytest.raises(TransportError):
+    for_host('telnet://10.0.0.1')
+
+def test_commands_and_copies(tmpdir, root):
+  local = Local('localhost')
+  local.connect()
+  lines = []
+
+  assert local.execute('echo one; echo two >&2', on_line=lambda name, line: lines.append((name, line))) == (['one\n'], ['two\n'])
+  assert sorted(lines) == [('stderr', 'two\n'), ('stdout', 'one\n')]
+  assert local.execute_many(['echo a', 'exit 3']) == [(['a\n'], [], 0), ([], [], 3)]
+  with pytest.raises(TransportError):
+    local.execute('exit 1')
+
+  tmpdir.join('big').write(os.urandom(3 * 1024 * 1024), 'wb')
+  local.copy_file(str(tmpdir.join('big')), str(tmpdir.join('copy')))
+  assert tmpdir.join('copy').read('rb') == tmpdir.join('big').read('rb')
+  local.close()
+
+def test_modules_run_unchanged_on_the_local_transport(tmpdir, root):
+  """ apt, file and service tasks converge the control node itself, the helper agent is a child process """
+  tmpdir.join('src').write('content')
+  tmpdir.mkdir('tree').join('a').write('a')
+  local = Local('localhost')
+  local.connect()
+
+  assert Apt.execute_batch([Apt({'name': 'apache2', 'apt': {'package': 'apache2', 'action': 'install'}}, local)]) == [True]
+  assert root.join('dpkg').read() == 'apache2\n'
+
+  present = {'name': 'index', 'file': {'src': str(tmpdir.join('src')), 'dest': str(tmpdir.join('dest')), 'owner': OWNER,
+                                      'group': GROUP, 'mod': 640, 'action': 'present'}}
+  sync = {'name': 'tree', 'file': {'src': str(tmpdir.join('tree')), 'dest': str(tmpdir.join('copy')), 'owner': OWNER,
+                                   'group': GROUP, 'action': 'sync'}}
+  assert File.execute_batch([File(present, local), File(sync, local)]) == [True, True]
+  assert File.execute_batch([File(present, local), File(sync, local)]) == [False, False]
+  assert tmpdir.join('dest').read() == 'content'
+  assert tmpdir.join('copy').join('a').read() == 'a'
+
+  assert Service({'name': 'restart', 'service': {'name': 'apache2', 'action': 'restart'}}, local).execute_action() == True
+  assert root.join('restarts').read() == 'apache2\n'
+  local.close()
+
+def test_task_runner_runs_local_hosts_without_ssh(tmpdir, monkeypatch, root):
+  tmpdir.join('src').write('content')
+  tmpdir.join('manifest.yml').write(MANIFEST % {'src': tmpdir.join('src'), 'dest': tmpdir.join('dest'), 'owner': OWNER,
+                                               'group': GROUP})
+  tmpdir.join('hosts').write('local://build\n')
+  monkeypatch.setitem(config, 'manifest', str(tmpdir.join('manifest.yml')))
+  monkeypatch.setitem(config, 'hosts', str(tmpdir.join('hosts')))
+
+  results = TaskRunner().run()
+
+  assert results['local://build'] == {'ok': 0, 'changed': 3, 'failed': False, 'error': None}
+  assert tmpdir.join('dest').read() == 'content'
+  assert root.join('restarts').read() == 'apache2\n'
@@ -0,0 +1,199 @@
+import os
+import pytest
+import subprocess
+import sys
+import yaml
+
+import hephaestus.plan
+from hephaestus.config import config
+from hephaestus.plan import Plan, compile, module_name
+from hephaestus.task_runner import TaskRunner
+
+MANIFEST = """
+- name: "Install apache2 package"
+  apt:
+    package: "apache2"
+    action: "install"
+
+- apt:
+    package: ["php5", "libapache2-mod-php5"]
+    action: "install"
+  name: "Install php packages"
+
+- name: "Restart the apache2 service"
+  service:
+    name: "apache2"
+    action: "restart"
+"""
+
+INVALID = """
+- name: "Install apache2 package"
+  apt:
+    package: "apache2"
+    action: "upgrade"
+
+- name: "Deploy PHP app"
+  file:
+    dest: "/var/www/html/index.php"
+    action: "present"
+
+- name: "Unknown module"
+  cron:
+    action: "present"
+"""
+
+def test_plan_resolves_modules_once(tmpdir):
+  """ tasks are validated, normalized and grouped by module no matter where the module key is """
+  tmpdir.join('manifest.yml').write(MANIFEST)
+
+  plan = compile(str(tmpdir.join('manifest.yml')))
+
+  assert [(module, cls.__name__, len(tasks)) for module, cls, tasks in plan.batches] == [('apt', 'Apt', 2), ('service', 'Service', 1)]
+  assert plan.tasks[0]['apt']['package'] == ['apache2']
+  assert module_name(plan.tasks[1]) == 'apt'
+  assert compile(str(tmpdir.join('manifest.yml'))) is plan
+
+def test_invalid_manifest_fails_before_connecting(tmpdir, fake_hosts):
+  """ every invalid task is reported at once and no host is contacted """
+  host = fake_hosts(1)[0]
+  tmpdir.join('manifest.yml').write(INVALID)
+
+  with pytest.raises(Exception) as error:
+    TaskRunner(str(tmpdir.join('manifest.yml')), [host.address]).run()
+
+  assert 'Install apache2 package' in str(error.value)
+  assert 'Missing options for file module in task `Deploy PHP app`: src, owner, group, mod' in str(error.value)
+  assert 'unknown module `cron`' in str(error.value)
+  assert host.transports == []
+
+SCHEDULED = """
+- name: "Install apache2 package"
+  apt:
+    package: "apache2"
+    action: "install"
+
+- name: "Deploy index.html"
+  depends_on: ["Install apache2 package"]
+  file: {src: "index.html", dest: "/var/www/html/index.html", owner: "www-data", group: "www-data", mod: 644, action: "present"}
+
+- name: "Deploy style.css"
+  depends_on: "Install apache2 package"
+  file: {src: "style.css", dest: "/var/www/html/style.css", owner: "www-data", group: "www-data", mod: 644, action: "present"}
+
+- name: "Deploy index.html again"
+  depends_on: []
+  file: {src: "index.html", dest: "/var/www/html/index.html", owner: "www-data", group: "www-data", mod: 644, action: "present"}
+
+- name: "Restart the apache2 service"
+  service:
+    name: "apache2"
+    action: "restart"
+"""
+
+def test_schedule_follows_depends_on_and_resources(tmpdir):
+  """ explicit dependencies and shared resources order tasks, tasks without depends_on wait for everything """
+  tmpdir.join('manifest.yml').write(SCHEDULED)
+
+  units = compile(str(tmpdir.join('manifest.yml'))).units
+
+  assert [[task['name'] for task in unit.tasks] for unit in units] == [
+    ['Install apache2 package'], ['Deploy index.html'], ['Deploy style.css'], ['Deploy index.html again'],
+    ['Restart the apache2 service']]
+  assert [sorted(unit.deps) for unit in units] == [[], [0], [0], [1], [0, 1, 2, 3]]
+
+def test_tasks_without_depends_on_do_not_widen_the_deps_of_a_unit(tmpdir):
+  """ a task waiting for everything starts its own unit rather than joining one with narrower dependencies """
+  tmpdir.join('manifest.yml').write("""
+- name: "Install apache2 package"
+  apt:
+    package: "apache2"
+    action: "install"
+
+- name: "Deploy style.css"
+  depends_on: []
+  file: {src: "style.css", dest: "/var/www/html/style.css", owner: "www-data", group: "www-data", mod: 644, action: "present"}
+
+- name: "Deploy index.html"
+  file: {src: "index.html", dest: "/var/www/html/index.html", owner: "www-data", group: "www-data", mod: 644, action: "present"}
+""")
+
+  units = compile(str(tmpdir.join('manifest.yml'))).units
+
+  assert [[task['name'] for task in unit.tasks] for unit in units] == [
+    ['Install apache2 package'], ['Deploy style.css'], ['Deploy index.html']]
+  assert [sorted(unit.deps) for unit in units] == [[], [], [0, 1]]
+
+def test_depends_on_must_name_earlier_tasks(tmpdir):
+  tmpdir.join('manifest.yml').write(MANIFEST.replace('  apt:\n    package: "apache2"', '  depends_on: ["Install php packages"]\n  apt:\n    package: "apache2"'))
+
+  with pytest.raises(Exception) as error:
+    compile(str(tmpdir.join('manifest.yml')))
+
+  assert 'depends on unknown or later tasks: Install php packages' in str(error.value)
+
+def test_task_names_must_be_unique(tmpdir):
+  """ task names key the journal (see hephaestus/journal.py), a repeated name would skip the second task on resume """
+  tmpdir.join('manifest.yml').write(MANIFEST + MANIFEST.split('\n\n')[0])
+
+  with pytest.raises(Exception) as error:
+    compile(str(tmpdir.join('manifest.yml')))
+
+  assert 'task `Install apache2 package` is defined more than once' in str(error.value)
+
+def test_plans_are_cached_on_disk(tmpdir, monkeypatch):
+  """ a manifest that did not change is not parsed again """
+  monkeypatch.setitem(config, 'plan_cache', str(tmpdir.join('cache')))
+  monkeypatch.setattr(hephaestus.plan, 'plans', {})
+  tmpdir.join('manifest.yml').write(MANIFEST)
+  plan = compile(str(tmpdir.join('manifest.yml')))
+
+  # forget the plans compiled by this process and break the yaml parser
+  monkeypatch.setattr(hephaestus.plan, 'plans', {})
+  monkeypatch.setattr(yaml, 'load', None)
+  cached = compile(str(tmpdir.join('manifest.yml')))
+
+  assert cached is not plan
+  assert cached.tasks == plan.tasks
+  assert len(tmpdir.join('cache').listdir()) == 1
+
+def test_handlers_are_validated_and_left_out_of_the_batches(tmpdir):
+  tmpdir.join('manifest.yml').write(MANIFEST.replace('name: "Restart the apache2 service"', 'name: "Restart the apache2 service"\n  handler: true')
+                                    .replace('action: "install"\n  name: "Install php packages"', 'action: "install"\n  name: "Install php packages"\n  notify: "Restart the apache2 service"'))
+  plan = compile(str(tmpdir.join('manifest.yml')))
+
+  assert [(module, len(tasks)) for module, cls, tasks in plan.batches] == [('apt', 2)]
+  assert [task['name'] for task in plan.handlers] == ['Restart the apache2 service']
+  assert plan.tasks[1]['notify'] == ['Restart the apache2 service']
+
+  with pytest.raises(Exception) as error:
+    Plan.validate(yaml.safe_load(MANIFEST.replace('action: "install"\n  name: "Install php packages"', 'action: "install"\n  name: "Install php packages"\n  notify: "Reload apache2"')))
+  assert 'notifies unknown handlers: Reload apache2' in str(error.value)
+
+def test_check_manifest_does_not_connect_nor_import_paramiko(tmpdir):
+  """ `hep --check-manifest` validates the manifest and exits before ssh is needed. """
+  root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  probe = ("import runpy, sys\n"
+           "sys.argv = sys.argv[1:]\n"
+           "try:\n"
+           "  runpy.run_path(sys.argv[0], run_name='__main__')\n"
+           "finally:\n"
+           "  sys.stdout.write('paramiko imported: %s' % ('paramiko' in sys.modules))\n")
+  env = dict(os.environ, PYTHONPATH=root)
+
+  def check(content):
+    tmpdir.join('manifest.yml').write(content)
+    process = subprocess.Popen([sys.executable, '-c', probe, os.path.join(root, 'bin/hep'),
+                                '-c', os.path.join(root, 'tests/config.yml'), '--check-manifest',
+                                str(tmpdir.join('manifest.yml'))],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    stdout, stderr = process.communicate()
+    return process.returncode, stdout.decode('utf-8'), stderr.decode('utf-8')
+
+  status, stdout, stderr = check(MANIFEST)
+  assert status == 0
+  assert '3 tasks, 0 handlers' in stdout
+  assert 'paramiko imported: False' in stdout
+
+  status, stdout, stderr = check(INVALID)
+  assert status == 1
+  assert 'Invalid manifest' in stderr
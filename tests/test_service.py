@@ -0,0 +1,25 @@
+import os
+
+from hephaestus.ssh import SSH
+from hephaestus.modules.service import Service
+
+TASK = {'name': 'Restart the apache2 service', 'service': {'name': 'apache2', 'action': 'restart'}}
+
+def test_restart_installed_service(fake_hosts):
+  host = fake_hosts(1)[0]
+  host.install('apache2')
+  ssh_client = SSH(host.address)
+  ssh_client.connect()
+
+  assert Service(TASK, ssh_client).execute_action() == True
+  ssh_client.close()
+  assert open(os.path.join(host.root, 'restarts')).read() == 'apache2\n'
+
+def test_missing_service_is_not_restarted(fake_hosts):
+  host = fake_hosts(1)[0]
+  ssh_client = SSH(host.address)
+  ssh_client.connect()
+
+  assert Service(TASK, ssh_client).execute_action() == False
+  ssh_client.close()
+  assert not os.path.exists(os.path.join(host.root, 'restarts'))
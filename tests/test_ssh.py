@@ -0,0 +1,122 @@
+import pytest
+import os
+import time
+
+from hephaestus.config import config
+from hephaestus.ssh import ConnectError, SSH, SSHError
+
+def test_copy_file_reuses_one_sftp_session(tmpdir, fake_hosts, monkeypatch):
+  """ every transfer goes through the same sftp session and large files are streamed in chunks """
+  host = fake_hosts(1)[0]
+  data = os.urandom(1024 * 1024 + 123)
+  tmpdir.join('src').write(data, mode = 'wb')
+  ssh_client = SSH(host.address)
+  ssh_client.chunk_size = 4096
+  ssh_client.max_pending_writes = 4
+  ssh_client.connect()
+
+  for i in range(3):
+    ssh_client.copy_file(str(tmpdir.join('src')), str(tmpdir.join('dest%d' % (i))))
+  ssh_client.close()
+
+  assert host.sftp_sessions == 1
+  for i in range(3):
+    assert tmpdir.join('dest%d' % (i)).read(mode = 'rb') == data
+
+def test_copy_file_bounds_the_writes_in_flight(tmpdir, fake_hosts, monkeypatch):
+  """ every `max_pending_writes` chunks a write waits for the acknowledgments of the writes in flight """
+  from paramiko.sftp_file import SFTPFile
+  pipelined = []
+  set_pipelined = SFTPFile.set_pipelined
+
+  def record(remote_file, value = True):
+    pipelined.append(value)
+    set_pipelined(remote_file, value)
+  monkeypatch.setattr(SFTPFile, 'set_pipelined', record)
+  host = fake_hosts(1)[0]
+  data = os.urandom(10 * 4096)
+  tmpdir.join('src').write(data, mode = 'wb')
+  ssh_client = SSH(host.address)
+  ssh_client.chunk_size = 4096
+  ssh_client.max_pending_writes = 4
+  ssh_client.connect()
+
+  ssh_client.copy_file(str(tmpdir.join('src')), str(tmpdir.join('dest')))
+  ssh_client.close()
+
+  assert pipelined == [True, True, True, False, True, True, True, False, True, True]
+  assert tmpdir.join('dest').read(mode = 'rb') == data
+
+def test_execute_many_returns_the_output_of_each_command(fake_hosts):
+  """ stdout, stderr and exit status of each command come back from a single remote shell """
+  host = fake_hosts(1)[0]
+  ssh_client = SSH(host.address)
+  ssh_client.connect()
+
+  results = ssh_client.execute_many(['echo one; echo two', 'echo oops >&2; exit 3', 'printf "no newline"', 'true'])
+
+  assert results == [(['one\n', 'two\n'], [], 0), ([], ['oops\n'], 3), (['no newline'], [], 0), ([], [], 0)]
+  assert len(host.commands) == 1
+
+  first = ssh_client.queue('echo first')
+  second = ssh_client.queue('false')
+  assert second.result == ([], [], 1)
+  assert first.result == (['first\n'], [], 0)
+  ssh_client.close()
+  assert len(host.commands) == 2
+
+def test_queued_commands_fail_with_the_flush(fake_hosts, monkeypatch):
+  """ a queued command whose flush failed raises rather than returning no result """
+  host = fake_hosts(1)[0]
+  ssh_client = SSH(host.address)
+  ssh_client.connect()
+  pending = ssh_client.queue('true')
+
+  def execute_many(commands):
+    raise SSHError('connection dropped')
+  monkeypatch.setattr(ssh_client, 'execute_many', execute_many)
+
+  with pytest.raises(SSHError):
+    ssh_client.flush()
+  with pytest.raises(SSHError) as error:
+    pending.result
+  assert 'connection dropped' in str(error.value)
+  ssh_client.close()
+
+def test_execute_fails_on_non_zero_exit_status(fake_hosts):
+  host = fake_hosts(1)[0]
+  ssh_client = SSH(host.address)
+  ssh_client.connect()
+
+  assert ssh_client.execute('echo warning >&2; echo done') == (['done\n'], ['warning\n'])
+  with pytest.raises(SSHError):
+    ssh_client.execute('echo output; exit 1')
+  ssh_client.close()
+
+def test_execute_streams_both_outputs_with_bounded_memory(fake_hosts):
+  """ a command filling stderr while we expect stdout does not block, only the tail of the output is kept """
+  host = fake_hosts(1)[0]
+  ssh_client = SSH(host.address)
+  ssh_client.connect()
+  seen = []
+
+  stdout, stderr = ssh_client.execute("seq 1 100000 >&2; echo done", on_line = lambda stream, line: seen.append(stream), tail = 3)
+  ssh_client.close()
+
+  assert stdout == ['done\n']
+  assert stderr == ['99998\n', '99999\n', '100000\n']
+  assert seen.count('stderr') == 100000
+
+def test_connect_retries_transient_failures(fake_hosts, monkeypatch):
+  """ an unreachable host is retried with a backoff before the connection fails with a ConnectError """
+  host = fake_hosts(1)[0]
+  host.stop()
+  monkeypatch.setitem(config, 'ssh', dict(config['ssh'], connect_retries = 2, connect_backoff = 0.2))
+  ssh_client = SSH(host.address)
+
+  start = time.time()
+  with pytest.raises(ConnectError):
+    ssh_client.connect()
+
+  # 0.2 seconds before the first retry, 0.4 before the second one
+  assert time.time() - start >= 0.6
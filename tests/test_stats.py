@@ -0,0 +1,63 @@
+import json
+
+from hephaestus.config import config
+from hephaestus.stats import NullStats, Stats, prometheus
+from hephaestus.task_runner import TaskRunner
+
+def test_run_writes_json_and_prometheus_reports(tmpdir, monkeypatch, fake_hosts, deploy_manifest):
+  """ connect time, round trips, bytes and task timings of each host end up in both reports """
+  host = fake_hosts(1)[0]
+  tmpdir.join('index.html').write('x' * 1000)
+  monkeypatch.setitem(config, 'stats', {'json': str(tmpdir.join('stats.json')),
+                                        'prometheus': str(tmpdir.join('hep.prom'))})
+
+  TaskRunner(deploy_manifest, [host.address]).run()
+
+  report = json.loads(tmpdir.join('stats.json').read())
+  stats = report['hosts'][host.address]
+  assert stats['connect_seconds'] > 0
+  assert stats['execute_calls'] >= 2 # apt-get update, apt-get install
+  assert stats['copy_file_calls'] == 1
+  assert stats['agent_calls'] >= 2 # dpkg status, stat
+  assert stats['bytes_sent'] >= 1000
+  assert stats['bytes_received'] > 0
+  assert [(task['module'], task['changed']) for task in stats['tasks']] == [('apt', True), ('file', True)]
+  assert sorted(stats['modules']) == ['apt', 'file']
+  assert stats['seconds'] >= sum(task['seconds'] for task in stats['tasks'])
+
+  textfile = tmpdir.join('hep.prom').read()
+  assert 'hep_host_copy_file_calls{host="%s"} 1' % (host.address) in textfile
+  assert 'hep_task_changed{host="%s",module="file",task="Deploy index.html"} 1' % (host.address) in textfile
+
+def test_prometheus_escapes_labels():
+  """ quotes, backslashes and newlines in task names don't break the textfile """
+  report = {'seconds': 1.0, 'hosts': {'h': {'tasks': [{'name': 'say "hi"\\\n', 'module': 'apt', 'seconds': 0.5,
+                                                       'changed': False}], 'modules': {}}}}
+  for counter in ['connect_seconds', 'execute_calls', 'copy_file_calls', 'agent_calls', 'bytes_sent',
+                  'bytes_received', 'seconds']:
+    report['hosts']['h'][counter] = 0
+
+  assert 'hep_task_seconds{host="h",module="apt",task="say \\"hi\\"\\\\\\n"} 0.5' in prometheus(report)
+
+def test_prometheus_has_one_sample_per_task():
+  """ the runs of a handler notified twice are summed, so the textfile has no duplicate series """
+  report = {'seconds': 1.0, 'hosts': {'h': {'tasks': [
+    {'name': 'Restart apache2', 'module': 'service', 'seconds': 0.5, 'changed': False},
+    {'name': 'Restart apache2', 'module': 'service', 'seconds': 0.25, 'changed': True}], 'modules': {}}}}
+  for counter in ['connect_seconds', 'execute_calls', 'copy_file_calls', 'agent_calls', 'bytes_sent',
+                  'bytes_received', 'seconds']:
+    report['hosts']['h'][counter] = 0
+
+  samples = [line for line in prometheus(report).splitlines() if line.startswith('hep_task_')]
+  assert samples == ['hep_task_seconds{host="h",module="service",task="Restart apache2"} 0.75',
+                     'hep_task_changed{host="h",module="service",task="Restart apache2"} 1']
+
+def test_disabled_stats_record_nothing():
+  """ without a report file nothing is collected nor written """
+  stats = NullStats()
+  stats.host('h').add('execute_calls')
+  stats.host('h').task('apt', 'task', 1.0, True)
+
+  assert not stats.enabled
+  assert stats.report() == None
+  assert Stats().report()['hosts'] == {}
@@ -0,0 +1,180 @@
+import os
+import time
+
+from hephaestus.config import config
+from hephaestus.task_runner import TaskRunner
+
+MANIFEST = """
+- name: "Install apache2 package"
+  apt:
+    package: "apache2"
+    action: "install"
+
+- name: "Install php package"
+  apt:
+    package: "php5"
+    action: "install"
+"""
+
+def use_inventory(tmpdir, monkeypatch, hosts, manifest = MANIFEST):
+  """ Points the config at a manifest and at a hosts file listing `hosts`. """
+  tmpdir.join('manifest.yml').write(manifest)
+  tmpdir.join('hosts').write('\n'.join(hosts) + '\n')
+  monkeypatch.setitem(config, 'manifest', str(tmpdir.join('manifest.yml')))
+  monkeypatch.setitem(config, 'hosts', str(tmpdir.join('hosts')))
+
+def test_run_converges_hosts_in_parallel(tmpdir, monkeypatch, fake_hosts):
+  """ Running the manifest on 4 hosts at a time is much faster than one host at a time """
+  hosts = fake_hosts(4, latency = 0.5)
+  for host in hosts:
+    host.install('apache2', 'php5')
+  use_inventory(tmpdir, monkeypatch, [host.address for host in hosts])
+
+  timings = {}
+  for forks in [1, 4]:
+    monkeypatch.setitem(config, 'forks', forks)
+    start = time.time()
+    results = TaskRunner().run()
+    timings[forks] = time.time() - start
+
+    for host in hosts:
+      assert results[host.address] == {'ok': 2, 'changed': 0, 'failed': False, 'error': None}
+
+  assert timings[4] < timings[1] / 2
+
+def test_failed_host_does_not_stop_other_hosts(tmpdir, monkeypatch, fake_hosts):
+  """ A host that can't be reached is reported as failed while the other hosts are still converged """
+  host = fake_hosts(1)[0]
+  host.install('apache2', 'php5')
+  unreachable = fake_hosts(1)[0]
+  unreachable.stop()
+  use_inventory(tmpdir, monkeypatch, [unreachable.address, host.address])
+
+  results = TaskRunner().run()
+
+  assert results[unreachable.address]['failed']
+  assert results[host.address] == {'ok': 2, 'changed': 0, 'failed': False, 'error': None}
+
+def test_independent_tasks_run_concurrently(tmpdir, monkeypatch, fake_hosts):
+  """ tasks that declare their dependencies run at the same time over the same connection """
+  host = fake_hosts(1, latency = 0.5)[0]
+  services = ['apache2', 'mysql', 'redis', 'memcached']
+  host.install(*services)
+  manifest = ''.join('- name: "Restart %s"\n  depends_on: []\n  service: {name: "%s", action: "restart"}\n' % (service, service)
+                     for service in services)
+  use_inventory(tmpdir, monkeypatch, [host.address], manifest)
+
+  timings = {}
+  for task_concurrency in [1, 4]:
+    monkeypatch.setitem(config, 'task_concurrency', task_concurrency)
+    start = time.time()
+    results = TaskRunner().run()
+    timings[task_concurrency] = time.time() - start
+
+    assert results[host.address] == {'ok': 0, 'changed': 4, 'failed': False, 'error': None}
+
+  assert timings[4] < timings[1] / 2
+  assert len(host.transports) == 2
+  assert sorted(open(os.path.join(host.root, 'restarts')).read().split()) == sorted(services * 2)
+
+def test_rolling_batches_abort_after_too_many_failures(tmpdir, monkeypatch, fake_hosts):
+  """ once a batch fails more than max_fail_percentage of its hosts the remaining batches are not run """
+  monkeypatch.setitem(config, 'ssh', dict(config['ssh'], connect_retries = 0))
+  unreachable = fake_hosts(1)[0]
+  unreachable.stop()
+  hosts = fake_hosts(3)
+  for host in hosts:
+    host.install('apache2', 'php5')
+  use_inventory(tmpdir, monkeypatch, [hosts[0].address, unreachable.address] + [host.address for host in hosts[1:]])
+  monkeypatch.setitem(config, 'serial', 2)
+  monkeypatch.setitem(config, 'max_fail_percentage', 0)
+
+  runner = TaskRunner()
+  assert runner.rolling_batches() == [[hosts[0].address, unreachable.address], [host.address for host in hosts[1:]]]
+  results = runner.run()
+
+  assert results[hosts[0].address] == {'ok': 2, 'changed': 0, 'failed': False, 'error': None}
+  assert results[unreachable.address]['failed']
+  for host in hosts[1:]:
+    assert results[host.address]['failed']
+    assert results[host.address]['error'].startswith('not run')
+    assert host.transports == []
+
+  monkeypatch.setitem(config, 'serial', '25%')
+  assert [len(batch) for batch in TaskRunner().rolling_batches()] == [1, 1, 1, 1]
+
+def test_prestage_downloads_packages_before_the_tasks_run(tmpdir, monkeypatch, fake_hosts):
+  """ the packages a host is missing are downloaded before the first task runs, then installed from the cache """
+  hosts = fake_hosts(3)
+  hosts[0].install('apache2')
+  use_inventory(tmpdir, monkeypatch, [host.address for host in hosts])
+  monkeypatch.setitem(config, 'prestage', True)
+  monkeypatch.setitem(config, 'prestage_concurrency', 1)
+
+  results = TaskRunner().run()
+
+  assert results[hosts[0].address] == {'ok': 1, 'changed': 1, 'failed': False, 'error': None}
+  assert open(os.path.join(hosts[0].root, 'archives')).read().split() == ['php5']
+  for host in hosts[1:]:
+    assert results[host.address] == {'ok': 0, 'changed': 2, 'failed': False, 'error': None}
+    assert open(os.path.join(host.root, 'archives')).read().split() == ['apache2', 'php5']
+  for host in hosts:
+    apt_get = [command for command in host.commands if 'apt-get install' in command]
+    assert len(apt_get) == 2 and '--download-only' in apt_get[0]
+    assert len([command for command in host.commands if 'apt-get update' in command]) == 1
+
+def test_prestage_pass_downloads_on_every_host_before_any_task(tmpdir, monkeypatch, fake_hosts):
+  """ the hosts of a batch are all prestaged (concurrently) before the task pass, which reuses their connections """
+  hosts = fake_hosts(3)
+  use_inventory(tmpdir, monkeypatch, [host.address for host in hosts])
+  monkeypatch.setitem(config, 'prestage', True)
+  monkeypatch.setitem(config, 'forks', 1)
+  monkeypatch.setitem(config, 'prestage_concurrency', 3)
+  calls = []
+  prestaged, execute = TaskRunner.prestaged, TaskRunner.execute
+  monkeypatch.setattr(TaskRunner, 'prestaged', lambda self, host, *args: calls.append('prestage') or prestaged(self, host, *args))
+  monkeypatch.setattr(TaskRunner, 'execute', lambda self, host, *args: calls.append('execute') or execute(self, host, *args))
+
+  results = TaskRunner().run()
+
+  assert not any(result['failed'] for result in results.values())
+  assert calls == ['prestage'] * 3 + ['execute'] * 3
+  for host in hosts:
+    assert len(host.transports) == 1
+
+HANDLERS = """
+- name: "Install apache2 package"
+  apt: {package: "apache2", action: "install"}
+  notify: "Restart apache2"
+
+- name: "Install php package"
+  apt: {package: "php5", action: "install"}
+  notify: ["Restart apache2"]
+  flush_handlers: %s
+
+- name: "Install libapache2-mod-php5 package"
+  apt: {package: "libapache2-mod-php5", action: "install"}
+  notify: "Restart apache2"
+
+- name: "Restart apache2"
+  handler: true
+  service: {name: "apache2", action: "restart"}
+"""
+
+def test_handlers_run_once_per_host_when_notified(tmpdir, monkeypatch, fake_hosts):
+  """ notified handlers run once at the end of the plan (or at a flush point), and not at all if nothing changed """
+  host = fake_hosts(1)[0]
+  restarts = lambda: open(os.path.join(host.root, 'restarts')).read().split() if os.path.exists(os.path.join(host.root, 'restarts')) else []
+  use_inventory(tmpdir, monkeypatch, [host.address], HANDLERS % ('false'))
+
+  assert TaskRunner().run()[host.address] == {'ok': 0, 'changed': 4, 'failed': False, 'error': None}
+  assert restarts() == ['apache2']
+
+  assert TaskRunner().run()[host.address] == {'ok': 3, 'changed': 0, 'failed': False, 'error': None}
+  assert restarts() == ['apache2']
+
+  # the handlers notified before the flush point run there, the ones notified later at the end of the plan
+  open(os.path.join(host.root, 'dpkg'), 'w').close()
+  use_inventory(tmpdir, monkeypatch, [host.address], HANDLERS % ('true'))
+  assert TaskRunner().run()[host.address] == {'ok': 0, 'changed': 5, 'failed': False, 'error': None}
+  assert restarts() == ['apache2'] * 3
@@ -0,0 +1,92 @@
+import grp
+import os
+import pwd
+
+import pytest
+
+from hephaestus import template
+from hephaestus.inventory import Inventory
+from hephaestus.task_runner import TaskRunner
+
+OWNER = pwd.getpwuid(os.getuid()).pw_name
+GROUP = grp.getgrgid(os.getgid()).gr_name
+
+HOSTS = """
+[all:vars]
+listen = 0.0.0.0
+workers = 1
+
+[web]
+web[1:2] tier=front
+web3 workers=16
+
+[web:vars]
+workers = 4
+tier = "back end"
+
+[prod:children]
+web
+
+[prod:vars]
+workers = 2
+env = prod
+"""
+
+MANIFEST = """
+- name: "Deploy the config"
+  file:
+    src: "%(src)s"
+    dest: "%(dest)s/${name}.conf"
+    owner: "%(owner)s"
+    group: "%(group)s"
+    mod: 644
+    action: "present"
+    template: true
+"""
+
+def test_variables_of_the_hosts(tmpdir):
+  tmpdir.join('hosts').write(HOSTS)
+  hosts = list(Inventory(str(tmpdir.join('hosts'))).select())
+
+  assert [host for host, variables in hosts] == ['web1', 'web2', 'web3']
+  # all < parent groups < group < host
+  assert hosts[0][1] == {'listen': '0.0.0.0', 'workers': '4', 'tier': 'front', 'env': 'prod'}
+  assert hosts[2][1] == {'listen': '0.0.0.0', 'workers': '16', 'tier': 'back end', 'env': 'prod'}
+
+def test_templates_render_once_per_set_of_variables(tmpdir):
+  """ hosts sharing the values of the variables a template uses share the rendered file and its hash """
+  tmpdir.join('nginx.conf').write('listen $listen;\nworker_processes $workers;\nset $$upstream;\n')
+  tmpdir.join('manifest.yaml').write(MANIFEST % {'src': tmpdir.join('nginx.conf'), 'dest': tmpdir,
+                                                 'owner': OWNER, 'group': GROUP})
+  hosts = ['local://web1', 'local://web2', 'local://web3']
+  variables = {'local://web1': {'name': 'web1', 'listen': '10.0.0.1', 'workers': '4'},
+               'local://web2': {'name': 'web2', 'listen': '10.0.0.1', 'workers': '4'},
+               'local://web3': {'name': 'web3', 'listen': '10.0.0.3', 'workers': '4', 'unused': 'x'}}
+
+  renders = len(template.rendered)
+  runner = TaskRunner(str(tmpdir.join('manifest.yaml')), hosts, variables)
+  assert len(template.rendered) == renders + 2
+  assert len(set(runner.plans.values())) == 3 # the dest files differ
+
+  results = runner.run()
+  assert [results[host]['changed'] for host in hosts] == [1, 1, 1]
+  assert tmpdir.join('web2.conf').read() == 'listen 10.0.0.1;\nworker_processes 4;\nset $upstream;\n'
+  assert tmpdir.join('web3.conf').read() == 'listen 10.0.0.3;\nworker_processes 4;\nset $upstream;\n'
+
+  # the rendered files are compared to the dest files like any src file
+  results = TaskRunner(str(tmpdir.join('manifest.yaml')), hosts, variables).run()
+  assert [results[host]['ok'] for host in hosts] == [1, 1, 1]
+  assert len(template.rendered) == renders + 2
+
+def test_undefined_variables_fail_before_connecting(tmpdir):
+  tmpdir.join('nginx.conf').write('worker_processes $workers;\n')
+  tmpdir.join('manifest.yaml').write(MANIFEST % {'src': tmpdir.join('nginx.conf'), 'dest': tmpdir,
+                                                 'owner': OWNER, 'group': GROUP})
+
+  with pytest.raises(Exception) as error:
+    TaskRunner(str(tmpdir.join('manifest.yaml')), ['local://web1'], {'local://web1': {'name': 'web1'}})
+  assert 'undefined variable `workers`' in str(error.value)
+
+def test_plain_manifests_are_not_rendered(tmpdir):
+  tmpdir.join('manifest.yaml').write('- name: "Restart"\n  service:\n    name: "apache2"\n    action: "restart"\n')
+  assert TaskRunner(str(tmpdir.join('manifest.yaml')), ['local://web1']).plans == {}